@@ -1,5 +1,6 @@
 from django.contrib import admin
 
-from agent.models import AgentMessage
+from agent.models import AgentMessage, ConversationSummary
 
 admin.site.register(AgentMessage)
+admin.site.register(ConversationSummary)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+logger = logging.getLogger('django')
+from typing import Any, Dict, List, Optional
+
+from pairdraft.redis_manager import redis_manager
+from documents import yjs
+
+
+DOCUMENT_TEXT_TTL = 3600 # seconds
+
+# element nodes that render inside a line instead of starting a new one
+INLINE_ELEMENT_TYPES = {'link', 'autolink', 'mark', 'ins'}
+
+
+def flatten_lexical(editor_state: str | Dict[str, Any]) -> str:
+    """
+    Flattens a serialized Lexical editor state into plain text for the agent.
+
+    Each block node is written on its own line and every keyed text node
+    is prefixed with its key, i.e. "[45]The buyer agrees", so the agent can
+    still reference start_key/offset positions in its proposed changes.
+    Text in comment marks is wrapped in "⟦mark:<ids>⟧...⟦/mark⟧", so the agent
+    can find the text of the active mark ids.
+    If the state is not Lexical JSON it is returned unchanged.
+    """
+    if isinstance(editor_state, str):
+        try:
+            editor_state = json.loads(editor_state)
+        except json.JSONDecodeError:
+            return editor_state
+
+    if not isinstance(editor_state, dict):
+        return str(editor_state)
+
+    root = editor_state.get('root', editor_state)
+    lines: List[str] = []
+    _flatten_block(root, lines)
+    return '\n'.join(lines)
+
+
+def _flatten_block(node: Dict[str, Any], lines: List[str]):
+    parts: List[str] = []
+    for child in node.get('children', []):
+        if 'children' in child and child.get('type') not in INLINE_ELEMENT_TYPES:
+            # flush the current line before a nested block (i.e. list items)
+            if parts:
+                lines.append(''.join(parts))
+                parts = []
+            _flatten_block(child, lines)
+        else:
+            _flatten_inline(child, parts)
+    if parts:
+        lines.append(''.join(parts))
+
+
+def _flatten_inline(node: Dict[str, Any], parts: List[str]):
+    node_type = node.get('type')
+    if node_type == 'linebreak':
+        parts.append('\n')
+    elif node_type == 'tab':
+        parts.append('\t')
+    elif node_type == 'mark':
+        parts.append(f"⟦mark:{','.join(str(id) for id in node.get('ids', []))}⟧")
+        for child in node.get('children', []):
+            _flatten_inline(child, parts)
+        parts.append('⟦/mark⟧')
+    elif 'children' in node:
+        for child in node['children']:
+            _flatten_inline(child, parts)
+    elif 'text' in node:
+        key = node.get('__key')
+        parts.append(f"[{key}]{node['text']}" if key else node['text'])
+
+
+def get_cache_key(document_id: str, version: str) -> str:
+    """Returns the cache key of a document's text at a version, the state vector is hashed to keep keys short."""
+    return f'document_text_document_id_{document_id}_{hashlib.sha256(version.encode()).hexdigest()[:16]}'
+
+
+def get_document_text(document_id: str, version: Optional[str] = None, editor_state: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the flattened text of a document for the agent prompt.
+
+    If the client sent the editor state, it is flattened and cached under
+    the client's Yjs state vector (version), so collaborators on different
+    versions keep their own snapshot.  Otherwise the cached snapshot of the
+    version is returned as long as no Yjs update has been written since it
+    was cached.  Returns None on a cache miss, in which case
+    the client needs to send the editor state.
+    """
+    if editor_state:
+        text = flatten_lexical(editor_state)
+        if version:
+            key = get_cache_key(document_id, version)
+            snapshot = {
+                'version': version,
+                'yjs_update_id': yjs.get_latest_update_id(document_id),
+                'text': text
+            }
+            redis_manager.r.set(key, json.dumps(snapshot), ex=DOCUMENT_TEXT_TTL)
+        return text
+
+    if not version:
+        return None
+
+    key = get_cache_key(document_id, version)
+    snapshot = redis_manager.r.get(key)
+    if not snapshot:
+        return None
+
+    snapshot = json.loads(snapshot)
+    if snapshot.get('version') != version:
+        return None
+
+    if snapshot.get('yjs_update_id') != yjs.get_latest_update_id(document_id):
+        # the document was edited since the snapshot was taken
+        redis_manager.r.delete(key)
+        return None
+
+    return snapshot.get('text')
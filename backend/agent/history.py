@@ -0,0 +1,177 @@
+"""
+Conversation history for the agent.
+
+The messages of a user on a document that are not in the rolling
+ConversationSummary yet are sent to the model verbatim.  Once more than
+AGENT_HISTORY_MESSAGES have accumulated, the older ones are folded into the
+summary in batches, so the prompt stays bounded on long negotiations and no
+message is left out of both.
+"""
+
+import asyncio
+import logging
+logger = logging.getLogger('django')
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from channels.db import database_sync_to_async
+
+from agent import prompt as agent_prompt
+from agent.models import AgentMessage, ConversationSummary
+
+
+# upper bound of messages folded into the summary by one model call
+SUMMARY_MAX_MESSAGES = 50
+
+# running summary updates by (user profile id, document id), referenced until they finish
+_summary_tasks: Dict[Tuple[Any, Any], asyncio.Task] = {}
+
+
+def to_chat_message(role: str, content: str) -> Dict[str, str]:
+    return {
+        'role': 'assistant' if role == AgentMessage.AGENT else 'user',
+        'content': content
+    }
+
+
+def window(conversation_history: List[Dict[str, str]], limit: Optional[int] = None) -> List[Dict[str, str]]:
+    """Returns the last messages of a conversation that are sent verbatim."""
+    limit = limit or settings.AGENT_HISTORY_MESSAGES
+    return conversation_history[-limit:]
+
+
+def after_summary(messages, summarized_until, summarized_until_id):
+    """
+    Filters the messages to those after the latest message of the summary, in the order
+    (timestamp, id), so messages saved with the same timestamp are not skipped.
+    """
+    if summarized_until_id is None:
+        return messages.filter(timestamp__gt=summarized_until)
+    return messages.filter(Q(timestamp__gt=summarized_until) | Q(timestamp=summarized_until, id__gt=summarized_until_id))
+
+
+def load_history(user_profile_id, document_id, limit: Optional[int] = None) -> Tuple[Optional[str], List[Dict[str, str]]]:
+    """
+    Returns the rolling summary and the messages of a user on a document that are
+    not in the summary, oldest first.  These are at least the last limit messages
+    and the older ones waiting to be folded into the summary, at most
+    SUMMARY_MAX_MESSAGES of those if summarizing fell behind.
+    The messages are read with one query on agent_msg_history_idx.
+    """
+    limit = limit or settings.AGENT_HISTORY_MESSAGES
+    summary = ConversationSummary.objects \
+        .filter(user_profile_id=user_profile_id, document_id=document_id) \
+        .values('content', 'summarized_until', 'summarized_until_id') \
+        .first()
+
+    messages = AgentMessage.objects.filter(user_profile_id=user_profile_id, document_id=document_id)
+    if summary:
+        messages = after_summary(messages, summary['summarized_until'], summary['summarized_until_id'])
+    messages = list(messages.order_by('-timestamp', '-id').values_list('role', 'content')[:limit + SUMMARY_MAX_MESSAGES])
+
+    return summary and summary['content'], [to_chat_message(role, content) for role, content in reversed(messages)]
+
+
+def save_turn(user_profile, document, user_message: str, agent_message: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None) -> List[AgentMessage]:
+    """Saves the user message and the agent reply of one turn with a single insert."""
+    messages = [AgentMessage(user_profile=user_profile, document=document, role=AgentMessage.USER, content=user_message)]
+    if agent_message:
+        messages.append(AgentMessage(
+            user_profile=user_profile,
+            document=document,
+            role=AgentMessage.AGENT,
+            content=agent_message,
+            metadata=metadata or {}
+        ))
+
+    with transaction.atomic():
+        return AgentMessage.objects.bulk_create(messages)
+
+
+def get_unsummarized_messages(user_profile_id, document_id, limit: Optional[int] = None) -> Tuple[Optional[ConversationSummary], List[Dict[str, Any]]]:
+    """
+    Returns the summary and the messages that fell out of the history window
+    but are not included in the summary yet, oldest first.
+    """
+    limit = limit or settings.AGENT_HISTORY_MESSAGES
+    summary = ConversationSummary.objects.filter(user_profile_id=user_profile_id, document_id=document_id).first()
+
+    messages = AgentMessage.objects.filter(user_profile_id=user_profile_id, document_id=document_id)
+    if summary:
+        messages = after_summary(messages, summary.summarized_until, summary.summarized_until_id)
+    messages = list(messages.order_by('-timestamp', '-id').values('id', 'role', 'content', 'timestamp')[limit:])
+    messages.reverse()
+
+    return summary, messages[:SUMMARY_MAX_MESSAGES]
+
+
+def save_summary(summary: Optional[ConversationSummary], user_profile_id, document_id, content: str, messages: List[Dict[str, Any]]) -> ConversationSummary:
+    """Saves the summary of a conversation, a summary written by another process in the meantime is replaced."""
+    summary, _ = ConversationSummary.objects.update_or_create(
+        user_profile_id=user_profile_id,
+        document_id=document_id,
+        defaults={
+            'content': content,
+            'summarized_until': messages[-1]['timestamp'],
+            'summarized_until_id': messages[-1]['id'],
+            'message_count': (summary.message_count if summary else 0) + len(messages)
+        }
+    )
+    return summary
+
+
+async def update_summary(llm, user_profile_id, document_id) -> Optional[ConversationSummary]:
+    """
+    Folds the messages that fell out of the history window into the rolling summary
+    once at least AGENT_SUMMARY_BATCH_MESSAGES of them have accumulated,
+    so the summary is rewritten every few turns instead of on every request.
+    """
+    summary, messages = await database_sync_to_async(get_unsummarized_messages)(user_profile_id, document_id)
+    if len(messages) < settings.AGENT_SUMMARY_BATCH_MESSAGES:
+        return None
+
+    try:
+        completion = await llm.chat.completions.create(
+            model=agent_prompt.MODEL,
+            messages=agent_prompt.build_summary_messages(
+                summary=summary.content if summary else None,
+                conversation_history=[to_chat_message(message['role'], message['content']) for message in messages]
+            )
+        )
+        content = completion.choices[0].message.content
+    except Exception as e:
+        logger.error(f"Could not summarize agent conversation for document {document_id}: {e}")
+        return None
+
+    if not content:
+        return None
+
+    return await database_sync_to_async(save_summary)(summary, user_profile_id, document_id, content, messages)
+
+
+def schedule_summary_update(llm, user_profile_id, document_id) -> asyncio.Task:
+    """
+    Runs update_summary in the background of the event loop, so the socket keeps
+    receiving while the summary is written.  A conversation has at most one update
+    running, a request while it runs returns the running one.
+    """
+    key = (user_profile_id, document_id)
+    task = _summary_tasks.get(key)
+    if task is not None and not task.done():
+        return task
+
+    task = asyncio.get_running_loop().create_task(update_summary(llm, user_profile_id, document_id))
+    _summary_tasks[key] = task
+    task.add_done_callback(lambda task: _summary_done(key, task))
+    return task
+
+
+def _summary_done(key, task: asyncio.Task):
+    if _summary_tasks.get(key) is task:
+        del _summary_tasks[key]
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logger.error(f"Could not update agent conversation summary for document {key[1]}: {task.exception()!r}")
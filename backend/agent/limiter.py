@@ -0,0 +1,161 @@
+"""
+Admission control for agent requests.
+
+Every request needs a slot for its user, its document and one of the
+global slots before the model is called.  Slots are leases in Redis
+sorted sets (scored by their expiry), so the limits hold across Daphne
+replicas and a crashed process cannot keep its slots.
+
+Requests wait for their user and document slots first and only then join
+the global queue, so a user waiting on their own limit never blocks the
+queue for everyone else.
+"""
+
+import asyncio
+import logging
+logger = logging.getLogger('django')
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from pairdraft.redis_manager import redis_manager
+from billing.models import Usage
+
+
+GLOBAL_KEY = 'agent_slots'
+QUEUE_KEY = 'agent_queue'
+HEARTBEAT_KEY = 'agent_queue_heartbeats'
+
+LEASE_TTL = 300 # seconds a slot is held at most, longer than any agent stream
+STALE_AFTER = 10 # seconds after which a waiter that stopped polling leaves the queue
+
+ADMITTED = -1
+WAITING_FOR_USER = -2 # the user or document has no free slot yet
+
+# KEYS: user slots, document slots, global slots, queue, heartbeats
+# ARGV: lease id, now, lease ttl, stale after, user limit, document limit, global limit
+# Returns ADMITTED, WAITING_FOR_USER or the 0-based position in the global queue
+ACQUIRE_SCRIPT = """
+local lease = ARGV[1]
+local now = tonumber(ARGV[2])
+local expires = now + tonumber(ARGV[3])
+
+for i = 1, 3 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+end
+local stale = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', now - tonumber(ARGV[4]))
+for _, member in ipairs(stale) do
+    redis.call('ZREM', KEYS[4], member)
+    redis.call('ZREM', KEYS[5], member)
+end
+
+if not redis.call('ZSCORE', KEYS[1], lease) then
+    if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[5]) or redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[6]) then
+        return -2
+    end
+end
+redis.call('ZADD', KEYS[1], expires, lease)
+redis.call('ZADD', KEYS[2], expires, lease)
+
+if not redis.call('ZSCORE', KEYS[4], lease) then
+    redis.call('ZADD', KEYS[4], now, lease)
+end
+redis.call('ZADD', KEYS[5], now, lease)
+
+local position = redis.call('ZRANK', KEYS[4], lease)
+if position < tonumber(ARGV[7]) - redis.call('ZCARD', KEYS[3]) then
+    redis.call('ZADD', KEYS[3], expires, lease)
+    redis.call('ZREM', KEYS[4], lease)
+    redis.call('ZREM', KEYS[5], lease)
+    return -1
+end
+return position
+"""
+
+
+class AgentLimitExceeded(Exception):
+    """Raised when an agent request cannot be admitted."""
+
+
+def get_current_usage(user_profile_id) -> Optional[Usage]:
+    now = timezone.now()
+    return Usage.objects.filter(
+        user_profile_id=user_profile_id,
+        period_start__lte=now,
+        period_end__gt=now
+    ).first()
+
+
+class AgentSlot:
+    """
+    Async context manager that waits for a slot for an agent request.
+
+    on_queued is awaited with the 1-based queue position (None while waiting for
+    the user's or document's own limit) whenever the position changes.
+
+        async with AgentSlot(user_profile_id, document_id, on_queued=send_position):
+            ... # call the model
+    """
+
+    def __init__(self, user_profile_id, document_id=None, on_queued: Optional[Callable[[Optional[int]], Awaitable]] = None):
+        self.lease = uuid.uuid4().hex
+        self.user_key = f'agent_slots_user_profile_id_{user_profile_id}'
+        self.document_key = f'agent_slots_document_id_{document_id}'
+        self.on_queued = on_queued
+
+    def try_acquire(self) -> int:
+        return redis_manager.r.eval(
+            ACQUIRE_SCRIPT,
+            5,
+            self.user_key, self.document_key, GLOBAL_KEY, QUEUE_KEY, HEARTBEAT_KEY,
+            self.lease,
+            time.time(),
+            LEASE_TTL,
+            STALE_AFTER,
+            settings.AGENT_MAX_REQUESTS_PER_USER,
+            settings.AGENT_MAX_REQUESTS_PER_DOCUMENT,
+            settings.AGENT_MAX_REQUESTS
+        )
+
+    def release(self):
+        pipeline = redis_manager.r.pipeline()
+        for key in (self.user_key, self.document_key, GLOBAL_KEY, QUEUE_KEY, HEARTBEAT_KEY):
+            pipeline.zrem(key, self.lease)
+        pipeline.execute()
+
+    async def __aenter__(self):
+        deadline = time.monotonic() + settings.AGENT_QUEUE_TIMEOUT
+        last_position = ADMITTED
+        try:
+            while True:
+                try:
+                    result = await sync_to_async(self.try_acquire, thread_sensitive=False)()
+                except Exception as e:
+                    # admit the request rather than taking the agent down with Redis
+                    logger.error(f"Could not acquire agent slot: {e}")
+                    return self
+
+                if result == ADMITTED:
+                    return self
+                if time.monotonic() >= deadline:
+                    raise AgentLimitExceeded("The agent is busy, please try again in a moment.")
+
+                position = None if result == WAITING_FOR_USER else result + 1
+                if position != last_position and self.on_queued:
+                    await self.on_queued(position)
+                last_position = position
+                await asyncio.sleep(settings.AGENT_QUEUE_POLL_INTERVAL)
+        except BaseException:
+            # i.e. timed out or the socket closed while waiting
+            await self.__aexit__(None, None, None)
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await sync_to_async(self.release, thread_sensitive=False)()
+        except Exception as e:
+            logger.error(f"Could not release agent slot: {e}")
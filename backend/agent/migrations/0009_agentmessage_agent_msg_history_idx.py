@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agent', '0008_remove_branchingstep_step_ptr_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agentmessage',
+            index=models.Index(fields=['user_profile', 'document', 'timestamp'], name='agent_msg_history_idx'),
+        ),
+    ]
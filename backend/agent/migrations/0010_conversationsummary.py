@@ -0,0 +1,29 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_alter_action_type'),
+        ('users', '0004_alter_userprofile_first_name_and_more'),
+        ('agent', '0009_agentmessage_agent_msg_history_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('summarized_until', models.DateTimeField(help_text='Timestamp of the latest message included in the summary')),
+                ('message_count', models.IntegerField(default=0, help_text='Number of messages included in the summary')),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to='documents.document')),
+                ('user_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to='users.userprofile')),
+            ],
+        ),
+    ]
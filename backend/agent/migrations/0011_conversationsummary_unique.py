@@ -0,0 +1,36 @@
+# Generated by Django 4.2.2 on 2026-10-18 04:38
+
+from django.db import migrations, models
+
+
+def delete_duplicate_summaries(apps, schema_editor):
+    """Keep the most recently updated summary of each user on a document."""
+    ConversationSummary = apps.get_model('agent', 'ConversationSummary')
+    seen = set()
+    duplicates = []
+    for summary in ConversationSummary.objects.order_by('user_profile_id', 'document_id', '-updated'):
+        key = (summary.user_profile_id, summary.document_id)
+        if key in seen:
+            duplicates.append(summary.id)
+        seen.add(key)
+    ConversationSummary.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agent', '0010_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='summarized_until_id',
+            field=models.UUIDField(blank=True, help_text='Id of the latest message included in the summary, orders messages with the same timestamp', null=True),
+        ),
+        migrations.RunPython(delete_duplicate_summaries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('user_profile', 'document'), name='conversation_summary_unique'),
+        ),
+    ]
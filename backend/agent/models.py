@@ -22,6 +22,33 @@ class AgentMessage(models.Model):
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # conversation history lookups for a user on a document
+            models.Index(fields=['user_profile', 'document', 'timestamp'], name='agent_msg_history_idx'),
+        ]
     
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
+
+
+class ConversationSummary(models.Model):
+    """
+    Rolling summary of the agent messages that fell out of
+    the conversation history window for a user on a document.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user_profile = models.ForeignKey('users.UserProfile', on_delete=models.CASCADE, related_name='conversation_summaries')
+    document = models.ForeignKey('documents.Document', on_delete=models.CASCADE, related_name='conversation_summaries')
+    content = models.TextField()
+    summarized_until = models.DateTimeField(help_text="Timestamp of the latest message included in the summary")
+    summarized_until_id = models.UUIDField(null=True, blank=True, help_text="Id of the latest message included in the summary, orders messages with the same timestamp")
+    message_count = models.IntegerField(default=0, help_text="Number of messages included in the summary")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_profile', 'document'], name='conversation_summary_unique'),
+        ]
+
+    def __str__(self):
+        return f"Summary of {self.message_count} messages: {self.content[:50]}..."
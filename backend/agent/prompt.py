@@ -0,0 +1,139 @@
+"""
+Prompt assembly for the agent.
+
+Providers cache the longest previously seen prefix of a prompt, so messages
+are ordered from most to least stable:
+
+    1. system prompt (identical for every request)
+    2. document (changes only when the document is edited)
+    3. summary of older messages (changes every few turns)
+    4. conversation history (grows by appending)
+    5. active mark ids (can change on every request)
+"""
+
+from typing import Any, Dict, List, Optional
+
+
+MODEL = 'gpt-5-mini'
+
+# It is very important to not give legal advice and if the user asks for it, you should say something like:
+# I am not a lawyer and cannot give legal advice.
+
+# If the user asks a question about a certain topic, you can direct them to reach out to a specialist.  For example, if they ask about the tax implications of a certain action, you can say:
+# I am not a tax specialist and cannot give tax advice.  You should reach out to a tax specialist for more information.
+
+# Here is another example of a disclaimer you can use to respond to a finance question:
+# This is not professional financial advice. Consulting a financial advisor about your particular circumstances is best.
+
+# If you do answer a question, you should try to share the source of your information.
+SYSTEM_PROMPT = """
+You are helping multiple parties negotiate an agreement.
+
+You will be given a full document and, optionally, a list of active mark ids to know which text is relevant.
+
+In the document, each text node is prefixed with its key in brackets, i.e. [45]. Offsets are counted from the first character after the key.
+Text covered by comment marks is wrapped in ⟦mark:<ids>⟧ and ⟦/mark⟧, where <ids> are the comma separated mark ids. These markers are not part of the text and do not count towards offsets.
+
+If you propose changes to the document (a change is defined as a deletion AND an addition), indicate the changes at the end of your response with '[[CHANGES]]: {changes_json_array} where changes_json_array is a JSON array with the following example format (don't include whitespace or new lines):
+
+[
+    {
+        "type": "deletion",
+        "start_key": "45",
+        "start_offset": 0,
+        "end_key": "45",
+        "end_offset": 8, // i.e. length of text in node to erase the whole node
+    },
+    {
+        "type": "addition",
+        "key": "45",
+        "offset": 0,
+        "text": "abc"
+    },
+]
+
+type: str (ONLY EITHER 'addition' OR 'deletion' are valid values)
+offset: int
+key, start_key, end_key: str
+
+If you are adding new text and the user did not designate a location, use your discretion to find the best location.
+
+If you propose changes, also include a justification section after your message with '[[JUSTIFICATION]]: <text>' where <text> is a brief message written in the user's voice, as if the user themselves is explaining the rationale behind the proposed change to the other parties on the document. It should read naturally as something the user would share with collaborators to justify the edit (this will be shown to all users in a comment thread).
+
+Response order when proposing changes:
+1. Your main message to the user
+2. [[JUSTIFICATION]]: <plain text explanation>
+3. [[CHANGES]]: <json array>
+"""
+
+SUMMARY_PROMPT = """
+You are summarizing a conversation between a user and an assistant helping multiple parties negotiate an agreement.
+
+Update the existing summary (if any) with the new messages. Keep the user's goals, positions, open questions and any changes that were proposed, accepted or rejected. Write at most 200 words of plain text.
+"""
+
+# Respond in two parts:
+# 1. A message to the user with `[[MESSAGE_END]]` at the end.
+# 2. Document content (formatted in standard Markdown) with `[[FINAL_END]]` at the end.
+
+
+def build_messages(
+    conversation_history: List[Dict[str, str]],
+    document_text: Optional[str] = None,
+    active_mark_ids: Optional[Any] = None,
+    summary: Optional[str] = None
+) -> List[Dict[str, str]]:
+    """
+    Returns the messages for the chat completions API in cache-friendly order.
+
+    conversation_history: [{'role': 'user' | 'assistant', 'content': str}, ...] ending with the current user message
+    """
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT}]
+
+    if document_text:
+        messages.append({
+            'role': 'user',
+            'content': f'FULL DOCUMENT (for reference only):\n"""\n{document_text}\n"""'
+        })
+
+    if summary:
+        messages.append({
+            'role': 'user',
+            'content': f'SUMMARY OF EARLIER CONVERSATION:\n"""\n{summary}\n"""'
+        })
+
+    messages.extend(conversation_history)
+
+    if active_mark_ids:
+        messages.append({
+            'role': 'user',
+            'content': f'ACTIVE MARK IDS:\n"""\n{active_mark_ids}\n"""'
+        })
+
+    return messages
+
+
+def build_summary_messages(conversation_history: List[Dict[str, str]], summary: Optional[str] = None) -> List[Dict[str, str]]:
+    """Returns the messages that fold conversation_history into the existing summary."""
+    transcript = '\n\n'.join(f"{message['role'].upper()}: {message['content']}" for message in conversation_history)
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT},
+        {'role': 'user', 'content': f'EXISTING SUMMARY:\n"""\n{summary or ""}\n"""\n\nNEW MESSAGES:\n"""\n{transcript}\n"""'}
+    ]
+
+
+def get_prompt_cache_key(document_id: Optional[str]) -> Optional[str]:
+    """Routes requests for the same document to the same provider cache."""
+    return f'document-{document_id}' if document_id else None
+
+
+def get_usage_metadata(usage: Any) -> Dict[str, int]:
+    """Returns the token counts of an OpenAI usage object for AgentMessage.metadata."""
+    if not usage:
+        return {}
+    prompt_tokens_details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'cached_tokens': getattr(prompt_tokens_details, 'cached_tokens', None) or 0,
+        'completion_tokens': usage.completion_tokens
+    }
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from django.conf import settings
+
+
+class StreamBatcher:
+    """
+    Coalesces streamed message text into fewer websocket frames.
+
+    Flush policies:
+        TIME: flush when the oldest pending text has waited `interval` seconds
+        SIZE: flush when `max_chars` characters are pending
+        SENTENCE: flush at the end of a sentence or line
+
+    Every policy also flushes once `max_chars` characters are pending so
+    that a frame never grows unbounded.
+
+    The frame envelope is serialized once per stream and only the
+    pending text is encoded on each flush.  Flushes are serialized, so
+    frames are sent in order even when a timer flush overlaps another.
+    """
+    TIME = 'time'
+    SIZE = 'size'
+    SENTENCE = 'sentence'
+    POLICIES = (TIME, SIZE, SENTENCE)
+
+    SENTENCE_ENDINGS = ('.', '!', '?', ':', ';', '\n')
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[Any]],
+        envelope: Dict[str, Any],
+        policy: Optional[str] = None,
+        interval: Optional[float] = None,
+        max_chars: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        send: coroutine function called with each serialized frame
+        envelope: fields sent with every frame, the text is added under "message"
+        """
+        self.send = send
+        self.policy = policy or settings.AGENT_STREAM_FLUSH_POLICY
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"Unknown flush policy: {self.policy}")
+        self.interval = interval if interval is not None else settings.AGENT_STREAM_FLUSH_INTERVAL
+        self.max_chars = max_chars if max_chars is not None else settings.AGENT_STREAM_FLUSH_MAX_CHARS
+        self.clock = clock
+
+        # i.e. '{"sender": "PAIRDRAFT", "streaming": true, "message": ' + <text> + '}'
+        self._frame_prefix = json.dumps(envelope)[:-1] + (', ' if envelope else '') + '"message": '
+
+        self._parts: List[str] = []
+        self._size = 0
+        self._pending_since: Optional[float] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+
+        self.frame_count = 0
+
+    def frame(self, text: str) -> str:
+        return self._frame_prefix + json.dumps(text) + '}'
+
+    async def add(self, text: str):
+        """Adds text to the pending frame and sends it if the policy says it is due."""
+        if not text:
+            return
+        if not self._parts:
+            self._pending_since = self.clock()
+        self._parts.append(text)
+        self._size += len(text)
+
+        if self._is_due(text):
+            await self.flush()
+        elif self.policy == self.TIME:
+            self._schedule_flush()
+
+    async def flush(self):
+        """Sends all pending text as a single frame."""
+        self._cancel_timer()
+        async with self._lock:
+            if not self._parts:
+                return
+            text = ''.join(self._parts)
+            self._parts = []
+            self._size = 0
+            self._pending_since = None
+
+            self.frame_count += 1
+            await self.send(self.frame(text))
+
+    async def close(self):
+        """Sends whatever is pending once the stream has ended, call it even if the stream failed."""
+        self._cancel_timer()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks)
+        await self.flush()
+
+    def _is_due(self, text: str) -> bool:
+        if self._size >= self.max_chars:
+            return True
+        if self.policy == self.TIME:
+            return self.clock() - self._pending_since >= self.interval
+        if self.policy == self.SENTENCE:
+            return text.rstrip(' ').endswith(self.SENTENCE_ENDINGS)
+        return False
+
+    def _schedule_flush(self):
+        """Makes sure pending text is sent even if the model pauses between tokens."""
+        if self._timer:
+            return
+        delay = max(0, self.interval - (self.clock() - self._pending_since))
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
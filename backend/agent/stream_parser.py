@@ -0,0 +1,177 @@
+import json
+import logging
+logger = logging.getLogger('django')
+from typing import Any, List, Optional, Tuple
+
+
+class AgentStreamParser:
+    """
+    Incrementally splits a streamed agent reply into its sections.
+
+    The agent responds in the order:
+        1. message to the user
+        2. [[JUSTIFICATION]]: <plain text>     (optional)
+        3. [[CHANGES]]: <json array>           (optional)
+
+    Each call to feed() only looks at the new text plus a lookback
+    shorter than the longest delimiter, so the cost per token stays
+    constant regardless of how long the reply gets.  The changes array
+    is scanned as it arrives and parsed once, as soon as it closes.
+    """
+    MESSAGE = 'message'
+    JUSTIFICATION = 'justification'
+    CHANGES = 'changes'
+
+    JUSTIFICATION_DELIMITER = '[[JUSTIFICATION]]:'
+    CHANGES_DELIMITER = '[[CHANGES]]:'
+
+    # delimiters that end each section
+    STATE_DELIMITERS = {
+        MESSAGE: (JUSTIFICATION_DELIMITER, CHANGES_DELIMITER),
+        JUSTIFICATION: (CHANGES_DELIMITER,),
+    }
+    DELIMITER_TO_STATE = {
+        JUSTIFICATION_DELIMITER: JUSTIFICATION,
+        CHANGES_DELIMITER: CHANGES,
+    }
+
+    def __init__(self):
+        self.state = self.MESSAGE
+        self.changes: Optional[List[Any]] = None # parsed changes once the array closes
+
+        self._pending = '' # tail held back because it could be the start of a delimiter
+        self._message_parts: List[str] = []
+        self._justification_parts: List[str] = []
+        self._changes_parts: List[str] = []
+
+        # changes array scanning state
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._changes_closed = False
+
+    @property
+    def message(self) -> str:
+        return ''.join(self._message_parts)
+
+    @property
+    def justification(self) -> str:
+        return ''.join(self._justification_parts).strip()
+
+    @property
+    def changes_text(self) -> str:
+        """Returns the raw text following the changes delimiter."""
+        return ''.join(self._changes_parts).strip()
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """
+        Consumes a chunk of the reply and returns the events it completes
+        as (event type, data) tuples, i.e. (MESSAGE, 'text to stream').
+        """
+        events = []
+        window = self._pending + text
+        self._pending = ''
+
+        while window:
+            if self.state == self.CHANGES:
+                self._feed_changes(window, events)
+                break
+
+            delimiters = self.STATE_DELIMITERS[self.state]
+            index, delimiter = self._find_delimiter(window, delimiters)
+
+            if delimiter is None:
+                # hold back only what could still turn into a delimiter
+                held = self._partial_delimiter_length(window, delimiters)
+                self._emit(window[:len(window) - held], events)
+                self._pending = window[len(window) - held:]
+                break
+
+            self._emit(window[:index], events)
+            self.state = self.DELIMITER_TO_STATE[delimiter]
+            window = window[index + len(delimiter):]
+
+        return events
+
+    def close(self) -> List[Tuple[str, Any]]:
+        """Flushes any held back text once the stream has ended."""
+        events = []
+        if self._pending:
+            self._emit(self._pending, events)
+            self._pending = ''
+
+        # the array never closed (i.e. truncated reply), try what we have
+        if self.state == self.CHANGES and self.changes is None and not self._changes_closed:
+            self._parse_changes(self.changes_text, events)
+
+        return events
+
+    def _emit(self, text: str, events: List[Tuple[str, Any]]):
+        if not text:
+            return
+        if self.state == self.MESSAGE:
+            self._message_parts.append(text)
+        elif self.state == self.JUSTIFICATION:
+            self._justification_parts.append(text)
+        events.append((self.state, text))
+
+    def _feed_changes(self, text: str, events: List[Tuple[str, Any]]):
+        self._changes_parts.append(text)
+        if self._changes_closed:
+            return
+
+        for index, char in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '[{':
+                self._depth += 1
+            elif char in ']}' and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._changes_closed = True
+                    changes_text = ''.join(self._changes_parts)
+                    trailing = len(text) - index - 1
+                    self._parse_changes(changes_text[:len(changes_text) - trailing], events)
+                    return
+
+    def _parse_changes(self, changes_text: str, events: List[Tuple[str, Any]]):
+        changes_text = changes_text.strip()
+        if not changes_text:
+            return
+        try:
+            changes = json.loads(changes_text)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Could not parse agent changes: {e}")
+            return
+        if not isinstance(changes, list):
+            logger.warning(f"Agent changes are not a list: {changes_text[:50]}")
+            return
+        self.changes = changes
+        events.append((self.CHANGES, changes))
+
+    @staticmethod
+    def _find_delimiter(window: str, delimiters: Tuple[str, ...]) -> Tuple[int, Optional[str]]:
+        """Returns the index and value of the earliest delimiter in the window."""
+        found_index, found_delimiter = -1, None
+        for delimiter in delimiters:
+            index = window.find(delimiter)
+            if index != -1 and (found_delimiter is None or index < found_index):
+                found_index, found_delimiter = index, delimiter
+        return found_index, found_delimiter
+
+    @staticmethod
+    def _partial_delimiter_length(window: str, delimiters: Tuple[str, ...]) -> int:
+        """Returns the length of the longest window suffix that is a delimiter prefix."""
+        longest = max(len(delimiter) for delimiter in delimiters) - 1
+        for length in range(min(longest, len(window)), 0, -1):
+            suffix = window[-length:]
+            if any(delimiter.startswith(suffix) for delimiter in delimiters):
+                return length
+        return 0
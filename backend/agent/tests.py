@@ -1,3 +1,475 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from agent.stream_parser import AgentStreamParser
+from agent.stream_batcher import StreamBatcher
+from agent.document_text import flatten_lexical, get_document_text
+from agent import prompt as agent_prompt
+from agent import history
+from agent import limiter
+from agent.models import AgentMessage, ConversationSummary
+from documents.models import Document
+from users import util as users_util
+
+
+def feed_all(parser: AgentStreamParser, chunks):
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+
+class AgentStreamParserTest(SimpleTestCase):
+    def test_message_only(self):
+        parser = AgentStreamParser()
+        events = feed_all(parser, ['Hello ', 'there', '!'])
+
+        self.assertEqual(''.join(value for _, value in events), 'Hello there!')
+        self.assertEqual(parser.message, 'Hello there!')
+        self.assertEqual(parser.justification, '')
+        self.assertIsNone(parser.changes)
+
+    def test_sections_split_across_chunks(self):
+        """Delimiters split across chunk boundaries are still detected."""
+        parser = AgentStreamParser()
+        events = feed_all(parser, [
+            'Try this.', '[[JUST', 'IFICATION]]: ', 'It is clearer.', '[[CHA', 'NGES]]: [{"type": "add', 'ition", "key": "4", "offset": 0, "text": "]"}]'
+        ])
+
+        message = ''.join(value for event, value in events if event == AgentStreamParser.MESSAGE)
+        self.assertEqual(message, 'Try this.')
+        self.assertEqual(parser.justification, 'It is clearer.')
+        self.assertEqual(parser.changes, [{'type': 'addition', 'key': '4', 'offset': 0, 'text': ']'}])
+        self.assertEqual(events[-1], (AgentStreamParser.CHANGES, parser.changes))
+
+    def test_changes_without_justification(self):
+        parser = AgentStreamParser()
+        feed_all(parser, ['Done.[[CHANGES]]: []'])
+
+        self.assertEqual(parser.message, 'Done.')
+        self.assertEqual(parser.changes, [])
+        self.assertEqual(parser.changes_text, '[]')
+
+    def test_changes_parsed_as_soon_as_array_closes(self):
+        parser = AgentStreamParser()
+        parser.feed('Ok [[CHANGES]]: [{"type": "deletion",')
+        self.assertIsNone(parser.changes)
+
+        events = parser.feed(' "start_key": "1"}] trailing')
+        self.assertEqual(events, [(AgentStreamParser.CHANGES, [{'type': 'deletion', 'start_key': '1'}])])
+
+    def test_holds_back_only_possible_delimiter_prefix(self):
+        parser = AgentStreamParser()
+
+        self.assertEqual(parser.feed('Price is $500 [['), [(AgentStreamParser.MESSAGE, 'Price is $500 ')])
+        self.assertEqual(parser.feed('x'), [(AgentStreamParser.MESSAGE, '[[x')])
+
+    def test_invalid_changes_are_not_parsed(self):
+        parser = AgentStreamParser()
+        feed_all(parser, ['Hi[[CHANGES]]: [{"type": "addition",}]'])
+
+        self.assertIsNone(parser.changes)
+        self.assertEqual(parser.changes_text, '[{"type": "addition",}]')
+
+    def test_lookback_is_bounded(self):
+        """The held back tail never grows with the length of the reply."""
+        parser = AgentStreamParser()
+        longest = max(len(AgentStreamParser.JUSTIFICATION_DELIMITER), len(AgentStreamParser.CHANGES_DELIMITER))
+        for _ in range(1000):
+            parser.feed('word [')
+            self.assertLess(len(parser._pending), longest)
+
+
+class StreamBatcherTest(SimpleTestCase):
+    def create_batcher(self, **kwargs):
+        self.frames = []
+
+        async def send(frame):
+            self.frames.append(json.loads(frame))
+
+        return StreamBatcher(send=send, envelope={'sender': 'PAIRDRAFT', 'streaming': True, 'thread_id': None}, **kwargs)
+
+    async def test_frame_splices_text_into_envelope(self):
+        batcher = self.create_batcher(policy=StreamBatcher.SIZE)
+        self.assertEqual(
+            json.loads(batcher.frame('say "hi"')),
+            {'sender': 'PAIRDRAFT', 'streaming': True, 'thread_id': None, 'message': 'say "hi"'}
+        )
+
+    async def test_size_policy(self):
+        batcher = self.create_batcher(policy=StreamBatcher.SIZE, max_chars=10)
+        for token in ['abc', 'def', 'ghij', 'k']:
+            await batcher.add(token)
+        await batcher.close()
+
+        self.assertEqual([frame['message'] for frame in self.frames], ['abcdefghij', 'k'])
+        self.assertEqual(batcher.frame_count, 2)
+
+    async def test_sentence_policy(self):
+        batcher = self.create_batcher(policy=StreamBatcher.SENTENCE, max_chars=1000)
+        for token in ['Hello', ' there.', ' How', ' are', ' you?', ' Bye']:
+            await batcher.add(token)
+        await batcher.close()
+
+        self.assertEqual([frame['message'] for frame in self.frames], ['Hello there.', ' How are you?', ' Bye'])
+
+    async def test_time_policy_flushes_on_interval(self):
+        now = [0.0]
+        batcher = self.create_batcher(policy=StreamBatcher.TIME, interval=0.03, max_chars=1000, clock=lambda: now[0])
+        for token in ['a', 'b', 'c']:
+            await batcher.add(token)
+            now[0] += 0.01
+        await batcher.add('d') # 0.03s after the first pending token
+        await batcher.close()
+
+        self.assertEqual([frame['message'] for frame in self.frames], ['abcd'])
+
+    async def test_time_policy_flushes_when_stream_pauses(self):
+        batcher = self.create_batcher(policy=StreamBatcher.TIME, interval=0.01, max_chars=1000)
+        await batcher.add('waiting')
+        await asyncio.sleep(0.05)
+
+        self.assertEqual([frame['message'] for frame in self.frames], ['waiting'])
+        await batcher.close()
+        self.assertEqual(len(self.frames), 1)
+
+    async def test_overlapping_flushes_send_in_order(self):
+        frames = []
+
+        async def send(frame):
+            message = json.loads(frame)['message']
+            if message == 'slow':
+                await asyncio.sleep(0.05)
+            frames.append(message)
+
+        batcher = StreamBatcher(send=send, envelope={}, policy=StreamBatcher.TIME, interval=0.01, max_chars=5)
+        await batcher.add('slow')
+        await asyncio.sleep(0.02) # the timer flush is still sending
+        await batcher.add('quick')
+        await batcher.close()
+
+        self.assertEqual(frames, ['slow', 'quick'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.create_batcher(policy='words')
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+EDITOR_STATE = {
+    'root': {
+        'type': 'root',
+        'children': [
+            {'type': 'heading', 'children': [{'type': 'text-with-key', 'text': 'Purchase Agreement', '__key': '3'}]},
+            {'type': 'paragraph', 'children': [
+                {'type': 'text-with-key', 'text': 'Price: ', '__key': '5'},
+                {'type': 'mark', 'ids': ['a'], 'children': [{'type': 'text-with-key', 'text': '$500,000', '__key': '6'}]},
+                {'type': 'linebreak'},
+                {'type': 'text', 'text': 'Close in 30 days'}
+            ]},
+            {'type': 'list', 'children': [
+                {'type': 'listitem', 'children': [{'type': 'text-with-key', 'text': 'Inspection', '__key': '9'}]}
+            ]}
+        ]
+    }
+}
+
+
+class FlattenLexicalTest(SimpleTestCase):
+    def test_flattens_blocks_and_keeps_keys(self):
+        self.assertEqual(
+            flatten_lexical(json.dumps(EDITOR_STATE)),
+            '[3]Purchase Agreement\n[5]Price: ⟦mark:a⟧[6]$500,000⟦/mark⟧\nClose in 30 days\n[9]Inspection'
+        )
+
+    def test_marks_keep_their_ids(self):
+        editor_state = {'root': {'type': 'root', 'children': [
+            {'type': 'paragraph', 'children': [
+                {'type': 'text-with-key', 'text': 'The buyer ', '__key': '2'},
+                {'type': 'mark', 'ids': ['thread-1', 'thread-2'], 'children': [
+                    {'type': 'text-with-key', 'text': 'may terminate', '__key': '3'},
+                    {'type': 'mark', 'ids': ['thread-3'], 'children': [{'type': 'text-with-key', 'text': ' early', '__key': '4'}]}
+                ]},
+                {'type': 'text-with-key', 'text': '.', '__key': '5'}
+            ]}
+        ]}}
+
+        self.assertEqual(
+            flatten_lexical(editor_state),
+            '[2]The buyer ⟦mark:thread-1,thread-2⟧[3]may terminate⟦mark:thread-3⟧[4] early⟦/mark⟧⟦/mark⟧[5].'
+        )
+
+    def test_plain_text_is_unchanged(self):
+        self.assertEqual(flatten_lexical('not json'), 'not json')
+
+
+@patch('agent.document_text.redis_manager')
+class GetDocumentTextTest(TestCase):
+    def test_caches_flattened_text_by_version(self, redis_manager_mock):
+        redis_manager_mock.r = FakeRedis()
+        text = get_document_text('doc', version='v1', editor_state=json.dumps(EDITOR_STATE))
+
+        self.assertEqual(get_document_text('doc', version='v1'), text)
+        self.assertIsNone(get_document_text('doc', version='v2'))
+        self.assertIsNone(get_document_text('other-doc', version='v1'))
+
+    def test_collaborators_on_different_versions_keep_their_snapshots(self, redis_manager_mock):
+        redis_manager_mock.r = FakeRedis()
+        get_document_text('doc', version='v1', editor_state='first')
+        get_document_text('doc', version='v2', editor_state='second')
+
+        self.assertEqual(get_document_text('doc', version='v1'), 'first')
+        self.assertEqual(get_document_text('doc', version='v2'), 'second')
+
+    def test_yjs_update_invalidates_snapshot(self, redis_manager_mock):
+        redis_manager_mock.r = FakeRedis()
+        with patch('agent.document_text.yjs.get_latest_update_id', return_value=10):
+            get_document_text('doc', version='v1', editor_state=json.dumps(EDITOR_STATE))
+            self.assertIsNotNone(get_document_text('doc', version='v1'))
+
+        with patch('agent.document_text.yjs.get_latest_update_id', return_value=11):
+            self.assertIsNone(get_document_text('doc', version='v1'))
+        self.assertEqual(redis_manager_mock.r.data, {})
+
+    def test_editor_state_without_version_is_not_cached(self, redis_manager_mock):
+        redis_manager_mock.r = FakeRedis()
+        self.assertEqual(get_document_text('doc', editor_state='plain'), 'plain')
+        self.assertEqual(redis_manager_mock.r.data, {})
+
+
+class BuildMessagesTest(SimpleTestCase):
+    def test_stable_content_comes_first(self):
+        history = [
+            {'role': 'user', 'content': 'Hi'},
+            {'role': 'assistant', 'content': 'Hello'},
+            {'role': 'user', 'content': 'Lower the price'}
+        ]
+        messages = agent_prompt.build_messages(history, document_text='[1]Price: $1', active_mark_ids=['m1'])
+
+        self.assertEqual(messages[0], {'role': 'system', 'content': agent_prompt.SYSTEM_PROMPT})
+        self.assertIn('[1]Price: $1', messages[1]['content'])
+        self.assertEqual(messages[2:5], history)
+        self.assertIn('m1', messages[5]['content'])
+
+    def test_system_prompt_does_not_depend_on_request(self):
+        with_marks = agent_prompt.build_messages([], document_text='doc', active_mark_ids=['m1'])
+        without_marks = agent_prompt.build_messages([], document_text='doc')
+        self.assertEqual(with_marks[:2], without_marks[:2])
+
+    def test_summary_comes_before_history(self):
+        history = [{'role': 'user', 'content': 'Lower the price'}]
+        messages = agent_prompt.build_messages(history, document_text='doc', summary='Buyer wants $450k')
+
+        self.assertIn('doc', messages[1]['content'])
+        self.assertIn('Buyer wants $450k', messages[2]['content'])
+        self.assertEqual(messages[3:], history)
+
+
+@override_settings(AGENT_HISTORY_MESSAGES=4, AGENT_SUMMARY_BATCH_MESSAGES=3)
+class HistoryTest(TransactionTestCase):
+    def setUp(self):
+        _, self.user_profile = users_util.create_user('buyer@pairdraft.com')
+        self.document = Document.objects.create(title='Offer')
+        self.start = timezone.now()
+
+    def create_messages(self, count):
+        offset = AgentMessage.objects.count()
+        for i in range(offset, offset + count):
+            message = AgentMessage.objects.create(
+                user_profile=self.user_profile,
+                document=self.document,
+                role=AgentMessage.USER if i % 2 == 0 else AgentMessage.AGENT,
+                content=f'message {i}'
+            )
+            AgentMessage.objects.filter(id=message.id).update(timestamp=self.start + timedelta(seconds=i))
+
+    def create_llm(self, content):
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        ))
+        return llm
+
+    def test_load_history_returns_unsummarized_messages_in_one_query(self):
+        self.create_messages(10)
+        ConversationSummary.objects.create(
+            user_profile=self.user_profile,
+            document=self.document,
+            content='Summary',
+            summarized_until=self.start + timedelta(seconds=5),
+            message_count=6
+        )
+
+        with self.assertNumQueries(2): # summary and messages
+            summary, messages = history.load_history(self.user_profile.id, self.document.id)
+
+        self.assertEqual(summary, 'Summary')
+        self.assertEqual(messages, [
+            {'role': 'user', 'content': 'message 6'},
+            {'role': 'assistant', 'content': 'message 7'},
+            {'role': 'user', 'content': 'message 8'},
+            {'role': 'assistant', 'content': 'message 9'}
+        ])
+
+    def test_messages_waiting_for_the_summary_are_sent_verbatim(self):
+        self.create_messages(6) # 2 messages outside the window, fewer than a batch
+
+        summary, messages = history.load_history(self.user_profile.id, self.document.id)
+
+        self.assertIsNone(summary)
+        self.assertEqual([message['content'] for message in messages], [f'message {i}' for i in range(6)])
+
+    def test_window(self):
+        conversation = [{'role': 'user', 'content': str(i)} for i in range(6)]
+        self.assertEqual(history.window(conversation), conversation[-4:])
+
+    def test_summary_waits_for_a_batch(self):
+        self.create_messages(6) # 2 messages outside the window
+        llm = self.create_llm('Summary')
+
+        self.assertIsNone(async_to_sync(history.update_summary)(llm, self.user_profile.id, self.document.id))
+        llm.chat.completions.create.assert_not_called()
+
+    def test_summary_rolls_forward(self):
+        self.create_messages(7) # 3 messages outside the window
+        async_to_sync(history.update_summary)(self.create_llm('First'), self.user_profile.id, self.document.id)
+
+        summary = ConversationSummary.objects.get(user_profile=self.user_profile, document=self.document)
+        self.assertEqual(summary.content, 'First')
+        self.assertEqual(summary.message_count, 3)
+
+        # the next 3 messages are folded into the existing summary
+        self.create_messages(3)
+        llm = self.create_llm('Second')
+        async_to_sync(history.update_summary)(llm, self.user_profile.id, self.document.id)
+
+        summary.refresh_from_db()
+        self.assertEqual(summary.content, 'Second')
+        self.assertEqual(summary.message_count, 6)
+        _, kwargs = llm.chat.completions.create.call_args
+        self.assertIn('First', kwargs['messages'][1]['content'])
+        summary, messages = history.load_history(self.user_profile.id, self.document.id)
+        self.assertEqual(summary, 'Second')
+        self.assertEqual([message['content'] for message in messages], [f'message {i}' for i in range(6, 10)])
+
+    def test_messages_with_the_same_timestamp_as_the_summary_are_kept(self):
+        self.create_messages(7)
+        # i.e. the two messages of a turn saved by one insert
+        AgentMessage.objects.update(timestamp=self.start)
+        async_to_sync(history.update_summary)(self.create_llm('First'), self.user_profile.id, self.document.id)
+
+        self.assertEqual(ConversationSummary.objects.get().message_count, 3)
+        _, messages = history.load_history(self.user_profile.id, self.document.id)
+        self.assertEqual(len(messages), 4)
+        ordered = list(AgentMessage.objects.order_by('timestamp', 'id').values_list('content', flat=True))
+        self.assertEqual([message['content'] for message in messages], ordered[3:])
+
+    def test_one_summary_per_conversation(self):
+        self.create_messages(7)
+        summary, messages = history.get_unsummarized_messages(self.user_profile.id, self.document.id)
+        # two processes summarize the same messages
+        history.save_summary(summary, self.user_profile.id, self.document.id, 'First', messages)
+        history.save_summary(summary, self.user_profile.id, self.document.id, 'Second', messages)
+
+        summary = ConversationSummary.objects.get()
+        self.assertEqual((summary.content, summary.message_count), ('Second', 3))
+
+    def test_failed_summary_is_not_saved(self):
+        self.create_messages(7)
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(side_effect=Exception('timeout'))
+
+        self.assertIsNone(async_to_sync(history.update_summary)(llm, self.user_profile.id, self.document.id))
+        self.assertFalse(ConversationSummary.objects.exists())
+
+    def test_scheduled_summary_runs_in_the_background(self):
+        self.create_messages(7)
+        created = asyncio.Event()
+        async def create(**kwargs):
+            created.set()
+            await asyncio.sleep(0.05)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='Summary'))])
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(side_effect=create)
+
+        async def schedule():
+            task = history.schedule_summary_update(llm, self.user_profile.id, self.document.id)
+            self.assertFalse(task.done())
+            await created.wait()
+            # the running update is reused
+            self.assertIs(history.schedule_summary_update(llm, self.user_profile.id, self.document.id), task)
+            return await task
+        summary = async_to_sync(schedule)()
+
+        self.assertEqual(summary.content, 'Summary')
+        self.assertEqual(llm.chat.completions.create.call_count, 1)
+        self.assertEqual(history._summary_tasks, {})
+
+    def test_scheduled_summary_logs_errors(self):
+        async def schedule():
+            with patch('agent.history.update_summary', AsyncMock(side_effect=RuntimeError('database is gone'))):
+                task = history.schedule_summary_update(MagicMock(), self.user_profile.id, self.document.id)
+                await asyncio.wait([task])
+                await asyncio.sleep(0) # done callbacks run on the next iteration
+
+        with self.assertLogs('django', level='ERROR') as logs:
+            async_to_sync(schedule)()
+        self.assertIn('database is gone', logs.output[0])
+        self.assertEqual(history._summary_tasks, {})
+
+
+@override_settings(AGENT_QUEUE_POLL_INTERVAL=0, AGENT_QUEUE_TIMEOUT=60)
+class AgentSlotTest(SimpleTestCase):
+    def create_slot(self, results):
+        self.positions = []
+
+        async def on_queued(position):
+            self.positions.append(position)
+
+        slot = limiter.AgentSlot('user', 'doc', on_queued=on_queued)
+        slot.try_acquire = MagicMock(side_effect=results)
+        slot.release = MagicMock()
+        return slot
+
+    async def test_waits_in_queue_until_admitted(self):
+        slot = self.create_slot([limiter.WAITING_FOR_USER, 2, 2, 0, limiter.ADMITTED])
+        async with slot:
+            slot.release.assert_not_called()
+
+        self.assertEqual(self.positions, [None, 3, 1])
+        slot.release.assert_called_once()
+
+    @override_settings(AGENT_QUEUE_TIMEOUT=0)
+    async def test_gives_up_after_timeout(self):
+        slot = self.create_slot([5])
+        with self.assertRaises(limiter.AgentLimitExceeded):
+            async with slot:
+                pass
+        slot.release.assert_called_once() # leaves the queue
+
+    async def test_admits_when_redis_is_unavailable(self):
+        slot = self.create_slot(ConnectionError('redis'))
+        async with slot:
+            pass
+        slot.release.assert_called_once()
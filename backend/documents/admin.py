@@ -1,6 +1,10 @@
 from django.contrib import admin
 
-from documents.models import Document, Action
+from documents.models import Document, DocumentBlob, PdfExport, OrphanedObject, Action, Chain
 
 admin.site.register(Document)
+admin.site.register(DocumentBlob)
 admin.site.register(Action)
+admin.site.register(Chain)
+admin.site.register(PdfExport)
+admin.site.register(OrphanedObject)
@@ -1,68 +1,160 @@
 # Check usage: https://acrobatservices.adobe.com/dc-integration-creation-app-cdn/main.html?
 
 import os
+import time
+import logging
+logger = logging.getLogger('django')
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from pairdraft.redis_manager import redis_manager
+
 
+class AdobeJobFailed(Exception):
+    """Raised when a PDF Services job failed or did not finish in time."""
 
-def get_access_token():
-    # TODO: handle token expiration, figuring out if we should store it, etc.
-    # because right now we're generating a new token every time this function is called
-    # which is wasteful
-    response = requests.post(
-        "https://pdf-services.adobe.io/token",
-        data={
-            "client_id": os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_ID'),
-            "client_secret": os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_SECRET')
-        }
-    )
-    data = response.json()
-    
-    return data.get('access_token', None) # { "access_token", "token_type", "expires_in" }
-
-
-# TODO: make this an async request if we need to poll for the result
-def html_to_pdf(input_uri: str, output_uri: str) -> str | None:
+
+class AdobePDFClient(object):
     """
-    Kicks off a job to convert an HTML document to a PDF.
-    Returns the job id.
+    Client for Adobe PDF Services.
 
-    https://developer.adobe.com/document-services/docs/apis/#tag/Html-to-PDF/operation/pdfoperations.htmltopdf
+    Requests go through one pooled session, so an export reuses its connection,
+    and the access token is cached in Redis until shortly before it expires,
+    so it is shared by all processes instead of being fetched for every request.
     """
-    token = get_access_token()
-    response = requests.post(
-        "https://pdf-services.adobe.io/operation/htmltopdf",
-        json={
-            "input": {
-                "uri": input_uri,
-                "storage": "S3"
-            },
-            "output": {
-                "uri": output_uri,
-                "storage": "S3"
-            },
-            "params": {
-                "pageLayout": {
-                    "pageWidth": 8.5,
-                    "pageHeight": 11
+    TOKEN_KEY = 'adobe_pdf_services_token'
+    TOKEN_EXPIRY_MARGIN = 60 # seconds before its expiry a token is no longer used
+
+    def __init__(self, base_url=None, client_id=None, client_secret=None):
+        self.base_url = base_url or os.environ.get('ADOBE_PDF_SERVICES_URL', 'https://pdf-services.adobe.io')
+        self.client_id = client_id or os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_ID')
+        self.client_secret = client_secret or os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_SECRET')
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
+        # the token of this process, in front of the one shared in Redis
+        self.token = None
+        self.token_expires_at = 0
+
+    def get_access_token(self) -> str | None:
+        """Returns a cached access token or fetches a new one."""
+        if self.token and time.time() < self.token_expires_at:
+            return self.token
+
+        try:
+            token, ttl = redis_manager.r.pipeline().get(self.TOKEN_KEY).ttl(self.TOKEN_KEY).execute()
+        except Exception as e:
+            logger.error(f"Could not read the Adobe token from Redis: {e}")
+            token, ttl = None, 0
+        if token and ttl > 0:
+            self.token, self.token_expires_at = token, time.time() + ttl
+            return token
+
+        return self.fetch_access_token()
+
+    def fetch_access_token(self) -> str | None:
+        response = self.session.post(
+            f"{self.base_url}/token",
+            data={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret
+            }
+        )
+        data = response.json() # { "access_token", "token_type", "expires_in" }
+        token = data.get('access_token', None)
+        if not token:
+            logger.error(f"Could not get an Adobe token: {data}")
+            return None
+
+        ttl = int(data.get('expires_in', 0)) - self.TOKEN_EXPIRY_MARGIN
+        if ttl > 0:
+            self.token, self.token_expires_at = token, time.time() + ttl
+            try:
+                redis_manager.r.set(self.TOKEN_KEY, token, ex=ttl)
+            except Exception as e:
+                logger.error(f"Could not store the Adobe token in Redis: {e}")
+        return token
+
+    def clear_access_token(self):
+        self.token, self.token_expires_at = None, 0
+        try:
+            redis_manager.r.delete(self.TOKEN_KEY)
+        except Exception as e:
+            logger.error(f"Could not delete the Adobe token from Redis: {e}")
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Sends an authenticated request, with a new token if the cached one was rejected."""
+        for attempt in range(2):
+            response = self.session.request(
+                method,
+                f"{self.base_url}{path}",
+                headers={
+                    "Authorization": f"Bearer {self.get_access_token()}",
+                    "x-api-key": self.client_id
+                },
+                **kwargs
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            # i.e. the token was revoked before it expired
+            self.clear_access_token()
+        return response
+
+    def html_to_pdf(self, input_uri: str, output_uri: str) -> str | None:
+        """
+        Kicks off a job to convert an HTML document to a PDF.
+        Returns the job id.
+
+        https://developer.adobe.com/document-services/docs/apis/#tag/Html-to-PDF/operation/pdfoperations.htmltopdf
+        """
+        response = self.request(
+            'POST',
+            "/operation/htmltopdf",
+            json={
+                "input": {
+                    "uri": input_uri,
+                    "storage": "S3"
+                },
+                "output": {
+                    "uri": output_uri,
+                    "storage": "S3"
+                },
+                "params": {
+                    "pageLayout": {
+                        "pageWidth": 8.5,
+                        "pageHeight": 11
+                    }
                 }
             }
-        },
-        headers={
-            "Authorization": f"Bearer {token}",
-            "x-api-key": os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_ID')
-        }
-    )
-    return response.headers.get('x-request-id')    
-
-
-def get_job_status(job_id: str):
-    token = get_access_token()
-    response = requests.get(
-        f"https://pdf-services.adobe.io/operation/htmltopdf/{job_id}/status",
-        headers={
-            "Authorization": f"Bearer {token}",
-            "x-api-key": os.environ.get('ADOBE_PDF_SERVICES_API_CLIENT_ID')
-        }
-    )
-    data = response.json()
-    return data.get('status', None)
+        )
+        return response.headers.get('x-request-id')
+
+    def get_job_status(self, job_id: str) -> str | None:
+        response = self.request('GET', f"/operation/htmltopdf/{job_id}/status")
+        data = response.json()
+        return data.get('status', None)
+
+    def wait_for_job(self, job_id: str, timeout: float, interval: float = 0.5, max_interval: float = 4) -> None:
+        """
+        Polls the status of a job with exponential backoff until it is done.
+        Raises AdobeJobFailed if it failed or did not finish within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job_status = self.get_job_status(job_id)
+            if job_status == 'done':
+                return
+            if job_status == 'failed':
+                raise AdobeJobFailed(f"Job {job_id} failed.")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AdobeJobFailed(f"Job {job_id} did not finish in {timeout} seconds.")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+
+adobe_client = AdobePDFClient()
@@ -0,0 +1,187 @@
+"""
+Audit of the documents bucket against the Document table.
+
+The bucket is listed once, with one list_objects_v2 pagination per first
+character of the keys running in parallel, into an index of key ->
+StoredObject.  The first characters are taken from a listing of the top
+level of the bucket (Delimiter='/').  For document keys, which start with the
+document id, these are the hexadecimal digits.  The index is joined with the
+ids and titles of all documents, so an audit takes about one request per 1000
+objects instead of a head_object per document and format.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from documents.models import Document, PdfExport
+from pairdraft.aws_manager import aws_manager, BUCKETS
+
+
+FORMATS = {
+    Document.JSON: 'json',
+    Document.HTML: 'html',
+    Document.PDF: 'pdf',
+}
+
+# documents
+OK = 'ok'
+MISSING = 'missing' # neither JSON nor HTML content
+NEEDS_MIGRATION = 'needs_migration' # HTML content only
+
+# objects
+ORPHANED = 'orphaned' # of a document or export that does not exist
+
+
+@dataclass
+class StoredObject:
+    key: str
+    size: int
+    etag: str
+    last_modified: datetime
+
+
+@dataclass
+class DocumentAudit:
+    id: str
+    title: str
+    status: str
+    formats: dict[str, StoredObject] = field(default_factory=dict) # by content type
+
+    def get_file_path(self, content_type: str) -> str:
+        return Document(id=self.id, title=self.title).get_file_path(content_type=content_type)
+
+
+@dataclass
+class Audit:
+    documents: list[DocumentAudit]
+    orphaned: list[StoredObject]
+
+    def get_documents(self, status: str) -> list[DocumentAudit]:
+        return [document for document in self.documents if document.status == status]
+
+
+def to_stored_object(obj: dict) -> StoredObject:
+    return StoredObject(
+        key=obj['Key'],
+        size=obj['Size'],
+        etag=obj.get('ETag', '').strip('"'),
+        last_modified=obj['LastModified']
+    )
+
+
+def list_prefix(bucket: str, prefix: str) -> dict[str, StoredObject]:
+    """Returns the objects under the prefix by key, streaming the pages of list_objects_v2."""
+    objects = {}
+    paginator = aws_manager.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = to_stored_object(obj)
+    return objects
+
+
+def list_top_level(bucket: str) -> tuple[list[str], dict[str, StoredObject]]:
+    """
+    Returns the first characters of the "directories" at the top level of the bucket,
+    and the objects at the top level, which are in no directory.
+    """
+    first_characters = set()
+    objects = {}
+    paginator = aws_manager.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            first_characters.add(common_prefix['Prefix'][0])
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = to_stored_object(obj)
+    return sorted(first_characters), objects
+
+
+def list_objects(bucket: str, prefixes: list[str] | None = None, workers: int = 8) -> dict[str, StoredObject]:
+    """Lists the prefixes, by default the whole bucket, in parallel and merges them."""
+    objects = {}
+    if prefixes is None:
+        prefixes, objects = list_top_level(bucket)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for prefix_objects in executor.map(lambda prefix: list_prefix(bucket, prefix), prefixes):
+            objects.update(prefix_objects)
+    return objects
+
+
+def get_status(formats: dict[str, StoredObject]) -> str:
+    if Document.JSON in formats:
+        return OK
+    if Document.HTML in formats:
+        return NEEDS_MIGRATION
+    return MISSING
+
+
+def audit_documents(documents=None, prefixes: list[str] | None = None, workers: int = 8) -> Audit:
+    """
+    Joins the objects of the documents bucket, under the prefixes, with the documents.
+    Objects that are neither a format of a document nor a finished export are orphaned,
+    they are only reported when all documents are audited.
+    """
+    objects = list_objects(BUCKETS.PAIRDRAFT_DOCUMENTS.value, prefixes=prefixes, workers=workers)
+
+    find_orphans = documents is None
+    if documents is None:
+        documents = Document.objects.all()
+
+    audits = []
+    expected_keys = set()
+    for id, title in documents.order_by('id').values_list('id', 'title'):
+        document = Document(id=id, title=title) # only to build the file paths
+        formats = {}
+        for content_type in FORMATS:
+            key = document.get_file_path(content_type=content_type)
+            expected_keys.add(key)
+            if key in objects:
+                formats[content_type] = objects[key]
+        audits.append(DocumentAudit(id=str(id), title=title, status=get_status(formats), formats=formats))
+
+    orphaned = []
+    if find_orphans:
+        export_hashes = PdfExport.objects.filter(status=PdfExport.DONE).values_list('content_hash', flat=True).distinct()
+        expected_keys.update(PdfExport(content_hash=content_hash).get_file_path() for content_hash in export_hashes)
+        orphaned = [obj for key, obj in sorted(objects.items()) if key not in expected_keys]
+
+    return Audit(documents=audits, orphaned=orphaned)
+
+
+def get_rows(audit: Audit) -> list[dict]:
+    """Returns a flat row per document and per orphaned object, i.e. for CSV."""
+    rows = []
+    for document in audit.documents:
+        row = {'kind': 'document', 'id': document.id, 'title': document.title, 'status': document.status, 'key': '', 'size': ''}
+        for content_type, extension in FORMATS.items():
+            row[extension] = content_type in document.formats
+        rows.append(row)
+    for obj in audit.orphaned:
+        rows.append({'kind': 'object', 'id': '', 'title': '', 'status': ORPHANED, 'key': obj.key, 'size': obj.size, **{extension: '' for extension in FORMATS.values()}})
+    return rows
+
+
+def serialize_audit(audit: Audit) -> dict:
+    """Returns the audit as JSON-serializable data."""
+    def serialize_object(obj: StoredObject) -> dict:
+        return {'key': obj.key, 'size': obj.size, 'etag': obj.etag, 'last_modified': obj.last_modified.isoformat()}
+
+    return {
+        'summary': {
+            'documents': len(audit.documents),
+            OK: len(audit.get_documents(OK)),
+            NEEDS_MIGRATION: len(audit.get_documents(NEEDS_MIGRATION)),
+            MISSING: len(audit.get_documents(MISSING)),
+            ORPHANED: len(audit.orphaned),
+        },
+        'documents': [
+            {
+                'id': document.id,
+                'title': document.title,
+                'status': document.status,
+                'formats': {FORMATS[content_type]: serialize_object(obj) for content_type, obj in document.formats.items()}
+            }
+            for document in audit.documents
+        ],
+        'orphaned': [serialize_object(obj) for obj in audit.orphaned],
+    }
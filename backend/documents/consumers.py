@@ -0,0 +1,46 @@
+import logging
+logger = logging.getLogger('django')
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from documents import exports
+
+
+class ExportConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Sends the result of a PDF export once it finished and closes.
+
+    The group is joined before the export is read,
+    so an export that finishes in between is not missed.
+    """
+
+    async def connect(self):
+        self.export_id = self.scope['url_route']['kwargs']['export_id']
+        self.group_name = exports.get_group_name(self.export_id)
+
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+        data = await database_sync_to_async(exports.get_export_data)(self.export_id, self.scope['user'])
+        if not data:
+            logger.error(f"User {self.scope['user']} does not have access to PDF export {self.export_id}")
+            await self.close()
+            return
+
+        if data['status'] in exports.FINISHED:
+            await self.send_json(data)
+            await self.close()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def export_finished(self, event):
+        data = await database_sync_to_async(exports.get_export_data)(self.export_id, self.scope['user'])
+        if data:
+            await self.send_json(data)
+        await self.close()
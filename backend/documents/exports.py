@@ -0,0 +1,433 @@
+"""
+Background PDF exports.
+
+download_url queues a PdfExport and returns right away.  An ExportWorker
+thread in the web process (or the run_pdf_exports command) claims pending
+exports in batches, generates their PDFs with the PDF_EXPORT_ENGINE and
+notifies the export's websocket group (see documents.consumers.ExportConsumer)
+once it finished.
+
+Engines:
+    local   renders the document's lexical JSON in a process pool (documents.pdf)
+    adobe   converts the document's HTML with Adobe PDF Services
+
+PDFs are stored by the etag of the exported content, so a document whose
+content did not change since it was last exported is served without
+generating it again.  The content is copied to a snapshot when the export
+is created, on the condition that it still has the etag, and the engines
+read the snapshot, so a document saved during an export does not end up
+in the PDF of the earlier content.  A PDF is deleted with the last export
+of its content (see documents.signals).
+"""
+
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+import logging
+logger = logging.getLogger('django')
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from documents import pdf
+from documents.api import adobe as adobe_api
+from documents.models import Document, DocumentBlob, PdfExport, Action
+from pairdraft.aws_manager import aws_manager, BUCKETS
+from pairdraft.cleanup import delete_objects_on_commit
+from users.models import UserProfile
+
+
+FINISHED = (PdfExport.DONE, PdfExport.FAILED)
+
+
+class ExportFailed(Exception):
+    """Raised when the PDF of an export could not be generated."""
+
+
+def get_group_name(export_id) -> str:
+    return f'pdf_export_{export_id}'
+
+
+def get_content_hash(document: Document, content_type: str, cached: bool = True) -> str | None:
+    """
+    Returns the etag of the document's content in the format, None if it has none.
+    The recorded etag is used unless cached is False.
+    """
+    blob = document.blobs.filter(content_type=content_type).first() if cached else None
+    if blob and blob.etag:
+        return blob.etag
+
+    metadata = aws_manager.get_object_metadata(
+        bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        file_path=document.get_file_path(content_type),
+        cached=cached
+    )
+    if not metadata:
+        return None
+    return DocumentBlob.record_metadata(document=document, content_type=content_type, metadata=metadata).etag or None
+
+
+def request_export(document: Document, user_profile: UserProfile) -> PdfExport | None:
+    """
+    Returns a finished export of the document's current content if there is one,
+    otherwise the export in progress or a new export, which is started after the transaction commits.
+    Returns None if the document has no content the engine can export.
+    """
+    content_type = get_engine().content_type
+    # the recorded etag first, the current one if the content changed since it was recorded
+    for cached in (True, False):
+        content_hash = get_content_hash(document, content_type, cached=cached)
+        if not content_hash:
+            return None
+
+        export = PdfExport.objects.filter(content_hash=content_hash, status=PdfExport.DONE).first() \
+            or PdfExport.objects.filter(document=document, content_hash=content_hash, status__in=[PdfExport.PENDING, PdfExport.RUNNING]).first()
+        if export:
+            return export
+
+        export = PdfExport(document=document, requested_by=user_profile, content_hash=content_hash)
+        if snapshot_content(export, content_type):
+            export.save()
+            if settings.PDF_EXPORT_IN_PROCESS:
+                transaction.on_commit(ExportWorker.start)
+            return export
+
+    logger.warning(f"Could not snapshot the content of document {document.id} for a PDF export")
+    return None
+
+
+def snapshot_content(export: PdfExport, content_type: str) -> bool:
+    """Copies the content of the export's document to the export's source path if it still has the export's content hash."""
+    return aws_manager.copy_object(
+        source_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        source_file_path=export.document.get_file_path(content_type),
+        destination_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        destination_file_path=export.get_source_path(content_type),
+        if_match=export.content_hash
+    ) is not None
+
+
+def request_chain_exports(document: Document, user_profile: UserProfile) -> list[tuple[Document, PdfExport]]:
+    """
+    Requests exports of all documents in the negotiation of the document, which are run as one batch.
+    Returns each document with content and its export, which may be the export of another document with the same content.
+    """
+    documents = Document.objects \
+        .filter(root_id=document.root_id or document.id) \
+        .annotate(first_action_at=Min('actions__timestamp')) \
+        .order_by('first_action_at')
+
+    # in one transaction, so the worker starts once all exports are queued
+    exports = []
+    with transaction.atomic():
+        for chain_document in documents:
+            export = request_export(document=chain_document, user_profile=user_profile)
+            if export:
+                exports.append((chain_document, export))
+    return exports
+
+
+def get_download_url(export: PdfExport, document: Document) -> str | None:
+    return aws_manager.generate_presigned_url(
+        client_method_name='get_object',
+        method_parameters={
+            'Bucket': BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            'Key': export.get_file_path(),
+            'ResponseContentType': Document.PDF,
+            'ResponseContentDisposition': f'attachment; filename="{document.title}.pdf"'
+        },
+        verify=False
+    )
+
+
+def serialize_export(export: PdfExport, document: Document) -> dict:
+    """Returns the status of an export and, once it is done, the url to download the document's PDF."""
+    return {
+        'id': str(export.id),
+        'status': export.status,
+        'url': get_download_url(export, document) if export.status == PdfExport.DONE else None,
+        'error': export.error or None
+    }
+
+
+def get_export_data(export_id, user) -> dict | None:
+    """Returns the serialized export if the user requested it or takes part in its document."""
+    try:
+        export = PdfExport.objects.select_related('document', 'requested_by').filter(id=export_id).first()
+    except ValidationError: # not a uuid
+        return None
+    if not export:
+        return None
+
+    if not user.is_superuser \
+        and not (export.requested_by_id and export.requested_by.user_id == user.id) \
+        and not Action.objects.filter(Q(from_user__user=user) | Q(to_user__user=user), document=export.document).exists():
+        return None
+
+    return serialize_export(export, export.document)
+
+
+def claim_exports(limit: int = 1) -> list[PdfExport]:
+    """
+    Marks the oldest pending exports, up to limit, as running and returns them.
+    Exports that have been running for too long, i.e. their process died, are claimed again.
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.PDF_EXPORT_TIMEOUT * 2)
+    with transaction.atomic():
+        exports = list(PdfExport.objects \
+            .select_for_update(skip_locked=True, of=('self',)) \
+            .select_related('document') \
+            .filter(Q(status=PdfExport.PENDING) | Q(status=PdfExport.RUNNING, updated__lt=stale_before)) \
+            .order_by('created')[:limit])
+        for export in exports:
+            export.status = PdfExport.RUNNING
+            export.save(update_fields=['status', 'updated'])
+    return exports
+
+
+class ExportEngine:
+    """
+    Generates the PDFs of exports and stores them at the exports' file paths.
+    The content hash of an export is the etag of the format the engine reads.
+    """
+    content_type = Document.HTML
+
+    def generate(self, export: PdfExport):
+        raise NotImplementedError
+
+    def generate_many(self, exports: list[PdfExport]) -> list[Exception | None]:
+        """Generates the PDFs of several exports and returns the error of each export, None if it succeeded."""
+        errors = []
+        for export in exports:
+            try:
+                self.generate(export)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+
+class AdobeEngine(ExportEngine):
+    """Converts the snapshot of the document's HTML with Adobe PDF Services, which reads the HTML from and writes the PDF to S3."""
+    content_type = Document.HTML
+
+    def generate(self, export: PdfExport):
+        get_html_url = aws_manager.generate_presigned_url(
+            client_method_name='get_object',
+            method_parameters={
+                'Bucket': BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                'Key': export.get_source_path(Document.HTML)
+            },
+            verify=False
+        )
+        put_pdf_url = aws_manager.generate_presigned_url(
+            client_method_name='put_object',
+            method_parameters={
+                'Bucket': BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                'Key': export.get_file_path(),
+                'ContentType': Document.PDF
+            },
+            verify=False
+        )
+        if not get_html_url or not put_pdf_url:
+            raise ExportFailed("Presigned urls not generated.")
+
+        job_id = adobe_api.adobe_client.html_to_pdf(get_html_url, put_pdf_url)
+        if not job_id:
+            raise ExportFailed("Job not created.")
+
+        try:
+            adobe_api.adobe_client.wait_for_job(job_id, timeout=settings.PDF_EXPORT_TIMEOUT, interval=settings.PDF_EXPORT_POLL_INTERVAL)
+        except adobe_api.AdobeJobFailed as e:
+            raise ExportFailed(str(e))
+
+
+class LocalEngine(ExportEngine):
+    """
+    Renders the snapshot of the document's lexical JSON with documents.pdf, in a pool of
+    PDF_EXPORT_PROCESSES worker processes so rendering does not hold the GIL
+    of the web process, and exports of a batch are rendered in parallel.
+    """
+    content_type = Document.JSON
+
+    _pool: ProcessPoolExecutor | None = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls) -> ProcessPoolExecutor | None:
+        """Returns the process pool, None to render in the current process."""
+        if not settings.PDF_EXPORT_PROCESSES:
+            return None
+        with cls._lock:
+            if cls._pool is None:
+                # spawned, as forking a process with running threads is unsafe
+                cls._pool = ProcessPoolExecutor(max_workers=settings.PDF_EXPORT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+            return cls._pool
+
+    @classmethod
+    def reset_pool(cls):
+        with cls._lock:
+            if cls._pool is not None:
+                cls._pool.shutdown(wait=False, cancel_futures=True)
+            cls._pool = None
+
+    def read_content(self, export: PdfExport) -> dict:
+        content = aws_manager.download_object(
+            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            file_path=export.get_source_path(Document.JSON)
+        )
+        if not content:
+            raise ExportFailed("Document content not found.")
+        return json.loads(content)
+
+    def store_pdf(self, export: PdfExport, body: bytes):
+        aws_manager.upload_object(
+            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            file_path=export.get_file_path(),
+            body=body,
+            content_type=Document.PDF
+        )
+
+    def generate(self, export: PdfExport):
+        error = self.generate_many([export])[0]
+        if error:
+            raise error
+
+    def generate_many(self, exports: list[PdfExport]) -> list[Exception | None]:
+        pool = self.get_pool()
+
+        # read all contents first, so the workers render while the rest is uploaded
+        results = []
+        for export in exports:
+            try:
+                data = self.read_content(export)
+                results.append(pool.submit(pdf.render_pdf, data) if pool else pdf.render_pdf(data))
+            except Exception as e:
+                results.append(e)
+
+        errors = []
+        for export, result in zip(exports, results):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if isinstance(result, Future):
+                    result = result.result(timeout=settings.PDF_EXPORT_TIMEOUT)
+                self.store_pdf(export, result)
+                errors.append(None)
+            except BrokenProcessPool as e:
+                # a worker died, i.e. it ran out of memory, the next batch gets a new pool
+                self.reset_pool()
+                errors.append(e)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+
+ENGINES = {
+    'adobe': AdobeEngine,
+    'local': LocalEngine,
+}
+
+
+def get_engine(name: str | None = None) -> ExportEngine:
+    """Returns the engine named name, PDF_EXPORT_ENGINE by default."""
+    return ENGINES[name or settings.PDF_EXPORT_ENGINE]()
+
+
+def run_exports(exports: list[PdfExport]):
+    """Runs claimed exports, saves their results and notifies their websocket groups."""
+    done = set(PdfExport.objects \
+        .filter(content_hash__in=[export.content_hash for export in exports], status=PdfExport.DONE) \
+        .values_list('content_hash', flat=True))
+
+    # the same content may have been exported for another document in the meantime,
+    # or be queued for several documents of the batch
+    to_generate = {}
+    for export in exports:
+        if export.content_hash not in done:
+            to_generate.setdefault(export.content_hash, export)
+
+    hashes = list(to_generate)
+    try:
+        errors = dict(zip(hashes, get_engine().generate_many([to_generate[content_hash] for content_hash in hashes])))
+    except Exception as e:
+        errors = {content_hash: e for content_hash in hashes}
+
+    # the snapshots of generated PDFs are not read again
+    generated = [content_hash for content_hash in hashes if not errors.get(content_hash)]
+    delete_objects_on_commit(
+        bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        keys=[to_generate[content_hash].get_source_path(get_engine().content_type) for content_hash in generated]
+    )
+
+    for export in exports:
+        error = errors.get(export.content_hash)
+        if error:
+            logger.error(f"PDF export {export.id} of document {export.document_id} failed: {error}")
+            export.status = PdfExport.FAILED
+            export.error = str(error) or error.__class__.__name__
+        else:
+            export.status = PdfExport.DONE
+        export.save(update_fields=['status', 'error', 'updated'])
+
+        try:
+            async_to_sync(get_channel_layer().group_send)(get_group_name(export.id), {'type': 'export.finished'})
+        except Exception as e:
+            logger.error(f"Could not notify PDF export {export.id}: {e}")
+
+
+def process_exports() -> int:
+    """Runs pending exports in batches of PDF_EXPORT_BATCH_SIZE until none are left and returns how many were run."""
+    count = 0
+    while exports := claim_exports(limit=settings.PDF_EXPORT_BATCH_SIZE):
+        run_exports(exports)
+        count += len(exports)
+    return count
+
+
+class ExportWorker:
+    """
+    Runs the pending exports in a background thread of the current process,
+    so requests never wait on PDFs.  The thread stops once no exports are pending.
+    """
+    _thread: threading.Thread | None = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def start(cls):
+        with cls._lock:
+            if cls._thread is None:
+                cls._thread = threading.Thread(target=cls.run, name='pdf-exports', daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def run(cls):
+        try:
+            while True:
+                try:
+                    process_exports()
+                except Exception as e:
+                    logger.error(f"Could not run PDF exports: {e}")
+                    time.sleep(settings.PDF_EXPORT_POLL_INTERVAL)
+
+                # checked under the lock so an export queued meanwhile is not left behind
+                with cls._lock:
+                    try:
+                        pending = PdfExport.objects.filter(status=PdfExport.PENDING).exists()
+                    except Exception as e:
+                        logger.error(f"Could not check for pending PDF exports: {e}")
+                        pending = False
+                    if not pending:
+                        cls._thread = None
+                        return
+        finally:
+            connection.close()
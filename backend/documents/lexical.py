@@ -0,0 +1,291 @@
+"""
+Converts the HTML of legacy documents to Lexical JSON.
+
+Understands the HTML the editor exports ($generateHtmlFromNodes with the
+theme's classes, see frontend/components/editor/theme.ts) and plain HTML:
+paragraphs, headings, quotes, nested lists, links, line breaks and bold,
+italic, underlined, struck through, code, subscript and superscript text.
+Anything else is kept as its text.
+
+Does not import Django, so it can run in the processes of a process pool.
+"""
+
+import json
+import re
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4.element import PreformattedString
+
+# lexical text formats
+IS_BOLD = 1
+IS_ITALIC = 1 << 1
+IS_STRIKETHROUGH = 1 << 2
+IS_UNDERLINE = 1 << 3
+IS_CODE = 1 << 4
+IS_SUBSCRIPT = 1 << 5
+IS_SUPERSCRIPT = 1 << 6
+
+TAG_FORMATS = {
+    'b': IS_BOLD,
+    'strong': IS_BOLD,
+    'i': IS_ITALIC,
+    'em': IS_ITALIC,
+    'u': IS_UNDERLINE,
+    's': IS_STRIKETHROUGH,
+    'strike': IS_STRIKETHROUGH,
+    'del': IS_STRIKETHROUGH,
+    'code': IS_CODE,
+    'sub': IS_SUBSCRIPT,
+    'sup': IS_SUPERSCRIPT,
+}
+CLASS_FORMATS = {
+    'textBold': IS_BOLD,
+    'textItalic': IS_ITALIC,
+    'textUnderline': IS_UNDERLINE,
+    'textStrikethrough': IS_STRIKETHROUGH,
+    'textUnderlineStrikethrough': IS_UNDERLINE | IS_STRIKETHROUGH,
+    'textCode': IS_CODE,
+    'textSubscript': IS_SUBSCRIPT,
+    'textSuperscript': IS_SUPERSCRIPT,
+}
+
+HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+BLOCKS = ('p', 'blockquote', 'ol', 'ul', 'li', 'div', 'section', 'article', 'body', 'html', 'main', 'header', 'footer') + HEADINGS
+IGNORED = ('head', 'style', 'script', 'title', 'meta', 'link')
+ALIGNMENTS = ('left', 'center', 'right', 'justify', 'start', 'end')
+
+
+def get_style(element: Tag) -> str:
+    return (element.get('style') or '').replace(' ', '').lower()
+
+
+def get_format(element: Tag) -> int:
+    format = TAG_FORMATS.get(element.name, 0)
+    for class_name in element.get('class') or []:
+        format |= CLASS_FORMATS.get(class_name, 0)
+
+    style = get_style(element)
+    if re.search(r'font-weight:(bold|[6-9]00)', style):
+        format |= IS_BOLD
+    if 'font-style:italic' in style:
+        format |= IS_ITALIC
+    if re.search(r'text-decoration[a-z-]*:[^;]*underline', style):
+        format |= IS_UNDERLINE
+    if re.search(r'text-decoration[a-z-]*:[^;]*line-through', style):
+        format |= IS_STRIKETHROUGH
+    if element.name == 'b' and 'font-weight:normal' in style:
+        format &= ~IS_BOLD # i.e. Google Docs wraps everything in <b style="font-weight:normal">
+    return format
+
+
+def get_alignment(element: Tag) -> str:
+    match = re.search(r'text-align:([a-z]+)', get_style(element))
+    return match.group(1) if match and match.group(1) in ALIGNMENTS else ''
+
+
+def get_indent(element: Tag) -> int:
+    # lexical exports indents as padding-inline-start: calc(N * 40px)
+    match = re.search(r'padding-inline-start:calc\((\d+)\*', get_style(element))
+    return int(match.group(1)) if match else 0
+
+
+def create_text(text: str, format: int) -> dict:
+    return {'detail': 0, 'format': format, 'mode': 'normal', 'style': '', 'text': text, 'type': 'text', 'version': 1}
+
+
+def create_element(type: str, children: list, **fields) -> dict:
+    return {
+        'children': children,
+        'direction': 'ltr' if children else None,
+        'format': fields.pop('format', ''),
+        'indent': fields.pop('indent', 0),
+        'type': type,
+        'version': 1,
+        **fields,
+    }
+
+
+def create_paragraph(children: list, **fields) -> dict:
+    return create_element('paragraph', children, textFormat=0, textStyle='', **fields)
+
+
+class Converter:
+
+    def convert(self, html: str) -> dict:
+        soup = BeautifulSoup(html, 'html.parser')
+        children = self.convert_blocks(soup.body or soup)
+        return {'root': create_element('root', children or [create_paragraph([])])}
+
+    def convert_blocks(self, element: Tag, list_depth: int = 0) -> list:
+        """Converts the children of an element to block nodes, wrapping inline content in paragraphs."""
+        blocks = []
+        inline = []
+
+        def flush():
+            children = trim(inline)
+            if any(node['type'] != 'linebreak' for node in children):
+                blocks.append(create_paragraph(children))
+            inline.clear()
+
+        for child in element.children:
+            if isinstance(child, Tag) and child.name in IGNORED:
+                continue
+            if isinstance(child, Tag) and child.name in BLOCKS:
+                flush()
+                blocks.extend(self.convert_block(child, list_depth))
+            else:
+                inline.extend(self.convert_inline(child, 0))
+        flush()
+        return blocks
+
+    def convert_block(self, element: Tag, list_depth: int) -> list:
+        name = element.name
+        fields = {'format': get_alignment(element), 'indent': get_indent(element)}
+
+        if name == 'p':
+            return [create_paragraph(trim(self.convert_inline_children(element)), **fields)]
+        if name in HEADINGS:
+            return [create_element('heading', trim(self.convert_inline_children(element)), tag=name, **fields)]
+        if name == 'blockquote':
+            return [create_element('quote', trim(self.convert_inline_children(element)), **fields)]
+        if name in ('ol', 'ul'):
+            return [self.convert_list(element, list_depth)]
+        if name == 'li': # outside of a list
+            return [create_paragraph(trim(self.convert_inline_children(element)), **fields)]
+        return self.convert_blocks(element, list_depth)
+
+    def convert_list(self, element: Tag, list_depth: int) -> dict:
+        ordered = element.name == 'ol'
+        start = int(element['start']) if (element.get('start') or '').isdigit() else 1
+
+        items = []
+        value = start
+        for child in element.children:
+            if not isinstance(child, Tag):
+                continue
+            if child.name in ('ol', 'ul'):
+                # a nested list directly in a list, wrapped in an item as lexical does
+                items.append(create_element('listitem', [self.convert_list(child, list_depth + 1)], value=value, indent=list_depth))
+                continue
+            if child.name != 'li':
+                continue
+
+            if (child.get('value') or '').isdigit():
+                value = int(child['value'])
+            items.extend(self.convert_list_item(child, list_depth, value))
+            if not self.is_nested_list_item(child):
+                value += 1
+
+        return create_element(
+            'list', items,
+            listType='number' if ordered else 'bullet',
+            start=start,
+            tag='ol' if ordered else 'ul',
+        )
+
+    def is_nested_list_item(self, element: Tag) -> bool:
+        children = [child for child in element.children if not (isinstance(child, NavigableString) and not child.strip())]
+        return bool(children) and all(isinstance(child, Tag) and child.name in ('ol', 'ul') for child in children)
+
+    def convert_list_item(self, element: Tag, list_depth: int, value: int) -> list:
+        """
+        Returns the list items of an li, lexical items hold either inline
+        content or a nested list, so an li with both becomes two items.
+        """
+        items = []
+        inline = []
+
+        def flush():
+            children = trim(inline)
+            if children:
+                items.append(create_element('listitem', children, value=value, indent=list_depth))
+            inline.clear()
+
+        for child in element.children:
+            if isinstance(child, Tag) and child.name in ('ol', 'ul'):
+                flush()
+                items.append(create_element('listitem', [self.convert_list(child, list_depth + 1)], value=value, indent=list_depth))
+            elif isinstance(child, Tag) and child.name in BLOCKS:
+                # paragraphs in an item are joined with line breaks
+                if inline:
+                    inline.append({'type': 'linebreak', 'version': 1})
+                inline.extend(trim(self.convert_inline_children(child)))
+            else:
+                inline.extend(self.convert_inline(child, 0))
+        flush()
+        return items or [create_element('listitem', [], value=value, indent=list_depth)]
+
+    def convert_inline_children(self, element: Tag, format: int = 0) -> list:
+        nodes = []
+        for child in element.children:
+            nodes.extend(self.convert_inline(child, format))
+        return merge_text(nodes)
+
+    def convert_inline(self, node, format: int) -> list:
+        if isinstance(node, PreformattedString): # comments, doctypes
+            return []
+        if isinstance(node, NavigableString):
+            text = str(node)
+            if not pre_wrap(node):
+                text = re.sub(r'\s+', ' ', text)
+            return [create_text(text, format)] if text else []
+        if not isinstance(node, Tag) or node.name in IGNORED:
+            return []
+
+        if node.name == 'br':
+            return [{'type': 'linebreak', 'version': 1}]
+        if node.name == 'a' and node.get('href'):
+            return [create_element(
+                'link', self.convert_inline_children(node, format),
+                url=node['href'],
+                rel=node.get('rel') and ' '.join(node['rel']) or None,
+                target=node.get('target'),
+                title=node.get('title'),
+            )]
+        if node.name in BLOCKS: # i.e. a paragraph in a span
+            return self.convert_inline_children(node, format)
+
+        return self.convert_inline_children(node, format | get_format(node))
+
+
+def pre_wrap(node) -> bool:
+    """Whether whitespace is preserved, lexical exports text in spans with white-space: pre-wrap."""
+    for parent in node.parents:
+        if isinstance(parent, Tag):
+            style = get_style(parent)
+            if 'white-space:pre' in style:
+                return True
+            if parent.name in BLOCKS:
+                return False
+    return False
+
+
+def merge_text(nodes: list) -> list:
+    """Joins adjacent text nodes of the same format."""
+    merged = []
+    for node in nodes:
+        if merged and node['type'] == 'text' and merged[-1]['type'] == 'text' and merged[-1]['format'] == node['format']:
+            merged[-1] = {**merged[-1], 'text': merged[-1]['text'] + node['text']}
+        else:
+            merged.append(node)
+    return [node for node in merged if node['type'] != 'text' or node['text']]
+
+
+def trim(nodes: list) -> list:
+    """Merges the inline content of a block and trims the whitespace around it, as browsers do."""
+    nodes = merge_text(nodes)
+    if nodes and nodes[0]['type'] == 'text':
+        nodes[0] = {**nodes[0], 'text': nodes[0]['text'].lstrip(' ')}
+    if nodes and nodes[-1]['type'] == 'text':
+        nodes[-1] = {**nodes[-1], 'text': nodes[-1]['text'].rstrip(' ')}
+    return [node for node in nodes if node['type'] != 'text' or node['text']]
+
+
+def html_to_lexical(html: str) -> dict:
+    """Returns the serialized lexical editor state of an HTML document."""
+    return Converter().convert(html)
+
+
+def html_to_json(html: str) -> str:
+    """Returns the serialized lexical editor state as JSON, so workers of a process pool return a string."""
+    return json.dumps(html_to_lexical(html))
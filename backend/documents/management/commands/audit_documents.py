@@ -0,0 +1,80 @@
+"""
+Django management command to audit the documents bucket against the Document table.
+
+Lists the bucket once, in parallel per key prefix, and reports the documents
+without content, the documents that only have HTML and need migration to
+Lexical JSON, and the orphaned objects of documents or exports that no longer
+exist (see documents.audit).
+"""
+
+import csv
+import json
+
+from django.core.management.base import BaseCommand
+
+from documents import audit as documents_audit
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Report missing, orphaned and needs-migration documents from one listing of the documents bucket'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format',
+            choices=['text', 'json', 'csv'],
+            default='text',
+            help='Output format (default: text)',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='File to write the report to instead of stdout',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Prefixes listed in parallel',
+        )
+
+    def handle(self, *args, **options):
+        audit = documents_audit.audit_documents(workers=options['workers'])
+
+        output = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            if options['format'] == 'json':
+                output.write(json.dumps(documents_audit.serialize_audit(audit), indent=2) + '\n')
+            elif options['format'] == 'csv':
+                rows = documents_audit.get_rows(audit)
+                writer = csv.DictWriter(output, fieldnames=list(rows[0]) if rows else ['kind'])
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                self.write_text(audit, output)
+        finally:
+            if options['output']:
+                output.close()
+
+        summary = documents_audit.serialize_audit(audit)['summary']
+        logger.info(f"Audited {summary['documents']} documents: {summary}")
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f'Wrote the audit of {summary["documents"]} documents to {options["output"]}'))
+
+    def write_text(self, audit: documents_audit.Audit, output):
+        for status, label in [
+            (documents_audit.MISSING, 'Documents without content'),
+            (documents_audit.NEEDS_MIGRATION, 'Documents needing migration (HTML exists, JSON does not)'),
+        ]:
+            documents = audit.get_documents(status)
+            output.write(f'{label}: {len(documents)}\n')
+            for document in documents:
+                output.write(f'  - {document.title} (ID: {document.id})\n')
+
+        output.write(f'Orphaned objects: {len(audit.orphaned)}\n')
+        for obj in audit.orphaned:
+            output.write(f'  - {obj.key} ({obj.size} bytes)\n')
+
+        output.write(f'{len(audit.documents)} documents, {len(audit.get_documents(documents_audit.OK))} with JSON content\n')
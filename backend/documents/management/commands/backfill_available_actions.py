@@ -0,0 +1,47 @@
+"""
+Django management command to materialize the available actions of documents.
+
+Available actions are updated by Action.save, this command fills them in for
+documents that have not been acted on since Document.available_actions was added
+and refreshes them with --all, i.e. after the transition table changed.
+"""
+
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Materialize the available actions and the editor of documents from their latest action'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Refresh every document, not only those without materialized actions',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many documents would be updated without saving them',
+        )
+
+    def handle(self, *args, **options):
+        documents = Document.objects.all()
+        if not options['all']:
+            documents = documents.filter(available_actions__isnull=True)
+
+        count = documents.count()
+        self.stdout.write(f'{count} documents to update')
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('This was a dry run. Use without --dry-run to save the available actions.'))
+            return
+
+        for document in documents.iterator():
+            document.update_available_actions()
+
+        logger.info(f"Backfilled the available actions of {count} documents")
+        self.stdout.write(self.style.SUCCESS(f'Updated {count} documents'))
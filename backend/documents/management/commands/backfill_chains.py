@@ -0,0 +1,74 @@
+"""
+Django management command to create or refresh the Chain of every document history.
+
+Chains are kept up to date by Action.save and the chains of histories
+that existed before the Chain model are created by migration 0016.  This
+command repairs chains that drifted, i.e. after actions were edited
+directly in the database.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.models import Action, Chain
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Create or refresh the Chain (negotiation) of every document history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many chains would be created or updated without saving them',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        # latest action of each history
+        latest_actions = Action.objects \
+            .select_related('document') \
+            .order_by('document__root_id', '-timestamp') \
+            .distinct('document__root_id')
+        latest_actions = {action.document.root_id: action for action in latest_actions}
+
+        participants = {}
+        for root_id, from_user_id, to_user_id in Action.objects.values_list('document__root_id', 'from_user_id', 'to_user_id'):
+            participants.setdefault(root_id, set()).update(user_id for user_id in (from_user_id, to_user_id) if user_id)
+
+        existing_chains = Chain.objects.in_bulk(latest_actions.keys(), field_name='root_id')
+        created = [root_id for root_id in latest_actions if root_id not in existing_chains]
+
+        self.stdout.write(f'{len(created)} chains to create, {len(existing_chains)} chains to update')
+        if dry_run:
+            self.stdout.write(self.style.WARNING('This was a dry run. Use without --dry-run to save the chains.'))
+            return
+
+        with transaction.atomic():
+            chains = []
+            for root_id, action in latest_actions.items():
+                chain = existing_chains.get(root_id) or Chain(root_id=root_id)
+                chain.latest_document_id = action.document_id
+                chain.latest_action = action
+                chain.last_activity_at = action.timestamp
+                chains.append(chain)
+
+            Chain.objects.bulk_create([chain for chain in chains if chain.root_id not in existing_chains])
+            Chain.objects.bulk_update(
+                [chain for chain in chains if chain.root_id in existing_chains],
+                ['latest_document', 'latest_action', 'last_activity_at']
+            )
+
+            Participant = Chain.participants.through
+            Participant.objects.bulk_create([
+                Participant(chain_id=chain.id, userprofile_id=user_id)
+                for chain in chains
+                for user_id in participants.get(chain.root_id, ())
+            ], ignore_conflicts=True)
+
+        logger.info(f"Backfilled {len(chains)} chains")
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} and updated {len(existing_chains)} chains'))
@@ -0,0 +1,65 @@
+"""
+Django management command to record the stored formats of documents in DocumentBlob.
+
+Formats are recorded when content is written or copied, this command fills
+them in for documents that existed before the DocumentBlob model by checking
+S3 for each format once.
+"""
+
+from django.core.management.base import BaseCommand
+
+from pairdraft.aws_manager import aws_manager, BUCKETS
+from documents.models import Document, DocumentBlob
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Record the formats (JSON, HTML, PDF) stored in S3 for documents without any recorded format'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Check every document, not only those without recorded formats',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show which formats would be recorded without saving them',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        documents = Document.objects.all()
+        if not options['all']:
+            documents = documents.filter(blobs__isnull=True)
+
+        recorded = 0
+        for document in documents.iterator():
+            for content_type in (Document.JSON, Document.HTML, Document.PDF):
+                try:
+                    metadata = aws_manager.get_object_metadata(
+                        bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                        file_path=document.get_file_path(content_type)
+                    )
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'Could not check {content_type} of document {document.id}: {e}'))
+                    continue
+
+                if not metadata:
+                    continue
+
+                recorded += 1
+                self.stdout.write(f'{document.id}: {content_type}')
+                if not dry_run:
+                    DocumentBlob.record_metadata(document=document, content_type=content_type, metadata=metadata)
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING(f'{recorded} formats found. This was a dry run. Use without --dry-run to record them.'))
+            return
+
+        logger.info(f"Backfilled {recorded} document formats")
+        self.stdout.write(self.style.SUCCESS(f'Recorded {recorded} formats'))
@@ -0,0 +1,103 @@
+"""
+Django management command to compare the PDF export engines.
+
+Renders the seeded purchase agreement (documents/purchase_agreement.json) with
+the local renderer, each run in this process and then all runs at once in the
+process pool.  With --document, each engine also exports that document end to
+end, reading its content from and storing the PDF in S3, which needs AWS
+credentials and, for adobe, Adobe PDF Services credentials.
+"""
+
+import json
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pairdraft.aws_manager import aws_manager, BUCKETS
+from documents import exports, pdf
+from documents.models import Document, PdfExport
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Compare the time the PDF export engines take to export a document'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=10,
+            help='Number of exports per engine',
+        )
+        parser.add_argument(
+            '--document',
+            help='Id of a document to export end to end with each engine',
+        )
+        parser.add_argument(
+            '--engine',
+            action='append',
+            choices=list(exports.ENGINES),
+            help='Engine to export the document with, can be repeated (default: all)',
+        )
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+
+        with open('documents/purchase_agreement.json', 'r') as file:
+            data = json.load(file)
+
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            body = pdf.render_pdf(data)
+            timings.append(time.perf_counter() - start)
+        self.report('local render', timings, f'{len(body)} bytes')
+
+        pool = exports.LocalEngine.get_pool()
+        if pool:
+            pool.submit(pdf.render_pdf, data).result() # start the workers
+            start = time.perf_counter()
+            list(pool.map(pdf.render_pdf, [data] * runs))
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'local pool: {runs} renders in {elapsed * 1000:.1f} ms, {runs / elapsed:.1f} per second')
+
+        if options['document']:
+            document = Document.objects.filter(id=options['document']).first()
+            if not document:
+                raise CommandError(f'Document {options["document"]} not found')
+            for name in options['engine'] or exports.ENGINES:
+                self.export(document, name, runs)
+
+        logger.info(f"Benchmarked the PDF export engines with {runs} runs")
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def export(self, document: Document, name: str, runs: int):
+        engine = exports.get_engine(name)
+        # not saved, so the PDF does not replace the document's exports
+        export = PdfExport(document=document, content_hash=f'benchmark-{uuid.uuid4()}')
+
+        timings = []
+        try:
+            for _ in range(runs):
+                start = time.perf_counter()
+                engine.generate(export)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'{name}: {e}'))
+            return
+        finally:
+            aws_manager.delete_object(bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value, key=export.get_file_path())
+
+        self.report(f'{name} export', timings)
+
+    def report(self, label: str, timings: list[float], detail: str = ''):
+        milliseconds = [timing * 1000 for timing in timings]
+        self.stdout.write(
+            f'{label}: median {statistics.median(milliseconds):.1f} ms, '
+            f'min {min(milliseconds):.1f} ms, max {max(milliseconds):.1f} ms'
+            + (f', {detail}' if detail else '')
+        )
@@ -1,7 +1,6 @@
-import json
 from django.core.management.base import BaseCommand
 from documents.models import Document
-from pairdraft.aws_manager import aws_manager, BUCKETS
+from documents import audit as documents_audit
 
 
 class Command(BaseCommand):
@@ -19,12 +18,15 @@ class Command(BaseCommand):
         
         if doc_id:
             documents = Document.objects.filter(id=doc_id)
+            # only the document's objects are listed
+            audit = documents_audit.audit_documents(documents, prefixes=[f'{doc_id}/'])
         else:
             documents = Document.objects.all()
+            audit = documents_audit.audit_documents(documents)
         
-        self.stdout.write(f'Checking {documents.count()} documents...\n')
+        self.stdout.write(f'Checking {len(audit.documents)} documents...\n')
         
-        for doc in documents:
+        for doc in audit.documents:
             self.stdout.write(self.style.SUCCESS(f'\nDocument: {doc.title} (ID: {doc.id})'))
             
             # Check each format
@@ -36,21 +38,9 @@ class Command(BaseCommand):
             
             for format_name, content_type in formats.items():
                 file_path = doc.get_file_path(content_type)
-                exists = aws_manager.object_exists(
-                    bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                    file_path=file_path
-                )
+                stored = doc.formats.get(content_type)
                 
-                if exists:
-                    # Get file size
-                    try:
-                        response = aws_manager.s3_client.head_object(
-                            Bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                            Key=file_path
-                        )
-                        size = response['ContentLength']
-                        self.stdout.write(f'  ✓ {format_name}: {file_path} ({size} bytes)')
-                    except:
-                        self.stdout.write(f'  ✓ {format_name}: {file_path}')
+                if stored:
+                    self.stdout.write(f'  ✓ {format_name}: {file_path} ({stored.size} bytes)')
                 else:
-                    self.stdout.write(self.style.WARNING(f'  ✗ {format_name}: {file_path} (not found)'))
\ No newline at end of file
+                    self.stdout.write(self.style.WARNING(f'  ✗ {format_name}: {file_path} (not found)'))
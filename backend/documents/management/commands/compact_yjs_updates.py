@@ -0,0 +1,136 @@
+"""
+Django management command to compact the Yjs updates in the "yjs-writings" table.
+
+The y-websocket server stores every update of a document as a row and
+replays all of them when the document is opened.  This command merges the
+rows of each document with at least --min-updates rows into one snapshot
+update, see documents.yjs.compact_document, which is safe while the server
+writes.
+
+Reports the rows and size of the table and the time it takes to open the
+largest documents before and after.  With --periodic the command keeps
+running and compacts every YJS_COMPACTION_INTERVAL seconds, i.e. as a
+worker service, otherwise it can be scheduled as a cron job.
+"""
+
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+
+from documents import yjs
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Merge the Yjs update rows of each document into a single snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show the documents that would be compacted without compacting them',
+        )
+        parser.add_argument(
+            '--doc-id',
+            action='append',
+            help='Id of a document to compact, can be repeated (default: all documents)',
+        )
+        parser.add_argument(
+            '--min-updates',
+            type=int,
+            default=settings.YJS_COMPACTION_MIN_UPDATES,
+            help=f'Compact documents with at least this many update rows (default: {settings.YJS_COMPACTION_MIN_UPDATES})',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Maximum number of documents to compact per run',
+        )
+        parser.add_argument(
+            '--sample',
+            type=int,
+            default=10,
+            help='Number of documents, those with the most rows, whose open time is measured before and after',
+        )
+        parser.add_argument(
+            '--periodic',
+            action='store_true',
+            help='Keep running and compact every YJS_COMPACTION_INTERVAL seconds',
+        )
+
+    def handle(self, *args, **options):
+        if not options['periodic']:
+            self.compact(options)
+            return
+
+        while True:
+            close_old_connections()
+            try:
+                self.compact(options)
+            except (CommandError, DatabaseError) as e:
+                logger.error(f"Could not compact the Yjs updates: {e}")
+            time.sleep(settings.YJS_COMPACTION_INTERVAL)
+
+    def compact(self, options):
+        try:
+            before = yjs.get_table_stats()
+        except DatabaseError as e:
+            raise CommandError(f'Could not read the {yjs.YJS_WRITINGS_TABLE} table: {e}')
+
+        documents = yjs.get_documents_to_compact(
+            min_updates=options['min_updates'],
+            docnames=options['doc_id'],
+            limit=options['limit']
+        )
+        self.stdout.write(f'{yjs.YJS_WRITINGS_TABLE}: {self.format_stats(before)}')
+        self.stdout.write(f'{len(documents)} documents with at least {options["min_updates"]} updates')
+
+        sample = [docname for docname, _ in documents[:options['sample']]]
+        open_before = [yjs.measure_open(docname) for docname in sample]
+
+        if options['dry_run']:
+            for docname, count in documents:
+                self.stdout.write(f'  {docname}: {count} updates')
+            if sample:
+                self.stdout.write(f'open time: {self.format_timings(open_before)}')
+            self.stdout.write(self.style.WARNING('This was a dry run. Use without --dry-run to compact the documents.'))
+            return
+
+        compacted, merged, skipped, failed = 0, 0, 0, 0
+        for docname, _ in documents:
+            try:
+                result = yjs.compact_document(docname)
+            except DatabaseError as e:
+                # i.e. the lock timed out, the next run tries again
+                logger.warning(f"Could not compact Yjs document {docname}: {e}")
+                failed += 1
+                continue
+            if result is None:
+                skipped += 1
+                continue
+            compacted += 1
+            merged += result.updates
+
+        after = yjs.get_table_stats()
+        self.stdout.write(f'{yjs.YJS_WRITINGS_TABLE} after: {self.format_stats(after)}')
+        if sample:
+            open_after = [yjs.measure_open(docname) for docname in sample]
+            self.stdout.write(f'open time of {len(sample)} documents before: {self.format_timings(open_before)}')
+            self.stdout.write(f'open time of {len(sample)} documents after: {self.format_timings(open_after)}')
+
+        summary = f'{merged} updates of {compacted} documents ({skipped} skipped, {failed} failed)'
+        logger.info(f"Compacted {summary} in {yjs.YJS_WRITINGS_TABLE}")
+        self.stdout.write(self.style.SUCCESS(f'Compacted {summary}, {before.rows - after.rows} rows removed'))
+
+    def format_stats(self, stats: yjs.TableStats) -> str:
+        return f'{stats.rows} rows of {stats.documents} documents, {stats.bytes / 1e6:.2f} MB of updates, {stats.table_size / 1e6:.2f} MB on disk'
+
+    def format_timings(self, timings: list[float]) -> str:
+        milliseconds = [timing * 1000 for timing in timings]
+        return f'median {statistics.median(milliseconds):.1f} ms, max {max(milliseconds):.1f} ms'
+
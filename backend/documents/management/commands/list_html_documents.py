@@ -1,8 +1,7 @@
-import json
 from django.core.management.base import BaseCommand
 from django.db.models import Q
 from documents.models import Document, Action
-from pairdraft.aws_manager import aws_manager, BUCKETS
+from documents import audit as documents_audit
 from users.models import UserProfile
 
 
@@ -46,47 +45,41 @@ class Command(BaseCommand):
         json_documents = []
         needs_migration = []
         
-        for doc in documents:
-            html_path = doc.get_file_path(Document.HTML)
-            json_path = doc.get_file_path(Document.JSON)
-            
-            if check_s3:
-                html_exists = aws_manager.object_exists(
-                    bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                    file_path=html_path
-                )
-                json_exists = aws_manager.object_exists(
-                    bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                    file_path=json_path
-                )
+        if check_s3:
+            # one listing of the bucket instead of two requests per document
+            audit = documents_audit.audit_documents(documents)
+            for doc in audit.documents:
+                html_exists = Document.HTML in doc.formats
+                json_exists = Document.JSON in doc.formats
                 
-                if html_exists and not json_exists:
+                if doc.status == documents_audit.NEEDS_MIGRATION:
                     needs_migration.append({
-                        'id': str(doc.id),
+                        'id': doc.id,
                         'title': doc.title,
-                        'html_path': html_path,
-                        'json_path': json_path
+                        'html_path': doc.get_file_path(Document.HTML),
+                        'json_path': doc.get_file_path(Document.JSON)
                     })
                 elif html_exists:
                     html_documents.append({
-                        'id': str(doc.id),
+                        'id': doc.id,
                         'title': doc.title,
-                        'html_path': html_path,
+                        'html_path': doc.get_file_path(Document.HTML),
                         'has_json': json_exists
                     })
                 elif json_exists:
                     json_documents.append({
-                        'id': str(doc.id),
+                        'id': doc.id,
                         'title': doc.title,
-                        'json_path': json_path
+                        'json_path': doc.get_file_path(Document.JSON)
                     })
-            else:
+        else:
+            for doc in documents:
                 # Just list all documents
                 html_documents.append({
                     'id': str(doc.id),
                     'title': doc.title,
-                    'html_path': html_path,
-                    'json_path': json_path
+                    'html_path': doc.get_file_path(Document.HTML),
+                    'json_path': doc.get_file_path(Document.JSON)
                 })
         
         # Output results
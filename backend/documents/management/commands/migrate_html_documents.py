@@ -0,0 +1,121 @@
+"""
+Django management command to migrate the documents that only have HTML content to Lexical JSON.
+
+The documents are found with one audit of the bucket and converted server
+side by documents.migration, see there.  Progress is appended to the
+checkpoint file, so a stopped run continues where it left off when it is run
+again with the same file.  Documents that failed are skipped on resume unless
+--retry-failed is given.
+
+Once all documents are migrated, the HTML fallback of format_document and the
+frontend's client side migration can be removed.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import migration
+from documents.models import Document
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Convert the HTML content of legacy documents to Lexical JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Download and convert the documents without uploading the JSON',
+        )
+        parser.add_argument(
+            '--doc-id',
+            action='append',
+            help='Id of a document to migrate, can be repeated (default: all documents)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Maximum number of documents to migrate',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Documents per batch, the checkpoint is written after each batch',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=16,
+            help='Threads downloading and uploading',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=4,
+            help='Worker processes converting, 0 converts in this process',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default='html_migration.jsonl',
+            help='File the result of each document is appended to and read from on resume',
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Migrate the documents that failed in an earlier run again',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['threads'] < 1 or options['processes'] < 0:
+            raise CommandError('--batch-size and --threads must be positive and --processes not negative')
+
+        documents = None
+        if options['doc_id']:
+            documents = Document.objects.filter(id__in=options['doc_id'])
+
+        candidates = migration.find_documents(documents)
+        statuses = migration.read_checkpoint(options['checkpoint'])
+        done = {migration.MIGRATED, migration.SKIPPED} if options['retry_failed'] else {migration.MIGRATED, migration.SKIPPED, migration.FAILED}
+        pending = [document for document in candidates if statuses.get(document.id) not in done]
+        if options['limit'] is not None:
+            pending = pending[:options['limit']]
+
+        self.stdout.write(f'{len(candidates)} documents need migration, {len(candidates) - len(pending)} skipped from {options["checkpoint"]}, migrating {len(pending)}')
+        if not pending:
+            self.stdout.write(self.style.SUCCESS('Nothing to migrate'))
+            return
+
+        run = migration.Migration(
+            threads=options['threads'],
+            processes=options['processes'],
+            dry_run=options['dry_run'],
+            checkpoint=options['checkpoint'],
+        )
+        metrics = run.run(pending, batch_size=options['batch_size'], on_batch=lambda results: self.report_batch(run.metrics, results))
+
+        self.stdout.write(
+            f'{metrics.documents} documents in {metrics.elapsed:.1f} s: '
+            f'{metrics.documents_per_second:.1f} documents/s, {metrics.megabytes_per_second:.2f} MB/s of HTML, '
+            f'{metrics.bytes_read / 1e6:.2f} MB read, {metrics.bytes_written / 1e6:.2f} MB written'
+        )
+        self.stdout.write(
+            f'stages, from the start of each batch: downloaded after {metrics.download_time:.1f} s, '
+            f'converted after {metrics.convert_time:.1f} s, uploaded after {metrics.upload_time:.1f} s'
+        )
+
+        summary = ', '.join(f'{count} {status}' for status, count in sorted(metrics.results.items()))
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{summary}. This was a dry run. Use without --dry-run to upload the JSON.'))
+            return
+
+        logger.info(f"Migrated HTML documents to JSON: {summary}")
+        self.stdout.write(self.style.SUCCESS(f'Done: {summary}'))
+
+    def report_batch(self, metrics: migration.Metrics, results: list[migration.MigrationResult]):
+        for result in results:
+            if result.status == migration.FAILED:
+                self.stdout.write(self.style.ERROR(f'{result.id}: {result.error}'))
+        self.stdout.write(f'{metrics.documents} documents, {metrics.documents_per_second:.1f}/s')
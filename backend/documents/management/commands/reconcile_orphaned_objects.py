@@ -0,0 +1,53 @@
+"""
+Django management command to delete the S3 objects recorded as OrphanedObject.
+
+Objects of deleted documents and properties are queued as OrphanedObject
+and deleted by pairdraft.cleanup once the delete commits, those that could
+not be deleted after all retries stay recorded as orphans.  This command
+deletes all of them again in batches, including the keys still queued by a
+process that stopped, and removes the records of the objects that are gone.
+"""
+
+from django.core.management.base import BaseCommand
+
+from documents.models import OrphanedObject
+from pairdraft.cleanup import delete_objects
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Delete the S3 objects that could not be deleted when their document or property was deleted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show the orphaned objects without deleting them',
+        )
+
+    def handle(self, *args, **options):
+        keys_by_bucket = {}
+        for bucket, key in OrphanedObject.objects.order_by('bucket', 'key').values_list('bucket', 'key'):
+            keys_by_bucket.setdefault(bucket, []).append(key)
+
+        if options['dry_run']:
+            for bucket, keys in keys_by_bucket.items():
+                for key in keys:
+                    self.stdout.write(f'{bucket}/{key}')
+            total = sum(len(keys) for keys in keys_by_bucket.values())
+            self.stdout.write(self.style.WARNING(f'{total} orphaned objects found. This was a dry run. Use without --dry-run to delete them.'))
+            return
+
+        deleted, failed = 0, 0
+        for bucket, keys in keys_by_bucket.items():
+            # removes the records of the deleted keys
+            errors = delete_objects(bucket, keys)
+            deleted += len(keys) - len(errors)
+            failed += len(errors)
+            for key, error in errors.items():
+                self.stdout.write(self.style.ERROR(f'Could not delete {bucket}/{key}: {error}'))
+
+        logger.info(f"Deleted {deleted} orphaned objects, {failed} still orphaned")
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} orphaned objects, {failed} could not be deleted'))
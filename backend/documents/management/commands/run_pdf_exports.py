@@ -0,0 +1,39 @@
+"""
+Django management command to run the pending PDF exports queued by documents.exports.
+
+Web processes run exports in a background thread unless PDF_EXPORT_IN_PROCESS
+is false, this command runs them in a dedicated process instead, or once to
+pick up exports left behind, i.e. after a deploy.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from documents.exports import process_exports
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Run the pending PDF exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once no exports are pending instead of waiting for new ones',
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            total += process_exports()
+            if options['once']:
+                break
+            time.sleep(settings.PDF_EXPORT_POLL_INTERVAL)
+
+        logger.info(f"Ran {total} PDF exports")
+        self.stdout.write(self.style.SUCCESS(f'Ran {total} exports'))
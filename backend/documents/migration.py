@@ -0,0 +1,267 @@
+"""
+Bulk migration of legacy HTML documents to Lexical JSON.
+
+Documents that only have HTML content are found with one audit of the
+bucket.  They are migrated in batches, each document streaming through three
+stages: its HTML is downloaded on a thread pool, converted by documents.lexical
+in a pool of worker processes, and the JSON uploaded on the thread pool again,
+so S3 requests overlap with the conversions.  The JSON is only written if the
+document has none yet, so a document saved by the editor in the meantime is
+left as it is.
+
+A conversion that takes longer than CONVERSION_TIMEOUT fails, and the pool
+is replaced with its workers terminated so the hung worker is not occupied
+for the rest of the run.  Conversions of the batch that were still pending in
+the old pool are submitted again.
+
+Each result is appended to a checkpoint file (JSON lines), a run resumes by
+skipping the documents in it.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, asdict
+import logging
+logger = logging.getLogger('django')
+
+from botocore.exceptions import ClientError
+
+from documents import audit as documents_audit, lexical
+from documents.models import Document, DocumentBlob
+from pairdraft.aws_manager import aws_manager, BUCKETS
+
+
+# results
+MIGRATED = 'migrated'
+CONVERTED = 'converted' # in a dry run, not uploaded
+SKIPPED = 'skipped' # the document got JSON content in the meantime
+FAILED = 'failed'
+
+CONVERSION_TIMEOUT = 60 # seconds
+
+
+@dataclass
+class MigrationResult:
+    id: str
+    status: str
+    error: str = ''
+    html_size: int = 0
+    json_size: int = 0
+    etag: str = ''
+
+
+@dataclass
+class Metrics:
+    documents: int = 0
+    results: dict[str, int] = field(default_factory=dict) # count by status
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # seconds from the start of each batch until all its documents passed the stage, summed over the batches
+    download_time: float = 0
+    convert_time: float = 0
+    upload_time: float = 0
+    elapsed: float = 0
+
+    def add(self, result: MigrationResult):
+        self.documents += 1
+        self.results[result.status] = self.results.get(result.status, 0) + 1
+        self.bytes_read += result.html_size
+        self.bytes_written += result.json_size
+
+    @property
+    def documents_per_second(self) -> float:
+        return self.documents / self.elapsed if self.elapsed else 0
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.bytes_read / 1e6 / self.elapsed if self.elapsed else 0
+
+
+def read_checkpoint(path: str) -> dict[str, str]:
+    """Returns the status of each document in the checkpoint file by id."""
+    statuses = {}
+    if not path or not os.path.exists(path):
+        return statuses
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError: # a line cut short when the last run was stopped
+                continue
+            statuses[entry['id']] = entry['status']
+    return statuses
+
+
+def find_documents(documents=None, workers: int = 8) -> list[documents_audit.DocumentAudit]:
+    """Returns the audits of the documents, all by default, that only have HTML content."""
+    audit = documents_audit.audit_documents(documents, workers=workers)
+    return audit.get_documents(documents_audit.NEEDS_MIGRATION)
+
+
+class Migration:
+    """
+    Migrates documents with a pool of threads for S3 and a pool of processes
+    for conversions.  With processes=0 documents are converted in this process.
+    """
+
+    def __init__(self, threads: int = 8, processes: int = 2, dry_run: bool = False, checkpoint: str | None = None):
+        self.threads = threads
+        self.processes = processes
+        self.dry_run = dry_run
+        self.checkpoint = checkpoint
+        self.metrics = Metrics()
+        self.pool = None
+
+    def run(self, documents: list[documents_audit.DocumentAudit], batch_size: int = 100, on_batch=None) -> Metrics:
+        """
+        Migrates the documents in batches and returns the metrics of the run.
+        on_batch is called with the results of each batch.
+        """
+        start = time.perf_counter()
+        self.pool = self.get_pool()
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as threads:
+                for offset in range(0, len(documents), batch_size):
+                    results = self.migrate_batch(documents[offset:offset + batch_size], threads)
+                    self.metrics.elapsed = time.perf_counter() - start
+                    if on_batch:
+                        on_batch(results)
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+        self.metrics.elapsed = time.perf_counter() - start
+        return self.metrics
+
+    def get_pool(self) -> ProcessPoolExecutor | ThreadPoolExecutor:
+        if not self.processes:
+            return ThreadPoolExecutor(max_workers=1) # only to share the interface, converts one at a time
+        # spawned, as forking a process with running threads is unsafe
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def recycle_pool(self):
+        """
+        Replaces the pool after a conversion timed out.  The workers of a process pool
+        are terminated, a hung thread of the in-process pool is only left behind.
+        """
+        pool, self.pool = self.pool, self.get_pool()
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def convert(self, html: str, pool, future: Future) -> str:
+        """Returns the JSON of a submitted conversion, converting again if its pool was recycled or broke."""
+        try:
+            return future.result(timeout=CONVERSION_TIMEOUT)
+        except (BrokenProcessPool, CancelledError):
+            if pool is self.pool: # i.e. a worker crashed
+                self.recycle_pool()
+            return self.pool.submit(lexical.html_to_json, html).result(timeout=CONVERSION_TIMEOUT)
+
+    def migrate_batch(self, documents: list[documents_audit.DocumentAudit], threads: ThreadPoolExecutor) -> list[MigrationResult]:
+        start = time.perf_counter()
+        downloads = [threads.submit(self.download, document) for document in documents]
+
+        # convert as the downloads come in
+        conversions = []
+        for document, download in zip(documents, downloads):
+            html = download.result()
+            if isinstance(html, MigrationResult):
+                conversions.append(html)
+                continue
+            conversions.append((html, self.pool, self.pool.submit(lexical.html_to_json, html)))
+        downloaded = time.perf_counter()
+
+        uploads = []
+        for document, conversion in zip(documents, conversions):
+            if isinstance(conversion, MigrationResult):
+                uploads.append(conversion)
+                continue
+            html, pool, future = conversion
+            try:
+                content = self.convert(html, pool, future)
+            except TimeoutError:
+                self.recycle_pool()
+                uploads.append(MigrationResult(id=document.id, status=FAILED, error=f'Conversion timed out after {CONVERSION_TIMEOUT} s', html_size=len(html.encode())))
+                continue
+            except Exception as e:
+                uploads.append(MigrationResult(id=document.id, status=FAILED, error=f'Conversion failed: {e!r}', html_size=len(html.encode())))
+                continue
+            uploads.append(threads.submit(self.upload, document, html, content))
+        converted = time.perf_counter()
+
+        results = [upload.result() if isinstance(upload, Future) else upload for upload in uploads]
+        self.metrics.download_time += downloaded - start
+        self.metrics.convert_time += converted - start
+        self.metrics.upload_time += time.perf_counter() - start
+        for result in results:
+            self.metrics.add(result)
+        self.record_blobs(results)
+        self.write_checkpoint(results)
+        return results
+
+    def download(self, document: documents_audit.DocumentAudit) -> str | MigrationResult:
+        try:
+            html = aws_manager.download_object(
+                bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                file_path=document.get_file_path(Document.HTML)
+            )
+        except Exception as e:
+            html = None
+            logger.error(f"Could not download the HTML of document {document.id}: {e}")
+
+        if html is None:
+            return MigrationResult(id=document.id, status=FAILED, error='HTML content not found.')
+        return html
+
+    def upload(self, document: documents_audit.DocumentAudit, html: str, content: str) -> MigrationResult:
+        result = MigrationResult(id=document.id, status=MIGRATED, html_size=len(html.encode()), json_size=len(content.encode()))
+        if self.dry_run:
+            result.status = CONVERTED
+            return result
+
+        try:
+            response = aws_manager.upload_object(
+                bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                file_path=document.get_file_path(Document.JSON),
+                body=content,
+                content_type=Document.JSON,
+                only_if_missing=True
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+                # saved by the editor since the audit
+                result.status, result.json_size = SKIPPED, 0
+                return result
+            result.status, result.error = FAILED, str(e)
+            return result
+        except Exception as e:
+            result.status, result.error = FAILED, str(e)
+            return result
+
+        result.etag = (response.get('ETag') or '').strip('"')
+        return result
+
+    def record_blobs(self, results: list[MigrationResult]):
+        """Records the uploaded JSON, on the calling thread so the pool threads do not open database connections."""
+        for result in results:
+            if result.status != MIGRATED:
+                continue
+            try:
+                DocumentBlob.record(document=Document(id=result.id), content_type=Document.JSON, size=result.json_size, etag=result.etag)
+            except Exception as e:
+                # the JSON is stored, backfill_document_blobs records it later
+                logger.error(f"Could not record the JSON of document {result.id}: {e}")
+
+    def write_checkpoint(self, results: list[MigrationResult]):
+        if not self.checkpoint or self.dry_run:
+            return
+        with open(self.checkpoint, 'a') as file:
+            for result in results:
+                file.write(json.dumps(asdict(result)) + '\n')
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+def create_chains(apps, schema_editor):
+    """Create the chains of the existing document histories, see the backfill_chains command."""
+    Action = apps.get_model('documents', 'Action')
+    Chain = apps.get_model('documents', 'Chain')
+
+    # latest action of each history
+    latest_actions = Action.objects \
+        .filter(document__root__isnull=False) \
+        .select_related('document') \
+        .order_by('document__root_id', '-timestamp') \
+        .distinct('document__root_id')
+
+    chains = Chain.objects.bulk_create([
+        Chain(
+            root_id=action.document.root_id,
+            latest_document_id=action.document_id,
+            latest_action_id=action.id,
+            last_activity_at=action.timestamp
+        )
+        for action in latest_actions
+    ])
+    chain_ids = {chain.root_id: chain.id for chain in chains}
+
+    participants = set()
+    for root_id, from_user_id, to_user_id in Action.objects.filter(document__root__isnull=False).values_list('document__root_id', 'from_user_id', 'to_user_id'):
+        participants.update((chain_ids[root_id], user_id) for user_id in (from_user_id, to_user_id) if user_id)
+
+    Participant = Chain.participants.through
+    Participant.objects.bulk_create([Participant(chain_id=chain_id, userprofile_id=user_id) for chain_id, user_id in participants])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_userprofile_first_name_and_more'),
+        ('documents', '0015_alter_action_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Chain',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('last_activity_at', models.DateTimeField(blank=True, null=True)),
+                ('latest_action', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.action')),
+                ('latest_document', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.document')),
+                ('participants', models.ManyToManyField(blank=True, related_name='chains', to='users.userprofile')),
+                ('root', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='chain', to='documents.document')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-last_activity_at'], name='chain_last_activity_idx')],
+            },
+        ),
+        migrations.RunPython(create_chains, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0016_chain'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['document', 'timestamp'], name='action_document_timestamp_idx'),
+        ),
+    ]
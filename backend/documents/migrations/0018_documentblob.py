@@ -0,0 +1,31 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0017_action_action_document_timestamp_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentBlob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('content_type', models.CharField(choices=[('application/json', 'JSON'), ('text/html', 'HTML'), ('application/pdf', 'PDF')], max_length=30)),
+                ('size', models.BigIntegerField(blank=True, help_text='Size in bytes, if known', null=True)),
+                ('etag', models.CharField(blank=True, max_length=100)),
+                ('last_modified', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blobs', to='documents.document')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='documentblob',
+            constraint=models.UniqueConstraint(fields=('document', 'content_type'), name='document_blob_content_type_unique'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_userprofile_first_name_and_more'),
+        ('documents', '0018_documentblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='available_actions',
+            field=models.JSONField(blank=True, help_text='Action types available to each participant by user profile id', null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='editable_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='users.userprofile'),
+        ),
+    ]
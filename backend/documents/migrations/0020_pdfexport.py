@@ -0,0 +1,32 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_userprofile_first_name_and_more'),
+        ('documents', '0019_document_available_actions_document_editable_by'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfExport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('content_hash', models.CharField(help_text='Etag of the exported HTML content', max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pdf_exports', to='documents.document')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pdf_exports', to='users.userprofile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['content_hash', 'status'], name='pdf_export_content_hash_idx'), models.Index(fields=['status', 'created'], name='pdf_export_status_idx')],
+            },
+        ),
+    ]
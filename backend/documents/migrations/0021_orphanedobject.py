@@ -0,0 +1,30 @@
+# Generated by Django 4.2.2 on 2026-10-18 03:56
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0020_pdfexport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrphanedObject',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('bucket', models.CharField(max_length=63)),
+                ('key', models.CharField(max_length=1024)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=1, help_text='Number of cleanups that failed to delete the object')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='orphanedobject',
+            constraint=models.UniqueConstraint(fields=('bucket', 'key'), name='orphaned_object_unique'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.2 on 2026-10-18 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0021_orphanedobject'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='action',
+            name='action_document_timestamp_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='chain',
+            name='chain_last_activity_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chain',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='chain_last_activity_idx'),
+        ),
+    ]
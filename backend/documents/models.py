@@ -4,8 +4,9 @@ import logging
 logger = logging.getLogger('django')
 from typing import List
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
+from django.utils import timezone
 
 from pairdraft.settings import IS_PRODUCTION
 from pairdraft.aws_manager import aws_manager, BUCKETS
@@ -19,36 +20,60 @@ class Document(models.Model):
     title = models.CharField(max_length=200)
     root = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True)
     property = models.ForeignKey('properties.Property', on_delete=models.SET_NULL, null=True, blank=True)
+
+    # materialized from the latest action by update_available_actions,
+    # and again when a participant's is_attorney changes (see documents.signals)
+    available_actions = models.JSONField(null=True, blank=True, help_text="Action types available to each participant by user profile id")
+    editable_by = models.ForeignKey('users.UserProfile', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
     
     JSON = 'application/json'
     HTML = 'text/html'
     PDF = 'application/pdf'
     
     actions: models.Manager['Action']
+    blobs: models.Manager['DocumentBlob']
 
     def save(self, *args, **kwargs):
         if not self.root:
             self.root = self
         super().save(*args, **kwargs)
 
-    def create_copy(self, content_type: str):
+    def create_copy(self, content_types: List[str] | None = None) -> 'Document':
+        """
+        Creates a document in the same history with a copy of this document's content.
+
+        The formats are copied once the transaction commits, see copy_content.
+        """
         document = Document.objects.create(
             title=self.title,
             root=self.root if self.root else self,
             property=self.property
         )
-        
-        try:
-            aws_manager.copy_object(
-                source_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                source_file_path=self.get_file_path(content_type=content_type),
-                destination_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                destination_file_path=document.get_file_path(content_type=content_type)
+        transaction.on_commit(lambda: document.copy_content(source=self, content_types=content_types))
+        return document
+
+    def copy_content(self, source: 'Document', content_types: List[str] | None = None):
+        """
+        Copies the formats of the source's content to this document in one concurrent batch and records them.
+        Copies the source's recorded formats by default, all formats if none are recorded,
+        formats that do not exist in S3 are skipped.
+        """
+        if content_types is None:
+            content_types = list(source.blobs.values_list('content_type', flat=True)) or [Document.JSON, Document.HTML, Document.PDF]
+
+        responses = aws_manager.copy_objects([
+            (
+                BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                source.get_file_path(content_type=content_type),
+                BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                self.get_file_path(content_type=content_type)
             )
-        except Exception as e:
-            logger.error(f"Failed to copy document {self.id} in S3: {e}")
+            for content_type in content_types
+        ])
 
-        return document
+        for content_type, response in zip(content_types, responses):
+            if response is not None: # None if the source does not exist
+                DocumentBlob.record_copy(source=source, document=self, content_type=content_type, response=response)
 
     def get_file_path(self, content_type):
         """
@@ -69,44 +94,39 @@ class Document(models.Model):
         Returns a list of action types (Action.TYPE_CHOICES)
         the user is authorized to perform.
         """
-        available_actions = []
-        
-        latest_action = self.actions.first() # Action table is ordered by timestamp
-
-        if not latest_action:
-            return []
-
-        if latest_action.from_user == user_profile:
-            if latest_action.type == Action.CREATE:
-                # available_actions.append(Action.SUBMIT)
-                # available_actions.append(Action.REQUEST_REVIEW)
-                available_actions.append(Action.DELETE)
-            elif latest_action.type == Action.COUNTER:
-                available_actions.append(Action.SUBMIT)
-            elif latest_action.type == Action.REVIEW and user_profile.is_attorney:
-                available_actions.append(Action.SUBMIT)
-
-        elif latest_action.to_user == user_profile:
-            if latest_action.type == Action.SUBMIT:
-                available_actions.append(Action.ACCEPT)
-                available_actions.append(Action.DECLINE)
-                available_actions.append(Action.COUNTER)
-                available_actions.append(Action.REQUEST_REVIEW)
-                
-                if latest_action.from_user.is_attorney:
-                    available_actions.append(Action.CREATE)
-
-            elif latest_action.type == Action.REQUEST_REVIEW and user_profile.is_attorney:
-                available_actions.append(Action.REVIEW)
-
-            elif latest_action.type == Action.ACCEPT:
-                available_actions.append(Action.REQUEST_REVIEW)
-                available_actions.append(Action.SIGN)
-            
-            elif latest_action.type == Action.SIGN:
-                available_actions.append(Action.SIGN)
-            
-        return available_actions
+        if self.available_actions is None:
+            # not materialized yet, i.e. no action since the field was added
+            latest_action = self.actions.first() # Action table is ordered by timestamp
+            return get_transitions(latest_action, user_profile) if latest_action else []
+
+        return self.available_actions.get(str(user_profile.id), [])
+
+    def can_perform(self, user_profile: UserProfile, action_type: str) -> bool:
+        return action_type in self.get_available_actions(user_profile)
+
+    def is_editable_by(self, user_profile: UserProfile) -> bool:
+        if self.available_actions is None:
+            latest_action = self.actions.first()
+            return bool(latest_action) \
+                and latest_action.from_user_id == user_profile.id \
+                and latest_action.type in EDITABLE_AFTER
+
+        return self.editable_by_id == user_profile.id
+
+    def update_available_actions(self):
+        """Materializes the available actions of the participants and the editor from the latest action."""
+        latest_action = self.actions.select_related('from_user', 'to_user').first()
+
+        self.available_actions = {}
+        self.editable_by = None
+        if latest_action:
+            for participant in (latest_action.from_user, latest_action.to_user):
+                if participant:
+                    self.available_actions[str(participant.id)] = get_transitions(latest_action, participant)
+            if latest_action.type in EDITABLE_AFTER:
+                self.editable_by = latest_action.from_user
+
+        self.save(update_fields=['available_actions', 'editable_by'])
     
     def get_to_user(self, from_user: UserProfile, is_attorney: bool = False) -> UserProfile | None:
         """
@@ -132,18 +152,134 @@ class Document(models.Model):
     def get_history(root_id: str, queryset, user_profile: UserProfile) -> dict:
         """Returns the document history for a document root id."""
         # get all documents belonging to the same history
-        documents = queryset.filter(root_id=root_id)
-        if not documents:
-            return {}
+        histories = Document.get_histories(queryset.filter(root_id=root_id), user_profile)
+        return histories[0] if histories else {}
 
-        to_user = documents[0].get_to_user(from_user=user_profile, is_attorney=False)
-        recipient_name = to_user.full_name if to_user else None
+    @staticmethod
+    def get_histories(queryset, user_profile: UserProfile) -> List[dict]:
+        """
+        Returns the document histories in a queryset, grouped by root document
+        in the order of the queryset.
 
-        return {
-            'documents': documents,
-            'available_actions': documents[0].get_available_actions(user_profile),
-            'recipient_name': recipient_name
-        }
+        Uses a constant number of queries however many histories there are,
+        as long as the queryset prefetches the actions (see DocumentViewSet.get_queryset).
+        """
+        documents_by_root_id: dict = {}
+        for document in queryset:
+            documents_by_root_id.setdefault(document.root_id, []).append(document)
+
+        to_users = Document.get_to_users(documents_by_root_id.keys(), from_user=user_profile, is_attorney=False)
+
+        histories = []
+        for root_id, documents in documents_by_root_id.items():
+            to_user = to_users.get(root_id)
+            histories.append({
+                'documents': documents,
+                'available_actions': documents[0].get_available_actions(user_profile),
+                'recipient_name': to_user.full_name if to_user else None
+            })
+        return histories
+
+    @staticmethod
+    def get_to_users(root_ids, from_user: UserProfile, is_attorney: bool = False) -> dict:
+        """
+        Returns the to_user (see get_to_user) of several document histories
+        with two queries, keyed by root id.
+        """
+        actions = list(
+            Action.objects
+                .filter(document__root_id__in=root_ids)
+                .order_by('timestamp')
+                .values_list('document__root_id', 'from_user_id', 'to_user_id')
+        )
+
+        user_profile_ids = set()
+        for _, from_user_id, to_user_id in actions:
+            user_profile_ids.update((from_user_id, to_user_id))
+        user_profile_ids.discard(None)
+        user_profile_ids.discard(from_user.id)
+
+        user_profiles = UserProfile.objects.filter(id__in=user_profile_ids, is_attorney=is_attorney).in_bulk()
+
+        to_users = {}
+        for root_id, from_user_id, to_user_id in actions:
+            if root_id in to_users:
+                continue
+            to_user = user_profiles.get(from_user_id) or user_profiles.get(to_user_id)
+            if to_user:
+                to_users[root_id] = to_user
+        return to_users
+
+
+class DocumentBlob(models.Model):
+    """
+    A format of a document's content that is stored in S3.
+
+    Recorded whenever the content is written or copied, so reads can sign
+    urls without asking S3 which formats exist.  Documents from before
+    this table are filled in by the backfill_document_blobs command.
+    """
+    CONTENT_TYPE_CHOICES = (
+        (Document.JSON, 'JSON'),
+        (Document.HTML, 'HTML'),
+        (Document.PDF, 'PDF')
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='blobs')
+    content_type = models.CharField(max_length=30, choices=CONTENT_TYPE_CHOICES)
+    size = models.BigIntegerField(null=True, blank=True, help_text="Size in bytes, if known")
+    etag = models.CharField(max_length=100, blank=True)
+    last_modified = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'content_type'], name='document_blob_content_type_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.document_id} ({self.content_type})"
+
+    @staticmethod
+    def record(document: Document, content_type: str, size: int | None = None, etag: str = '', last_modified=None) -> 'DocumentBlob':
+        blob, _ = DocumentBlob.objects.update_or_create(
+            document=document,
+            content_type=content_type,
+            defaults={
+                'size': size,
+                'etag': etag.strip('"'),
+                'last_modified': last_modified or timezone.now()
+            }
+        )
+        return blob
+
+    @staticmethod
+    def record_metadata(document: Document, content_type: str, metadata: dict) -> 'DocumentBlob':
+        """Records a format from an S3 head_object response."""
+        return DocumentBlob.record(
+            document=document,
+            content_type=content_type,
+            size=metadata.get('ContentLength'),
+            etag=metadata.get('ETag') or '',
+            last_modified=metadata.get('LastModified')
+        )
+
+    @staticmethod
+    def record_copy(source: Document, document: Document, content_type: str, response: dict | None = None) -> 'DocumentBlob':
+        """
+        Records a format copied from another document, the copy has the same size and etag.
+        The etag and time of the copy are taken from the copy_object response if there is one.
+        """
+        source_blob = source.blobs.filter(content_type=content_type).first()
+        result = (response or {}).get('CopyObjectResult') or {}
+        return DocumentBlob.record(
+            document=document,
+            content_type=content_type,
+            size=source_blob.size if source_blob else None,
+            etag=result.get('ETag') or (source_blob.etag if source_blob else ''),
+            last_modified=result.get('LastModified')
+        )
 
 
 class Action(models.Model):
@@ -190,7 +326,7 @@ class Action(models.Model):
         
     def save(self, *args, **kwargs):
         if not self.to_user:
-            return super().save(*args, **kwargs)
+            return self.save_to_chain(*args, **kwargs)
         
         # log a message  
         message = Message.objects.create(
@@ -214,7 +350,240 @@ class Action(models.Model):
             # TODO: add different wording for different types of actions
             # gmail_send_message(self.to_user.email, f"Offer {type}", f"<div>Hello {self.to_user.first_name},\n\n{self.from_user.full_name} {type} your offer.  Click here to view: {link}\n\nBest,\nPairDraft Team</div>")
     
-        super().save(*args, **kwargs)
+        self.save_to_chain(*args, **kwargs)
+
+    def save_to_chain(self, *args, **kwargs):
+        """
+        Saves the action, records it on the chain of its document
+        and updates the document's available actions in the same transaction.
+        """
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Chain.record_action(self)
+            self.document.update_available_actions()
+
+
+# The negotiation workflow.
+# (type of the latest action, side of the user in it) -> [(available action type, condition)]
+SENDER = 'sender'
+RECIPIENT = 'recipient'
+
+IS_ATTORNEY = 'is_attorney' # the user is an attorney
+SENT_BY_ATTORNEY = 'sent_by_attorney' # the latest action was sent by an attorney
+
+TRANSITIONS = {
+    (Action.CREATE, SENDER): [(Action.DELETE, None)],
+    (Action.COUNTER, SENDER): [(Action.SUBMIT, None)],
+    (Action.REVIEW, SENDER): [(Action.SUBMIT, IS_ATTORNEY)],
+    (Action.SUBMIT, RECIPIENT): [
+        (Action.ACCEPT, None),
+        (Action.DECLINE, None),
+        (Action.COUNTER, None),
+        (Action.REQUEST_REVIEW, None),
+        (Action.CREATE, SENT_BY_ATTORNEY)
+    ],
+    (Action.REQUEST_REVIEW, RECIPIENT): [(Action.REVIEW, IS_ATTORNEY)],
+    (Action.ACCEPT, RECIPIENT): [(Action.REQUEST_REVIEW, None), (Action.SIGN, None)],
+    (Action.SIGN, RECIPIENT): [(Action.SIGN, None)],
+}
+
+# the sender can edit the document after these actions
+EDITABLE_AFTER = {Action.CREATE, Action.COUNTER, Action.REVIEW}
+
+
+def get_transitions(latest_action: Action, user_profile: UserProfile) -> List[str]:
+    """Returns the action types available to the user after the latest action of a document (see TRANSITIONS)."""
+    if latest_action.from_user_id == user_profile.id:
+        side = SENDER
+    elif latest_action.to_user_id == user_profile.id:
+        side = RECIPIENT
+    else:
+        return []
+
+    def check(condition: str | None) -> bool:
+        if condition == IS_ATTORNEY:
+            return user_profile.is_attorney
+        if condition == SENT_BY_ATTORNEY:
+            return latest_action.from_user.is_attorney
+        return True
+
+    return [action_type for action_type, condition in TRANSITIONS.get((latest_action.type, side), []) if check(condition)]
+
+
+class Chain(models.Model):
+    """
+    A negotiation, i.e. all documents that share a root document.
+
+    Denormalizes the latest document and action of the history so reads
+    do not have to scan Action.  Kept up to date by Action.save,
+    existing histories are filled in by migration 0016.
+
+    last_activity_at is the time of the latest action of the negotiation,
+    including actions a participant was not part of (e.g. a counterparty's
+    review request), so every participant sees the same order.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    root = models.OneToOneField(Document, on_delete=models.CASCADE, related_name='chain')
+    latest_document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    latest_action = models.ForeignKey(Action, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    participants = models.ManyToManyField('users.UserProfile', blank=True, related_name='chains')
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at', '-id'], name='chain_last_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.root.title} ({self.last_activity_at})"
+
+    @staticmethod
+    def record_action(action: Action):
+        """Updates the chain of the action's document, call inside a transaction."""
+        root_id = action.document.root_id or action.document_id
+        chain, _ = Chain.objects.select_for_update().get_or_create(root_id=root_id)
+
+        if not chain.last_activity_at or action.timestamp >= chain.last_activity_at:
+            chain.latest_document_id = action.document_id
+            chain.latest_action = action
+            chain.last_activity_at = action.timestamp
+            chain.save(update_fields=['latest_document', 'latest_action', 'last_activity_at'])
+
+        chain.participants.add(*[user_id for user_id in (action.from_user_id, action.to_user_id) if user_id])
+
+    def get_to_user(self, from_user: UserProfile, is_attorney: bool = False) -> UserProfile | None:
+        """
+        Returns the to_user for a from_user from the prefetched participants (see Document.get_to_user).
+
+        The counterparty of the latest action if the from_user was part of it,
+        otherwise the participant with the lowest id, so it does not change between requests.
+        """
+        participants = {
+            participant.id: participant for participant in self.participants.all()
+            if participant.id != from_user.id and participant.is_attorney == is_attorney
+        }
+        action = self.latest_action
+        if action and from_user.id in (action.from_user_id, action.to_user_id):
+            for user_id in (action.from_user_id, action.to_user_id):
+                if user_id in participants:
+                    return participants[user_id]
+        return participants[min(participants)] if participants else None
+
+    @staticmethod
+    def get_histories(chains, documents, user_profile: UserProfile) -> List[dict]:
+        """
+        Returns the document histories of the chains in the order of the chains.
+
+        chains should prefetch the participants and documents the actions,
+        documents without actions are left out.
+        """
+        chains = list(chains)
+        documents_by_root_id: dict = {chain.root_id: [] for chain in chains}
+        for document in documents.filter(root_id__in=documents_by_root_id.keys()):
+            if document.actions.all():
+                documents_by_root_id[document.root_id].append(document)
+
+        histories = []
+        for chain in chains:
+            documents = documents_by_root_id[chain.root_id]
+            if not documents:
+                continue
+
+            # the most recently active document first
+            documents.sort(key=lambda document: document.actions.all()[0].timestamp, reverse=True)
+            to_user = chain.get_to_user(from_user=user_profile, is_attorney=False)
+            histories.append({
+                'documents': documents,
+                'available_actions': documents[0].get_available_actions(user_profile),
+                'recipient_name': to_user.full_name if to_user else None
+            })
+        return histories
+
+
+class PdfExport(models.Model):
+    """
+    A job that exports the HTML content of a document to a PDF (see documents.exports).
+
+    PDFs are stored by content hash, so documents with unchanged content
+    reuse the PDF of an earlier export.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed')
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='pdf_exports')
+    requested_by = models.ForeignKey('users.UserProfile', on_delete=models.SET_NULL, null=True, blank=True, related_name='pdf_exports')
+    content_hash = models.CharField(max_length=100, help_text="Etag of the exported HTML content")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_hash', 'status'], name='pdf_export_content_hash_idx'),
+            models.Index(fields=['status', 'created'], name='pdf_export_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.document_id} ({self.status})"
+
+    def get_file_path(self) -> str:
+        return f"exports/{self.content_hash}.pdf"
+
+    def get_source_path(self, content_type: str) -> str:
+        """Returns the path of the snapshot of the exported content, which the engine reads."""
+        return f"exports/{self.content_hash}.{'json' if content_type == Document.JSON else 'html'}"
+
+
+class OrphanedObject(models.Model):
+    """
+    An S3 object of a deleted document or property.  Queued with attempts 0 in the
+    deleting transaction and removed once the object is deleted (see pairdraft.cleanup),
+    objects that could not be deleted are deleted again by the reconcile_orphaned_objects command.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    bucket = models.CharField(max_length=63)
+    key = models.CharField(max_length=1024)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=1, help_text="Number of cleanups that failed to delete the object")
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'key'], name='orphaned_object_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket}/{self.key}"
+
+    @staticmethod
+    def queue(bucket: str, keys: list[str]):
+        """Queues the keys for deletion, keys that are already queued or orphaned are kept as they are."""
+        OrphanedObject.objects.bulk_create(
+            [OrphanedObject(bucket=bucket, key=key, attempts=0) for key in keys],
+            ignore_conflicts=True
+        )
+
+    @staticmethod
+    def record(bucket: str, errors: dict[str, str]):
+        """Records the keys that could not be deleted, by their errors."""
+        for key, error in errors.items():
+            orphan, created = OrphanedObject.objects.get_or_create(bucket=bucket, key=key, defaults={'error': error})
+            if not created:
+                orphan.error = error
+                orphan.attempts = models.F('attempts') + 1
+                orphan.save(update_fields=['error', 'attempts', 'updated'])
 
 
 # TODO: deprecate
@@ -0,0 +1,378 @@
+"""
+Renders Lexical documents to PDF without any third-party service.
+
+Supports what documents are written with: paragraphs, headings, quotes,
+nested ordered and unordered lists, line breaks and bold, italic, underlined
+and struck through text.  Text is set in the standard Helvetica fonts on
+letter pages, so no fonts are embedded and characters outside of
+Windows-1252 are replaced.
+
+Does not import Django, so it can run in the processes of a process pool.
+"""
+
+import re
+import zlib
+
+PAGE_WIDTH = 612 # letter, in points
+PAGE_HEIGHT = 792
+MARGIN = 72
+
+FONT_SIZE = 11
+LINE_HEIGHT = 1.3
+PARAGRAPH_SPACING = 6
+LIST_INDENT = 24
+MARKER_GAP = 6
+HEADING_SIZES = {'h1': 20, 'h2': 16, 'h3': 13, 'h4': 12, 'h5': 11, 'h6': 11}
+
+# lexical text formats
+IS_BOLD = 1
+IS_ITALIC = 1 << 1
+IS_STRIKETHROUGH = 1 << 2
+IS_UNDERLINE = 1 << 3
+
+FONTS = {
+    'F1': 'Helvetica',
+    'F2': 'Helvetica-Bold',
+    'F3': 'Helvetica-Oblique',
+    'F4': 'Helvetica-BoldOblique',
+}
+
+# widths of the characters 32 to 126 in thousandths of the font size (Adobe's font metrics),
+# oblique fonts have the same widths as upright ones
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+# widths of frequent characters beyond ASCII, (regular, bold)
+_EXTRA_WIDTHS = {
+    '‘': (222, 278), '’': (222, 278), '“': (333, 500), '”': (333, 500),
+    '–': (556, 556), '—': (1000, 1000), '•': (350, 350), '…': (1000, 1000),
+    '§': (556, 556), '¶': (537, 556), '©': (737, 737), '®': (737, 737),
+    '°': (400, 400), '½': (834, 834), ' ': (278, 278),
+}
+DEFAULT_WIDTH = 556
+
+BULLET = '•'
+
+
+def to_alpha(number: int) -> str:
+    letters = ''
+    while number > 0:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def to_roman(number: int) -> str:
+    numerals = [
+        (1000, 'M'), (900, 'CM'), (500, 'D'), (400, 'CD'), (100, 'C'), (90, 'XC'),
+        (50, 'L'), (40, 'XL'), (10, 'X'), (9, 'IX'), (5, 'V'), (4, 'IV'), (1, 'I'),
+    ]
+    roman = ''
+    for value, numeral in numerals:
+        count, number = divmod(number, value)
+        roman += numeral * count
+    return roman
+
+
+# the markers of ordered lists by depth, as in the editor's theme (ol1 to ol5)
+OL_MARKERS = [
+    str,
+    to_alpha,
+    lambda number: to_alpha(number).lower(),
+    to_roman,
+    lambda number: to_roman(number).lower(),
+]
+
+
+def get_font(format: int) -> str:
+    bold, italic = format & IS_BOLD, format & IS_ITALIC
+    if bold and italic:
+        return 'F4'
+    if bold:
+        return 'F2'
+    if italic:
+        return 'F3'
+    return 'F1'
+
+
+def get_text_width(text: str, font: str, size: float) -> float:
+    bold = font in ('F2', 'F4')
+    widths = _HELVETICA_BOLD_WIDTHS if bold else _HELVETICA_WIDTHS
+    total = 0
+    for char in text:
+        code = ord(char)
+        if 32 <= code <= 126:
+            total += widths[code - 32]
+        elif char in _EXTRA_WIDTHS:
+            total += _EXTRA_WIDTHS[char][bold]
+        else:
+            total += DEFAULT_WIDTH
+    return total * size / 1000
+
+
+def encode_text(text: str) -> bytes:
+    """Returns the text as a PDF string literal in WinAnsiEncoding."""
+    encoded = text.encode('cp1252', errors='replace')
+    escaped = bytearray(b'(')
+    for byte in encoded:
+        if byte in b'()\\':
+            escaped += b'\\' + bytes([byte])
+        elif byte < 32 or byte > 126:
+            escaped += b'\\%03o' % byte
+        else:
+            escaped.append(byte)
+    escaped += b')'
+    return bytes(escaped)
+
+
+class Block:
+    """A paragraph of runs of text, laid out into lines at an indent."""
+
+    def __init__(self, indent: float = 0, size: float = FONT_SIZE, align: str = '', marker: str = '', base_format: int = 0):
+        self.indent = indent
+        self.size = size
+        self.align = align
+        self.marker = marker
+        self.base_format = base_format
+        self.runs = [] # (text, format), '\n' for line breaks
+
+    def add_text(self, text: str, format: int):
+        self.runs.append((text, format | self.base_format))
+
+    def add_line_break(self):
+        self.runs.append(('\n', 0))
+
+    def layout(self, width: float) -> list[list[tuple]]:
+        """Returns the lines of the block, each a list of (x, text, font, format) from the block's left edge."""
+        lines = [[]]
+        x = 0
+        for text, format in self.runs:
+            if text == '\n':
+                lines.append([])
+                x = 0
+                continue
+
+            font = get_font(format)
+            for token in re.findall(r'\s+|\S+', text.replace('\t', '    ')):
+                is_space = token.isspace()
+                if is_space:
+                    token = ' ' * len(token.replace('\n', ' '))
+                    if not lines[-1]:
+                        continue # no spaces at the start of a line
+
+                token_width = get_text_width(token, font, self.size)
+                if x + token_width > width and lines[-1] and not is_space:
+                    lines.append([])
+                    x = 0
+
+                # words wider than the page are broken at the margin
+                while not is_space and token_width > width - x and len(token) > 1:
+                    cut = len(token) - 1
+                    while cut > 1 and get_text_width(token[:cut], font, self.size) > width - x:
+                        cut -= 1
+                    lines[-1].append((x, token[:cut], font, format))
+                    lines.append([])
+                    x = 0
+                    token = token[cut:]
+                    token_width = get_text_width(token, font, self.size)
+
+                lines[-1].append((x, token, font, format))
+                x += token_width
+
+        return [merge_segments(line) for line in lines]
+
+
+def merge_segments(line: list[tuple]) -> list[tuple]:
+    """Joins adjacent segments of the same format and drops trailing spaces."""
+    merged = []
+    for x, text, font, format in line:
+        if merged and merged[-1][2] == font and merged[-1][3] == format:
+            merged[-1] = (merged[-1][0], merged[-1][1] + text, font, format)
+        else:
+            merged.append((x, text, font, format))
+    if merged:
+        x, text, font, format = merged[-1]
+        merged[-1] = (x, text.rstrip(' '), font, format)
+    return merged
+
+
+def get_blocks(root: dict) -> list[Block]:
+    """Flattens the lexical node tree into blocks of text."""
+    blocks = []
+
+    def add_inline(node: dict, block: Block):
+        node_type = node.get('type')
+        if node_type == 'del': # suggested deletions are not part of the exported text, insertions are
+            return
+        if 'text' in node and 'children' not in node: # text, text-with-key, mention and other text nodes
+            block.add_text(node.get('text') or '', node.get('format', 0) or 0)
+        elif node_type == 'linebreak':
+            block.add_line_break()
+        elif node_type == 'tab':
+            block.add_text('    ', 0)
+        else: # links, comment marks, insertions and other inline elements
+            for child in node.get('children', []):
+                add_inline(child, block)
+
+    def add_block(node: dict, indent: float = 0, list_depth: int = 0):
+        node_type = node.get('type')
+        children = node.get('children', [])
+        align = node.get('format') if isinstance(node.get('format'), str) else ''
+        indent += (node.get('indent', 0) or 0) * LIST_INDENT if node_type in ('paragraph', 'heading', 'quote') else 0
+
+        if node_type == 'root':
+            for child in children:
+                add_block(child, indent)
+        elif node_type == 'list':
+            ordered = node.get('listType', 'bullet') == 'number' or node.get('tag') == 'ol'
+            number = node.get('start', 1) or 1
+            for child in children:
+                nested = child.get('children', [])
+                if nested and all(grandchild.get('type') == 'list' for grandchild in nested):
+                    # a wrapper of a nested list, without a marker of its own
+                    for grandchild in nested:
+                        add_block(grandchild, indent + LIST_INDENT, list_depth + 1)
+                    continue
+                number = child.get('value', number) or number
+                marker = OL_MARKERS[list_depth % len(OL_MARKERS)](number) + '.' if ordered else BULLET
+                add_list_item(child, indent + LIST_INDENT, list_depth, marker)
+                number += 1
+        elif node_type in ('paragraph', 'heading', 'quote'):
+            size = HEADING_SIZES.get(node.get('tag'), FONT_SIZE) if node_type == 'heading' else FONT_SIZE
+            base_format = IS_BOLD if node_type == 'heading' else IS_ITALIC if node_type == 'quote' else 0
+            if node_type == 'quote':
+                indent += LIST_INDENT
+            block = Block(indent=indent, size=size, align=align, base_format=base_format)
+            for child in children:
+                add_inline(child, block)
+            blocks.append(block)
+        else:
+            block = Block(indent=indent)
+            add_inline(node, block)
+            blocks.append(block)
+
+    def add_list_item(node: dict, indent: float, list_depth: int, marker: str):
+        block = Block(indent=indent, marker=marker)
+        blocks.append(block)
+        for child in node.get('children', []):
+            if child.get('type') == 'list':
+                add_block(child, indent, list_depth + 1)
+            else:
+                if block is not blocks[-1]: # text after a nested list
+                    block = Block(indent=indent)
+                    blocks.append(block)
+                add_inline(child, block)
+
+    add_block(root)
+    return blocks
+
+
+class PDFWriter:
+    """Lays blocks out on pages and writes the PDF file."""
+
+    def __init__(self):
+        self.pages = [] # content streams
+        self.operations = []
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def new_page(self):
+        if self.operations:
+            self.pages.append(b'\n'.join(self.operations))
+        self.operations = []
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def add_block(self, block: Block):
+        left = MARGIN + block.indent
+        width = PAGE_WIDTH - MARGIN - left
+        line_height = block.size * LINE_HEIGHT
+
+        for index, line in enumerate(block.layout(width)):
+            if self.y - line_height < MARGIN:
+                self.new_page()
+            self.y -= line_height
+            baseline = self.y + (line_height - block.size) / 2 + block.size * 0.2
+
+            offset = 0
+            if line and block.align in ('center', 'right'):
+                last_x, last_text, last_font, _ = line[-1]
+                line_width = last_x + get_text_width(last_text, last_font, block.size)
+                offset = width - line_width if block.align == 'right' else (width - line_width) / 2
+
+            if index == 0 and block.marker:
+                marker_width = get_text_width(block.marker, 'F1', block.size)
+                self.add_text(left - MARKER_GAP - marker_width, baseline, block.marker, 'F1', block.size, 0)
+
+            for x, text, font, format in line:
+                self.add_text(left + offset + x, baseline, text, font, block.size, format)
+
+        self.y -= PARAGRAPH_SPACING
+
+    def add_text(self, x: float, y: float, text: str, font: str, size: float, format: int):
+        if not text:
+            return
+        self.operations.append(b'BT /%s %g Tf %.2f %.2f Td %s Tj ET' % (font.encode(), size, x, y, encode_text(text)))
+
+        width = get_text_width(text, font, size)
+        if format & IS_UNDERLINE:
+            self.operations.append(b'%.2f %.2f %.2f %.2f re f' % (x, y - size * 0.15, width, size * 0.05))
+        if format & IS_STRIKETHROUGH:
+            self.operations.append(b'%.2f %.2f %.2f %.2f re f' % (x, y + size * 0.3, width, size * 0.05))
+
+    def write(self) -> bytes:
+        self.new_page()
+        if not self.pages:
+            self.pages.append(b'')
+
+        # 1 catalog, 2 pages, then the fonts, then a page and its content for each page
+        font_ids = {name: 3 + index for index, name in enumerate(FONTS)}
+        first_page_id = 3 + len(FONTS)
+        page_ids = [first_page_id + index * 2 for index in range(len(self.pages))]
+
+        fonts = b' '.join(b'/%s %d 0 R' % (name.encode(), object_id) for name, object_id in font_ids.items())
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % page_id for page_id in page_ids), len(page_ids)),
+        ]
+        for name in FONTS.values():
+            objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % name.encode())
+        for page_id, content in zip(page_ids, self.pages):
+            objects.append(
+                b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << %s >> >> /Contents %d 0 R >>'
+                % (PAGE_WIDTH, PAGE_HEIGHT, fonts, page_id + 1)
+            )
+            stream = zlib.compress(content)
+            objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream))
+
+        output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for object_id, body in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += b'%d 0 obj\n%s\nendobj\n' % (object_id, body)
+
+        xref = len(output)
+        output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        for offset in offsets:
+            output += b'%010d 00000 n \n' % offset
+        output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return bytes(output)
+
+
+def render_pdf(data: dict) -> bytes:
+    """Returns the PDF of a serialized lexical editor state, i.e. the JSON content of a document."""
+    writer = PDFWriter()
+    for block in get_blocks(data.get('root', {})):
+        writer.add_block(block)
+    return writer.write()
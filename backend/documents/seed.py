@@ -1,7 +1,7 @@
 import json
 
 from pairdraft.aws_manager import aws_manager, BUCKETS
-from documents.models import Document, Action
+from documents.models import Document, DocumentBlob, Action
 
 
 def mock_document(from_user: 'users.UserProfile', to_user: 'users.UserProfile', property: 'properties.Property'):
@@ -14,12 +14,19 @@ def mock_document(from_user: 'users.UserProfile', to_user: 'users.UserProfile',
     with open('documents/purchase_agreement.json', 'r') as file:
         data = json.load(file)
 
-        aws_manager.upload_object(
+        body = json.dumps(data)
+        response = aws_manager.upload_object(
             bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
             file_path=document.get_file_path(content_type=Document.JSON),
-            body=json.dumps(data),
+            body=body,
             content_type=Document.JSON
         )
+        DocumentBlob.record(
+            document=document,
+            content_type=Document.JSON,
+            size=len(body.encode('utf-8')),
+            etag=response.get('ETag', '')
+        )
 
     Action.objects.create(
         type=Action.CREATE,
@@ -29,6 +29,28 @@ class DocumentSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'root', 'actions', 'property', 'property_address')
 
 
+class DocumentSiblingSerializer(serializers.ModelSerializer):
+    """Compact representation of a document in a history, expects the actions to be prefetched."""
+    latest_action_type = serializers.SerializerMethodField()
+    latest_action_timestamp = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Document
+        fields = ('id', 'title', 'latest_action_type', 'latest_action_timestamp')
+
+    def get_latest_action(self, document: Document) -> Action | None:
+        actions = document.actions.all() # ordered by timestamp
+        return actions[0] if actions else None
+
+    def get_latest_action_type(self, document: Document) -> str | None:
+        latest_action = self.get_latest_action(document)
+        return latest_action.type if latest_action else None
+
+    def get_latest_action_timestamp(self, document: Document):
+        latest_action = self.get_latest_action(document)
+        return serializers.DateTimeField().to_representation(latest_action.timestamp) if latest_action else None
+
+
 class CommentSerializer(serializers.ModelSerializer):
     author = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all(), write_only=True)
     author_details = UserProfileSerializerAbbreviated(source='author', read_only=True)
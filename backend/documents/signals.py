@@ -2,28 +2,52 @@ import logging
 logger = logging.getLogger('django')
 
 from django.dispatch import receiver
-from django.db.models.signals import post_delete
-from django.db import connection
+from django.db.models.signals import post_delete, pre_save, post_save
 
-from pairdraft.aws_manager import aws_manager, BUCKETS
-from documents.models import Document
+from pairdraft.aws_manager import BUCKETS
+from pairdraft.cleanup import delete_objects_on_commit
+from documents import yjs
+from documents.models import Document, PdfExport
+from users.models import UserProfile
 
 
 @receiver(post_delete, sender=Document)
 def document_post_delete(sender, instance, **kwargs):
     # Perform actions after Document object is deleted
-    logger.info(f"Deleting document {instance.id} in S3...")
-
-    for content_type in [Document.JSON, Document.HTML, Document.PDF]:
-        aws_manager.delete_object(
-            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-            key=instance.get_file_path(content_type=content_type)
-        )
-    logger.info(f"Deleted document {instance.id} in S3.")
-
-    with connection.cursor() as cursor:
-        cursor.execute(
-            "DELETE FROM \"yjs-writings\" WHERE docname = %s",
-            [str(instance.id)]
-        )
-        logger.info(f"Deleted {cursor.rowcount} rows in yjs-writings table.")
+    # the S3 objects are deleted once the transaction commits, in batches with other deleted documents
+    delete_objects_on_commit(
+        bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        keys=[instance.get_file_path(content_type=content_type) for content_type in [Document.JSON, Document.HTML, Document.PDF]]
+    )
+
+    deleted = yjs.delete_updates(instance.id)
+    logger.info(f"Deleted {deleted} rows in yjs-writings table.")
+
+
+@receiver(post_delete, sender=PdfExport)
+def pdf_export_post_delete(sender, instance, **kwargs):
+    # PDFs are shared by the exports of the same content, delete one with its last export
+    if PdfExport.objects.filter(content_hash=instance.content_hash).exists():
+        return
+    delete_objects_on_commit(
+        bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+        keys=[instance.get_file_path()] + [instance.get_source_path(content_type) for content_type in [Document.JSON, Document.HTML]]
+    )
+
+
+@receiver(pre_save, sender=UserProfile)
+def user_profile_pre_save(sender, instance, **kwargs):
+    # the available actions of the user's documents depend on is_attorney (see documents.models.TRANSITIONS)
+    previous = UserProfile.objects.filter(id=instance.id).values_list('is_attorney', flat=True).first()
+    instance._is_attorney_changed = previous is not None and previous != instance.is_attorney
+
+
+@receiver(post_save, sender=UserProfile)
+def user_profile_post_save(sender, instance, **kwargs):
+    # re-materialize the documents the user is a participant of the latest action of
+    if not getattr(instance, '_is_attorney_changed', False):
+        return
+    documents = Document.objects.filter(available_actions__has_key=str(instance.id))
+    for document in documents:
+        document.update_available_actions()
+    logger.info(f"Updated the available actions of {len(documents)} documents of user profile {instance.id}")
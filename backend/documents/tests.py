@@ -1,17 +1,42 @@
+import csv
+import json
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from typing import Optional
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, AsyncMock
+from urllib.parse import parse_qs, urlparse
 
-from django.test import TestCase
+from botocore.exceptions import ClientError
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.utils import timezone
+import pycrdt
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
 from users import util as users_util
 from properties.tests import create_test_property
+from pairdraft import cleanup
+from pairdraft.aws_manager import aws_manager, BUCKETS
 from tokens.models import DocumentToken
-from documents.models import Document, Action
+from documents import audit as documents_audit, exports, lexical, migration, pdf, yjs
+from documents.api import adobe as adobe_api
+from documents.models import Document, DocumentBlob, PdfExport, OrphanedObject, Action, Chain
 from documents.permissions import IsAuthorizedDocument
 from documents.views import DocumentViewSet
+from pairdraft.routing import websocket_urlpatterns
 
 
 # TODO: fix
@@ -304,3 +329,1301 @@ class SubmitTest(TestCase):
             f'{self.from_user.full_name}! ' +
             f'Click the link below to view the document:\n\n{link}\n\nBest,\nPairDraft Team'
         )
+
+
+class DocumentHistoryListTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com', first_name='Buyer', last_name='One')
+        _, cls.seller_user_profile = users_util.create_user('seller@pairdraft.com', first_name='Seller', last_name='Two')
+        cls.property = create_test_property()
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.view = DocumentViewSet.as_view({'get': 'list'})
+
+    def create_history(self):
+        """The buyer submits an offer and the seller counters it."""
+        offer = Document.objects.create(title='Offer', property=self.property)
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, type=Action.CREATE)
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, to_user=self.seller_user_profile, type=Action.SUBMIT)
+
+        counter = offer.create_copy([Document.JSON])
+        Action.objects.create(document=counter, from_user=self.seller_user_profile, type=Action.COUNTER)
+        Action.objects.create(document=counter, from_user=self.seller_user_profile, to_user=self.buyer_user_profile, type=Action.SUBMIT)
+        return offer, counter
+
+    def list_documents(self, params=None):
+        request = self.factory.get('/documents/', params)
+        request.user = self.buyer
+        with CaptureQueriesContext(connection) as queries:
+            response = self.view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    @patch('documents.models.aws_manager')
+    def test_groups_documents_by_history(self, aws_manager_mock):
+        offer, counter = self.create_history()
+
+        response, _ = self.list_documents()
+
+        self.assertEqual(len(response.data), 1)
+        history = response.data[0]
+        self.assertEqual(history['document']['id'], str(counter.id))
+        self.assertEqual([document['id'] for document in history['history']], [str(counter.id), str(offer.id)])
+        self.assertEqual(history['recipient_name'], 'Seller Two')
+        self.assertEqual(
+            history['available_actions'],
+            [Action.ACCEPT, Action.DECLINE, Action.COUNTER, Action.REQUEST_REVIEW]
+        )
+        self.assertEqual(history['document']['property_address']['address'], self.property.address)
+
+    @patch('documents.models.aws_manager')
+    def test_query_count_does_not_grow_with_histories(self, aws_manager_mock):
+        self.create_history()
+        _, queries_for_one = self.list_documents()
+
+        for _ in range(5):
+            self.create_history()
+        response, queries_for_six = self.list_documents()
+
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(queries_for_one, queries_for_six)
+
+    @patch('documents.models.aws_manager')
+    def test_sorted_by_last_activity(self, aws_manager_mock):
+        first_offer, _ = self.create_history()
+        second_offer, _ = self.create_history()
+
+        response, _ = self.list_documents()
+        self.assertEqual([str(history['document']['root']) for history in response.data], [str(second_offer.id), str(first_offer.id)])
+
+        # the seller accepts the first offer
+        Action.objects.create(document=first_offer, from_user=self.seller_user_profile, to_user=self.buyer_user_profile, type=Action.ACCEPT)
+
+        response, _ = self.list_documents()
+        self.assertEqual([str(history['document']['root']) for history in response.data], [str(first_offer.id), str(second_offer.id)])
+
+    @patch('documents.models.aws_manager')
+    def test_cursor_pagination(self, aws_manager_mock):
+        offers = [self.create_history()[0] for _ in range(3)]
+
+        response, _ = self.list_documents({'page_size': 2})
+        self.assertEqual([str(history['document']['root']) for history in response.data['results']], [str(offers[2].id), str(offers[1].id)])
+        self.assertIsNone(response.data['previous'])
+
+        cursor = parse_qs(urlparse(response.data['next']).query)
+        self.assertEqual(cursor['page_size'], ['2'])
+        response, _ = self.list_documents({'page_size': 2, 'cursor': cursor['cursor'][0]})
+        self.assertEqual([str(history['document']['root']) for history in response.data['results']], [str(offers[0].id)])
+        self.assertIsNone(response.data['next'])
+
+    @patch('documents.models.aws_manager')
+    def test_cursor_pagination_with_the_same_activity(self, aws_manager_mock):
+        for _ in range(3):
+            self.create_history()
+        Chain.objects.update(last_activity_at=timezone.now())
+
+        roots = []
+        params = {'page_size': 2}
+        while True:
+            response, _ = self.list_documents(params)
+            roots += [str(history['document']['root']) for history in response.data['results']]
+            if not response.data['next']:
+                break
+            params['cursor'] = parse_qs(urlparse(response.data['next']).query)['cursor'][0]
+        self.assertEqual(roots, [str(root_id) for root_id in Chain.objects.order_by('-id').values_list('root_id', flat=True)])
+
+    @patch('documents.models.aws_manager')
+    def test_summary_leaves_out_history(self, aws_manager_mock):
+        _, counter = self.create_history()
+
+        response, _ = self.list_documents({'summary': 'true'})
+
+        history = response.data[0]
+        self.assertNotIn('history', history)
+        self.assertEqual(history['document']['id'], str(counter.id))
+        self.assertEqual(history['recipient_name'], 'Seller Two')
+
+
+class ChainTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+        _, cls.seller_user_profile = users_util.create_user('seller@pairdraft.com')
+
+    @patch('documents.models.aws_manager')
+    def test_action_updates_chain(self, aws_manager_mock):
+        offer = Document.objects.create(title='Offer')
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, type=Action.CREATE)
+        counter = offer.create_copy([Document.JSON])
+        submit = Action.objects.create(document=counter, from_user=self.buyer_user_profile, to_user=self.seller_user_profile, type=Action.SUBMIT)
+
+        chain = Chain.objects.get(root=offer)
+        self.assertEqual(chain.latest_document, counter)
+        self.assertEqual(chain.latest_action, submit)
+        self.assertEqual(chain.last_activity_at, submit.timestamp)
+        self.assertEqual(set(chain.participants.all()), {self.buyer_user_profile, self.seller_user_profile})
+
+    @patch('documents.models.aws_manager')
+    def test_to_user_is_the_counterparty_of_the_latest_action(self, aws_manager_mock):
+        _, other_buyer_user_profile = users_util.create_user('other-buyer@pairdraft.com')
+        offer = Document.objects.create(title='Offer')
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, type=Action.CREATE)
+        Action.objects.create(document=offer, from_user=other_buyer_user_profile, to_user=self.buyer_user_profile, type=Action.SUBMIT)
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, to_user=self.seller_user_profile, type=Action.SUBMIT)
+
+        chain = Chain.objects.prefetch_related('participants').get(root=offer)
+        self.assertEqual(chain.get_to_user(from_user=self.buyer_user_profile), self.seller_user_profile)
+        self.assertEqual(chain.get_to_user(from_user=self.seller_user_profile), self.buyer_user_profile)
+        # not part of the latest action
+        self.assertEqual(
+            chain.get_to_user(from_user=other_buyer_user_profile),
+            min(self.buyer_user_profile, self.seller_user_profile, key=lambda user_profile: user_profile.id)
+        )
+
+    def test_backfill_chains(self):
+        offer = Document.objects.create(title='Offer')
+        Action.objects.create(document=offer, from_user=self.buyer_user_profile, type=Action.CREATE)
+        submit = Action.objects.create(document=offer, from_user=self.buyer_user_profile, to_user=self.seller_user_profile, type=Action.SUBMIT)
+        Chain.objects.all().delete() # i.e. histories from before the Chain model
+
+        call_command('backfill_chains', stdout=StringIO())
+        call_command('backfill_chains', stdout=StringIO()) # refreshes the existing chain
+
+        chain = Chain.objects.get(root=offer)
+        self.assertEqual(chain.latest_action, submit)
+        self.assertEqual(chain.last_activity_at, submit.timestamp)
+        self.assertEqual(set(chain.participants.all()), {self.buyer_user_profile, self.seller_user_profile})
+
+
+class DocumentBlobTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.document = Document.objects.create(title='Offer')
+        Action.objects.create(document=self.document, from_user=self.buyer_user_profile, type=Action.CREATE)
+
+    def retrieve(self):
+        request = self.factory.get(f'/documents/{self.document.id}/')
+        request.user = self.buyer
+        response = DocumentViewSet.as_view({'get': 'retrieve'})(request, pk=str(self.document.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    @patch.object(aws_manager, 's3_client')
+    def test_retrieve_signs_url_without_s3_requests(self, s3_client_mock):
+        s3_client_mock.generate_presigned_url.return_value = 'https://example.com/presigned_url'
+        DocumentBlob.record(document=self.document, content_type=Document.HTML)
+        DocumentBlob.record(document=self.document, content_type=Document.JSON, size=10, etag='"abc"')
+
+        response = self.retrieve()
+
+        self.assertEqual(response.data['presigned_url'], 'https://example.com/presigned_url')
+        self.assertEqual(response.data['content_type'], Document.JSON)
+        self.assertNotIn('needs_migration', response.data)
+        s3_client_mock.head_object.assert_not_called()
+
+    @patch.object(aws_manager, 's3_client')
+    def test_retrieve_falls_back_to_html(self, s3_client_mock):
+        DocumentBlob.record(document=self.document, content_type=Document.HTML)
+
+        response = self.retrieve()
+        self.assertEqual(response.data['content_type'], Document.HTML)
+        self.assertTrue(response.data['needs_migration'])
+
+        s3_client_mock.head_object.assert_not_called()
+
+        # neither format is stored
+        self.document.blobs.all().delete()
+        s3_client_mock.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        response = self.retrieve()
+        self.assertIsNone(response.data['presigned_url'])
+        self.assertIsNone(response.data['content_type'])
+        self.assertEqual(s3_client_mock.head_object.call_count, 2)
+
+    @patch.object(aws_manager, 's3_client')
+    def test_retrieve_records_format_of_document_without_blobs(self, s3_client_mock):
+        json_path = self.document.get_file_path(Document.JSON)
+        def head_object(Bucket, Key):
+            if Key == json_path:
+                raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {'ContentLength': 20, 'ETag': '"html"', 'LastModified': timezone.now()}
+        s3_client_mock.head_object.side_effect = head_object
+
+        response = self.retrieve()
+        self.assertEqual(response.data['content_type'], Document.HTML)
+        self.assertTrue(response.data['needs_migration'])
+        blob = self.document.blobs.get()
+        self.assertEqual((blob.content_type, blob.size, blob.etag), (Document.HTML, 20, 'html'))
+
+        # recorded, so the next request signs the url without S3 requests
+        s3_client_mock.head_object.reset_mock()
+        self.retrieve()
+        s3_client_mock.head_object.assert_not_called()
+
+    @patch('documents.models.aws_manager')
+    def test_create_copy_records_format(self, aws_manager_mock):
+        DocumentBlob.record(document=self.document, content_type=Document.JSON, size=10, etag='"abc"')
+        DocumentBlob.record(document=self.document, content_type=Document.HTML, size=20, etag='"def"')
+        aws_manager_mock.copy_objects.side_effect = lambda copies: [{'CopyObjectResult': {'ETag': '"abc"'}}, None]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy = self.document.create_copy()
+            # copied once the transaction commits
+            aws_manager_mock.copy_objects.assert_not_called()
+
+        # the recorded formats are copied in one batch
+        copies = aws_manager_mock.copy_objects.call_args.args[0]
+        self.assertEqual([destination for _, _, _, destination in copies], [copy.get_file_path(Document.JSON), copy.get_file_path(Document.HTML)])
+
+        # the HTML does not exist in S3
+        blob = copy.blobs.get()
+        self.assertEqual((blob.content_type, blob.size, blob.etag), (Document.JSON, 10, 'abc'))
+
+    @patch('documents.models.aws_manager')
+    def test_create_copy_without_recorded_formats(self, aws_manager_mock):
+        aws_manager_mock.copy_objects.side_effect = lambda copies: [None, {'CopyObjectResult': {'ETag': '"html"'}}, None]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy = self.document.create_copy()
+
+        self.assertEqual(len(aws_manager_mock.copy_objects.call_args.args[0]), 3)
+        blob = copy.blobs.get()
+        self.assertEqual((blob.content_type, blob.etag), (Document.HTML, 'html'))
+
+    @patch('documents.views.aws_manager')
+    def test_uploaded_records_metadata(self, aws_manager_mock):
+        last_modified = timezone.now()
+        aws_manager_mock.get_object_metadata.return_value = {'ContentLength': 42, 'ETag': '"def"', 'LastModified': last_modified}
+
+        request = self.factory.post(f'/documents/{self.document.id}/uploaded/', {'content_type': Document.JSON}, format='json')
+        request.user = self.buyer
+        response = DocumentViewSet.as_view({'post': 'uploaded'})(request, pk=str(self.document.id))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        blob = self.document.blobs.get()
+        self.assertEqual((blob.content_type, blob.size, blob.etag, blob.last_modified), (Document.JSON, 42, 'def', last_modified))
+
+    @patch('documents.management.commands.backfill_document_blobs.aws_manager')
+    def test_backfill_document_blobs(self, aws_manager_mock):
+        aws_manager_mock.get_object_metadata.side_effect = lambda bucket, file_path: \
+            {'ContentLength': 5, 'ETag': '"ghi"'} if file_path.endswith('.html') else None
+
+        call_command('backfill_document_blobs', '--dry-run', stdout=StringIO())
+        self.assertFalse(self.document.blobs.exists())
+
+        call_command('backfill_document_blobs', stdout=StringIO())
+        self.assertEqual([blob.content_type for blob in self.document.blobs.all()], [Document.HTML])
+
+
+class FormatDocumentTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+        _, cls.seller_user_profile = users_util.create_user('seller@pairdraft.com')
+        cls.property = create_test_property()
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.offer = Document.objects.create(title='Offer', property=self.property)
+        Action.objects.create(document=self.offer, from_user=self.buyer_user_profile, type=Action.CREATE)
+
+        # the offer has no stored formats
+        aws_manager_patcher = patch('documents.views.aws_manager')
+        aws_manager_patcher.start().get_object_metadata.return_value = None
+        self.addCleanup(aws_manager_patcher.stop)
+
+    def create_counter(self):
+        with patch('documents.models.aws_manager'):
+            counter = self.offer.create_copy([Document.JSON])
+        Action.objects.create(document=counter, from_user=self.buyer_user_profile, to_user=self.seller_user_profile, type=Action.SUBMIT)
+        return counter
+
+    def retrieve(self, params=None):
+        request = self.factory.get(f'/documents/{self.offer.id}/', params)
+        request.user = self.buyer
+        with CaptureQueriesContext(connection) as queries:
+            response = DocumentViewSet.as_view({'get': 'retrieve'})(request, pk=str(self.offer.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_compact_documents(self):
+        counter = self.create_counter()
+
+        response, _ = self.retrieve()
+
+        self.assertEqual([document['id'] for document in response.data['documents']], [str(counter.id), str(self.offer.id)])
+        self.assertEqual(response.data['documents'][0]['title'], 'Offer')
+        self.assertEqual(response.data['documents'][0]['latest_action_type'], Action.SUBMIT)
+        self.assertIsNotNone(response.data['documents'][0]['latest_action_timestamp'])
+        self.assertNotIn('actions', response.data['documents'][0])
+
+    def test_expand_history(self):
+        counter = self.create_counter()
+
+        response, _ = self.retrieve({'expand': 'history'})
+
+        self.assertEqual(response.data['documents'][0]['id'], str(counter.id))
+        self.assertEqual(response.data['documents'][0]['actions'][0]['to_user']['id'], str(self.seller_user_profile.id))
+        self.assertEqual(response.data['documents'][0]['property_address']['address'], self.property.address)
+
+    def test_query_count_does_not_grow_with_documents(self):
+        self.create_counter()
+        _, compact_queries_for_two = self.retrieve()
+        _, expanded_queries_for_two = self.retrieve({'expand': 'history'})
+
+        for _ in range(3):
+            self.create_counter()
+        _, compact_queries_for_five = self.retrieve()
+        _, expanded_queries_for_five = self.retrieve({'expand': 'history'})
+
+        self.assertEqual(compact_queries_for_two, compact_queries_for_five)
+        self.assertEqual(expanded_queries_for_two, expanded_queries_for_five)
+
+
+class AvailableActionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+        _, cls.seller_user_profile = users_util.create_user('seller@pairdraft.com')
+        _, cls.attorney_user_profile = users_util.create_user('attorney@pairdraft.com')
+        cls.attorney_user_profile.is_attorney = True
+        cls.attorney_user_profile.save()
+
+    def setUp(self):
+        self.document = Document.objects.create(title='Offer')
+
+    def act(self, type: str, from_user, to_user=None) -> Document:
+        Action.objects.create(document=self.document, type=type, from_user=from_user, to_user=to_user)
+        return Document.objects.get(id=self.document.id)
+
+    def test_materialized_on_each_action(self):
+        document = self.act(Action.CREATE, self.buyer_user_profile)
+        self.assertEqual(document.get_available_actions(self.buyer_user_profile), [Action.DELETE])
+        self.assertTrue(document.is_editable_by(self.buyer_user_profile))
+
+        document = self.act(Action.SUBMIT, self.buyer_user_profile, self.seller_user_profile)
+        with self.assertNumQueries(0):
+            self.assertEqual(document.get_available_actions(self.buyer_user_profile), [])
+            self.assertEqual(
+                document.get_available_actions(self.seller_user_profile),
+                [Action.ACCEPT, Action.DECLINE, Action.COUNTER, Action.REQUEST_REVIEW]
+            )
+            self.assertTrue(document.can_perform(self.seller_user_profile, Action.ACCEPT))
+            self.assertFalse(document.can_perform(self.attorney_user_profile, Action.ACCEPT))
+            self.assertFalse(document.is_editable_by(self.buyer_user_profile))
+
+        document = self.act(Action.ACCEPT, self.seller_user_profile, self.buyer_user_profile)
+        self.assertEqual(document.get_available_actions(self.buyer_user_profile), [Action.REQUEST_REVIEW, Action.SIGN])
+
+    def test_conditions(self):
+        document = self.act(Action.SUBMIT, self.attorney_user_profile, self.seller_user_profile)
+        self.assertIn(Action.CREATE, document.get_available_actions(self.seller_user_profile))
+
+        document = self.act(Action.REQUEST_REVIEW, self.seller_user_profile, self.attorney_user_profile)
+        self.assertEqual(document.get_available_actions(self.attorney_user_profile), [Action.REVIEW])
+
+        document = self.act(Action.REQUEST_REVIEW, self.attorney_user_profile, self.buyer_user_profile)
+        self.assertEqual(document.get_available_actions(self.buyer_user_profile), [])
+
+    def test_rematerialized_when_is_attorney_changes(self):
+        self.act(Action.REQUEST_REVIEW, self.buyer_user_profile, self.seller_user_profile)
+
+        self.seller_user_profile.is_attorney = True
+        self.seller_user_profile.save()
+
+        document = Document.objects.get(id=self.document.id)
+        self.assertEqual(document.get_available_actions(self.seller_user_profile), [Action.REVIEW])
+
+    def test_falls_back_to_latest_action(self):
+        self.act(Action.SUBMIT, self.buyer_user_profile, self.seller_user_profile)
+        Document.objects.filter(id=self.document.id).update(available_actions=None, editable_by=None)
+        document = Document.objects.get(id=self.document.id)
+
+        self.assertEqual(document.get_available_actions(self.seller_user_profile)[0], Action.ACCEPT)
+
+        call_command('backfill_available_actions', stdout=StringIO())
+        document = Document.objects.get(id=self.document.id)
+        self.assertEqual(document.available_actions[str(self.seller_user_profile.id)][0], Action.ACCEPT)
+
+
+@override_settings(PDF_EXPORT_IN_PROCESS=False, PDF_EXPORT_POLL_INTERVAL=0, PDF_EXPORT_ENGINE='adobe')
+class PdfExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.document = Document.objects.create(title='Offer')
+        Action.objects.create(document=self.document, from_user=self.buyer_user_profile, type=Action.CREATE)
+        DocumentBlob.record(document=self.document, content_type=Document.HTML, etag='"abc"')
+
+        aws_manager_patcher = patch('documents.exports.aws_manager')
+        self.aws_manager = aws_manager_patcher.start()
+        self.aws_manager.generate_presigned_url.return_value = 'https://example.com/presigned_url'
+        self.addCleanup(aws_manager_patcher.stop)
+
+        html_to_pdf_patcher = patch.object(adobe_api.adobe_client, 'html_to_pdf', return_value='job')
+        self.html_to_pdf = html_to_pdf_patcher.start()
+        self.addCleanup(html_to_pdf_patcher.stop)
+
+        get_job_status_patcher = patch.object(adobe_api.adobe_client, 'get_job_status', side_effect=['in progress', 'done'])
+        self.get_job_status = get_job_status_patcher.start()
+        self.addCleanup(get_job_status_patcher.stop)
+
+    def download_url(self, document):
+        request = self.factory.get(f'/documents/{document.id}/download_url/')
+        request.user = self.buyer
+        return DocumentViewSet.as_view({'get': 'download_url'})(request, pk=str(document.id))
+
+    @patch('documents.exports.get_channel_layer')
+    def test_exports_in_the_background_and_reuses_the_pdf(self, get_channel_layer_mock):
+        get_channel_layer_mock.return_value.group_send = AsyncMock()
+
+        response = self.download_url(self.document)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], PdfExport.PENDING)
+        self.assertIsNone(response.data['url'])
+        self.html_to_pdf.assert_not_called()
+
+        # requesting it again while it is pending does not queue another export
+        self.assertEqual(self.download_url(self.document).data['id'], response.data['id'])
+
+        self.assertEqual(exports.process_exports(), 1)
+        export = PdfExport.objects.get(id=response.data['id'])
+        self.assertEqual(export.status, PdfExport.DONE)
+        self.assertEqual(self.get_job_status.call_count, 2)
+        get_channel_layer_mock.return_value.group_send.assert_awaited_once_with(exports.get_group_name(export.id), {'type': 'export.finished'})
+
+        response = self.download_url(self.document)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['url'], 'https://example.com/presigned_url')
+
+        # a copy with the same content is not exported again
+        with patch('documents.models.aws_manager') as models_aws_manager, self.captureOnCommitCallbacks(execute=True):
+            models_aws_manager.copy_objects.return_value = [{}]
+            copy = self.document.create_copy([Document.HTML])
+        Action.objects.create(document=copy, from_user=self.buyer_user_profile, type=Action.COUNTER)
+        response = self.download_url(copy)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.html_to_pdf.assert_called_once()
+
+        # the reused export is found for the copy
+        request = self.factory.get(f'/documents/{copy.id}/exports/{export.id}/')
+        request.user = self.buyer
+        response = DocumentViewSet.as_view({'get': 'export'})(request, pk=str(copy.id), export_id=str(export.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], PdfExport.DONE)
+
+    @patch('documents.exports.get_channel_layer')
+    def test_exports_a_snapshot_of_the_hashed_content(self, get_channel_layer_mock):
+        get_channel_layer_mock.return_value.group_send = AsyncMock()
+        # the document was saved since its etag was recorded
+        self.aws_manager.copy_object.side_effect = [None, {}]
+        self.aws_manager.get_object_metadata.return_value = {'ETag': '"def"'}
+
+        export = PdfExport.objects.get(id=self.download_url(self.document).data['id'])
+        self.assertEqual(export.content_hash, 'def')
+        self.aws_manager.get_object_metadata.assert_called_once_with(
+            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value, file_path=self.document.get_file_path(Document.HTML), cached=False
+        )
+        self.aws_manager.copy_object.assert_called_with(
+            source_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            source_file_path=self.document.get_file_path(Document.HTML),
+            destination_bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            destination_file_path='exports/def.html',
+            if_match='def'
+        )
+
+        with patch('pairdraft.cleanup.OrphanedObject.queue') as queue:
+            exports.process_exports()
+        self.assertEqual(self.aws_manager.generate_presigned_url.call_args_list[0].kwargs['method_parameters']['Key'], 'exports/def.html')
+        queue.assert_called_once_with(BUCKETS.PAIRDRAFT_DOCUMENTS.value, ['exports/def.html'])
+
+    @patch('documents.exports.get_channel_layer')
+    def test_failed_export(self, get_channel_layer_mock):
+        get_channel_layer_mock.return_value.group_send = AsyncMock()
+        self.get_job_status.side_effect = ['failed']
+
+        export_id = self.download_url(self.document).data['id']
+        exports.process_exports()
+
+        request = self.factory.get(f'/documents/{self.document.id}/exports/{export_id}/')
+        request.user = self.buyer
+        response = DocumentViewSet.as_view({'get': 'export'})(request, pk=str(self.document.id), export_id=export_id)
+        self.assertEqual(response.data['status'], PdfExport.FAILED)
+        self.assertEqual(response.data['error'], 'Job job failed.')
+
+    def test_document_without_html(self):
+        self.document.blobs.all().delete()
+        self.aws_manager.get_object_metadata.return_value = None
+
+        self.assertEqual(self.download_url(self.document).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(PDF_EXPORT_ENGINE='adobe')
+class ExportConsumerTest(TransactionTestCase):
+    def setUp(self):
+        self.user, self.user_profile = users_util.create_user('buyer@pairdraft.com')
+        self.document = Document.objects.create(title='Offer')
+        self.export = PdfExport.objects.create(document=self.document, requested_by=self.user_profile, content_hash='abc')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/exports/{self.export.id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @patch('documents.exports.aws_manager')
+    @patch.object(adobe_api.adobe_client, 'html_to_pdf', return_value='job')
+    @patch.object(adobe_api.adobe_client, 'get_job_status', return_value='done')
+    async def test_sends_result_when_finished(self, get_job_status_mock, html_to_pdf_mock, aws_manager_mock):
+        aws_manager_mock.generate_presigned_url.return_value = 'https://example.com/presigned_url'
+
+        communicator = await self.connect(self.user)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await database_sync_to_async(exports.run_exports)([self.export])
+
+        data = await communicator.receive_json_from()
+        self.assertEqual(data['status'], PdfExport.DONE)
+        self.assertEqual(data['url'], 'https://example.com/presigned_url')
+        await communicator.disconnect()
+
+    async def test_rejects_other_users(self):
+        other_user, _ = await database_sync_to_async(users_util.create_user)('seller@pairdraft.com')
+
+        communicator = await self.connect(other_user)
+        output = await communicator.receive_output()
+        self.assertEqual(output['type'], 'websocket.close')
+
+
+def get_page_contents(body: bytes) -> list[str]:
+    return [zlib.decompress(stream).decode('latin-1') for stream in re.findall(rb'stream\n(.*?)\nendstream', body, re.S)]
+
+
+def create_lexical_state(*children) -> dict:
+    return {'root': {'type': 'root', 'children': list(children)}}
+
+
+def create_text(text: str, format: int = 0) -> dict:
+    return {'type': 'text', 'text': text, 'format': format}
+
+
+class RenderPdfTest(TestCase):
+    def test_purchase_agreement(self):
+        with open('documents/purchase_agreement.json', 'r') as file:
+            body = pdf.render_pdf(json.load(file))
+
+        self.assertTrue(body.startswith(b'%PDF-1.4'))
+        self.assertTrue(body.endswith(b'%%EOF\n'))
+
+        # every object is where the cross-reference table says
+        xref = int(body.rsplit(b'startxref\n', 1)[1].split(b'\n')[0])
+        offsets = [int(line[:10]) for line in body[xref:].split(b'\n')[3:] if line.endswith(b' n ')]
+        for object_id, offset in enumerate(offsets, start=1):
+            self.assertTrue(body[offset:].startswith(b'%d 0 obj' % object_id))
+
+        pages = get_page_contents(body)
+        self.assertGreater(len(pages), 1)
+        self.assertIn(b'/Count %d' % len(pages), body)
+        # markers of the first three list levels
+        self.assertIn('(1.) Tj', pages[0])
+        self.assertIn('(A.) Tj', pages[0])
+        self.assertIn('(a.) Tj', pages[0])
+        self.assertIn('(Offer) Tj', pages[0])
+
+    def test_wraps_lines_within_margins(self):
+        block = pdf.Block()
+        block.add_text('word ' * 200, 0)
+
+        lines = block.layout(width=200)
+        self.assertGreater(len(lines), 1)
+        for line in lines:
+            x, text, font, format = line[-1]
+            self.assertLessEqual(x + pdf.get_text_width(text, font, block.size), 200)
+            self.assertFalse(text.endswith(' '))
+
+    def test_text_formats(self):
+        body = pdf.render_pdf(create_lexical_state({
+            'type': 'paragraph',
+            'children': [
+                create_text('bold', pdf.IS_BOLD),
+                create_text('underlined', pdf.IS_UNDERLINE),
+                {'type': 'linebreak'},
+                create_text('(“quoted”) ✓'),
+            ]
+        }))
+
+        content = get_page_contents(body)[0]
+        self.assertIn('/F2 11 Tf', content)
+        self.assertIn('(bold) Tj', content)
+        self.assertIn('re f', content)
+        self.assertIn('(\\(\\223quoted\\224\\) ?) Tj', content)
+
+    def test_editor_nodes(self):
+        # as saved by the editor, with TextNodeWithKey, mentions and suggested changes
+        body = pdf.render_pdf(create_lexical_state({
+            'type': 'paragraph',
+            'children': [
+                {**create_text('Offer for'), 'type': 'text-with-key'},
+                {**create_text(' 123 Main St'), 'type': 'del'},
+                {'type': 'ins', 'children': [{**create_text(' 456 Oak Ave'), 'type': 'text-with-key'}]},
+                {**create_text(' by @Buyer'), 'type': 'mention', 'mentionName': 'Buyer'},
+            ]
+        }))
+
+        content = get_page_contents(body)[0]
+        self.assertIn('(Offer for 456 Oak Ave by @Buyer) Tj', content)
+        self.assertNotIn('Main St', content)
+
+    def test_empty_document(self):
+        body = pdf.render_pdf(create_lexical_state())
+        self.assertIn(b'/Count 1', body)
+
+
+@override_settings(PDF_EXPORT_IN_PROCESS=False, PDF_EXPORT_ENGINE='local', PDF_EXPORT_PROCESSES=0)
+class LocalEngineTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.document = Document.objects.create(title='Offer')
+        Action.objects.create(document=self.document, from_user=self.buyer_user_profile, type=Action.CREATE)
+        DocumentBlob.record(document=self.document, content_type=Document.JSON, etag='"offer"')
+
+        aws_manager_patcher = patch('documents.exports.aws_manager')
+        self.aws_manager = aws_manager_patcher.start()
+        self.aws_manager.download_object.return_value = json.dumps(create_lexical_state({
+            'type': 'paragraph',
+            'children': [create_text('Purchase Price')]
+        }))
+        self.addCleanup(aws_manager_patcher.stop)
+
+        channel_layer_patcher = patch('documents.exports.get_channel_layer')
+        channel_layer_patcher.start().return_value.group_send = AsyncMock()
+        self.addCleanup(channel_layer_patcher.stop)
+
+    def download_urls(self, document):
+        request = self.factory.get(f'/documents/{document.id}/download_urls/')
+        request.user = self.buyer
+        return DocumentViewSet.as_view({'get': 'download_urls'})(request, pk=str(document.id))
+
+    def test_exports_negotiation_as_one_batch(self):
+        counter = Document.objects.create(title='Offer', root=self.document)
+        Action.objects.create(document=counter, from_user=self.buyer_user_profile, type=Action.COUNTER)
+        DocumentBlob.record(document=counter, content_type=Document.JSON, etag='"counter"')
+
+        response = self.download_urls(counter)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(set(response.data), {str(self.document.id), str(counter.id)})
+
+        with patch('documents.exports.claim_exports', wraps=exports.claim_exports) as claim_exports_mock:
+            self.assertEqual(exports.process_exports(), 2)
+        self.assertEqual(len(claim_exports_mock.call_args_list), 2) # the batch and the check for more
+
+        keys = sorted(call.kwargs['file_path'] for call in self.aws_manager.upload_object.call_args_list)
+        self.assertEqual(keys, ['exports/counter.pdf', 'exports/offer.pdf'])
+        for call in self.aws_manager.upload_object.call_args_list:
+            self.assertTrue(call.kwargs['body'].startswith(b'%PDF'))
+            self.assertEqual(call.kwargs['content_type'], Document.PDF)
+
+        self.aws_manager.generate_presigned_url.return_value = 'https://example.com/presigned_url'
+        response = self.download_urls(self.document)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[str(counter.id)]['url'], 'https://example.com/presigned_url')
+
+    def test_missing_content(self):
+        self.aws_manager.download_object.return_value = None
+
+        export = exports.request_export(self.document, self.buyer_user_profile)
+        exports.process_exports()
+
+        export.refresh_from_db()
+        self.assertEqual(export.status, PdfExport.FAILED)
+        self.assertEqual(export.error, 'Document content not found.')
+
+    @override_settings(PDF_EXPORT_PROCESSES=1)
+    def test_renders_in_process_pool(self):
+        self.addCleanup(exports.LocalEngine.reset_pool)
+        export = exports.request_export(self.document, self.buyer_user_profile)
+
+        self.assertEqual(exports.get_engine().generate_many([export]), [None])
+        self.assertIsNotNone(exports.LocalEngine._pool)
+        self.assertTrue(self.aws_manager.upload_object.call_args.kwargs['body'].startswith(b'%PDF'))
+
+
+@override_settings(S3_CLEANUP_DELAY=0, S3_CLEANUP_RETRY_INTERVAL=0)
+class ObjectCleanupTest(TestCase):
+    def setUp(self):
+        self.document = Document.objects.create(title='Offer')
+
+        aws_manager_patcher = patch('pairdraft.cleanup.aws_manager')
+        self.aws_manager = aws_manager_patcher.start()
+        self.aws_manager.delete_objects.return_value = {}
+        self.addCleanup(aws_manager_patcher.stop)
+
+    @patch('pairdraft.cleanup.ObjectCleaner.start')
+    def test_queues_objects_in_the_deleting_transaction(self, start_mock):
+        counter = Document.objects.create(title='Offer', root=self.document)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Document.objects.filter(id__in=[self.document.id, counter.id]).delete()
+            # queued with the delete, deleted in S3 once it commits
+            keys = set(OrphanedObject.objects.filter(attempts=0).values_list('key', flat=True))
+            self.assertIn(counter.get_file_path(Document.HTML), keys)
+            self.assertEqual(len(keys), 6)
+            start_mock.assert_not_called()
+
+        self.assertEqual(len(callbacks), 2)
+        start_mock.assert_called()
+        self.aws_manager.delete_objects.assert_not_called()
+
+    @patch('pairdraft.cleanup.ObjectCleaner.start')
+    def test_rolled_back_delete_keeps_objects(self, start_mock):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.document.delete()
+                    raise RuntimeError('rolled back')
+            except RuntimeError:
+                pass
+
+        self.assertFalse(OrphanedObject.objects.exists())
+        self.assertEqual(callbacks, [])
+
+    def test_drains_queue_in_batches_per_bucket(self):
+        OrphanedObject.queue('documents', [f'{i}/offer.json' for i in range(2500)])
+        OrphanedObject.queue('images', ['photo.jpg'])
+        # orphans that failed before are left to reconcile_orphaned_objects
+        OrphanedObject.record(bucket='documents', errors={'stale.json': 'Access Denied'})
+
+        with patch('pairdraft.cleanup.connection'): # run closes the connection of its thread
+            cleanup.ObjectCleaner.run()
+
+        batches = [(call.kwargs['bucket'], len(call.kwargs['keys'])) for call in self.aws_manager.delete_objects.call_args_list]
+        self.assertEqual(sorted(batches), [('documents', 500), ('documents', 1000), ('documents', 1000), ('images', 1)])
+        self.assertIsNone(cleanup.ObjectCleaner._thread)
+        self.assertEqual(list(OrphanedObject.objects.values_list('key', flat=True)), ['stale.json'])
+
+    @patch('pairdraft.cleanup.ObjectCleaner.start')
+    def test_deletes_shared_pdf_with_its_last_export(self, start_mock):
+        copy = Document.objects.create(title='Offer', root=self.document)
+        PdfExport.objects.create(document=self.document, content_hash='abc', status=PdfExport.DONE)
+        PdfExport.objects.create(document=copy, content_hash='abc', status=PdfExport.DONE)
+
+        copy.delete()
+        self.assertFalse(OrphanedObject.objects.filter(key='exports/abc.pdf').exists())
+
+        self.document.delete()
+        self.assertTrue(OrphanedObject.objects.filter(key='exports/abc.pdf', attempts=0).exists())
+
+    @override_settings(S3_CLEANUP_RETRIES=2)
+    def test_retries_and_records_orphans(self):
+        self.aws_manager.delete_objects.side_effect = [
+            Exception('Connection reset'),
+            {'b': 'Access Denied'},
+            {'b': 'Access Denied'},
+        ]
+
+        self.assertEqual(cleanup.delete_objects('documents', ['a', 'b']), {'b': 'Access Denied'})
+
+        # the failed key is retried on its own
+        self.assertEqual([call.kwargs['keys'] for call in self.aws_manager.delete_objects.call_args_list], [['a', 'b'], ['a', 'b'], ['b']])
+        orphan = OrphanedObject.objects.get()
+        self.assertEqual((orphan.bucket, orphan.key, orphan.error, orphan.attempts), ('documents', 'b', 'Access Denied', 1))
+
+    def test_reconcile_orphaned_objects(self):
+        OrphanedObject.record(bucket='documents', errors={'a': 'Access Denied', 'b': 'Access Denied'})
+        self.aws_manager.delete_objects.return_value = {'b': 'Access Denied'}
+
+        call_command('reconcile_orphaned_objects', '--dry-run', stdout=StringIO())
+        self.aws_manager.delete_objects.assert_not_called()
+
+        call_command('reconcile_orphaned_objects', stdout=StringIO())
+
+        orphan = OrphanedObject.objects.get()
+        self.assertEqual((orphan.key, orphan.attempts), ('b', 2))
+
+
+class AuditTest(TestCase):
+    def setUp(self):
+        self.offer = Document.objects.create(title='Offer')
+        self.legacy = Document.objects.create(title='Legacy Offer')
+        self.empty = Document.objects.create(title='Empty')
+        PdfExport.objects.create(document=self.offer, content_hash='done', status=PdfExport.DONE)
+
+        keys = [
+            self.offer.get_file_path(Document.JSON),
+            self.offer.get_file_path(Document.PDF),
+            self.legacy.get_file_path(Document.HTML),
+            '0e5b2a43-1c7d-4a8e-9f60-3b1d2c4e5f67/deleted.json',
+            'exports/done.pdf',
+            'exports/stale.pdf',
+            'Uploads/stray.html', # outside of the hexadecimal prefixes
+            'stray.txt',
+        ]
+        objects = [{'Key': key, 'Size': 10, 'ETag': '"etag"', 'LastModified': timezone.now()} for key in keys]
+
+        def paginate(Bucket, Prefix='', Delimiter=None):
+            contents = [obj for obj in objects if obj['Key'].startswith(Prefix)]
+            if Delimiter:
+                directories = sorted({obj['Key'].split(Delimiter)[0] + Delimiter for obj in contents if Delimiter in obj['Key']})
+                return [{'CommonPrefixes': [{'Prefix': directory} for directory in directories], 'Contents': [obj for obj in contents if Delimiter not in obj['Key']]}]
+            # two pages per prefix
+            return [{'Contents': contents[:1]}, {'Contents': contents[1:]}] if contents else [{}]
+
+        aws_manager_patcher = patch('documents.audit.aws_manager')
+        self.aws_manager = aws_manager_patcher.start()
+        self.paginate = self.aws_manager.s3_client.get_paginator.return_value.paginate
+        self.paginate.side_effect = paginate
+        self.addCleanup(aws_manager_patcher.stop)
+
+    def test_audit_documents(self):
+        audit = documents_audit.audit_documents()
+
+        # the top level and one listing per first character instead of a request per document and format
+        prefixes = sorted(call.kwargs.get('Prefix') for call in self.paginate.call_args_list if 'Delimiter' not in call.kwargs)
+        self.assertEqual(prefixes, sorted({'U', 'e', str(self.offer.id)[0], str(self.legacy.id)[0], '0'}))
+        statuses = {document.id: document.status for document in audit.documents}
+        self.assertEqual(statuses, {
+            str(self.offer.id): documents_audit.OK,
+            str(self.legacy.id): documents_audit.NEEDS_MIGRATION,
+            str(self.empty.id): documents_audit.MISSING,
+        })
+        offer = next(document for document in audit.documents if document.id == str(self.offer.id))
+        self.assertEqual(set(offer.formats), {Document.JSON, Document.PDF})
+        self.assertEqual(offer.formats[Document.JSON].etag, 'etag')
+
+        self.assertEqual({obj.key for obj in audit.orphaned}, {'0e5b2a43-1c7d-4a8e-9f60-3b1d2c4e5f67/deleted.json', 'exports/stale.pdf', 'Uploads/stray.html', 'stray.txt'})
+
+    def test_audit_some_documents(self):
+        audit = documents_audit.audit_documents(Document.objects.filter(id=self.legacy.id), prefixes=[f'{self.legacy.id}/'])
+
+        self.assertEqual([document.status for document in audit.documents], [documents_audit.NEEDS_MIGRATION])
+        self.assertEqual(audit.orphaned, [])
+
+    def test_audit_command_output(self):
+        output = StringIO()
+        call_command('audit_documents', '--format', 'json', stdout=output)
+        data = json.loads(output.getvalue())
+        self.assertEqual(data['summary'], {'documents': 3, 'ok': 1, 'needs_migration': 1, 'missing': 1, 'orphaned': 4})
+
+        output = StringIO()
+        call_command('audit_documents', '--format', 'csv', stdout=output)
+        rows = list(csv.DictReader(StringIO(output.getvalue())))
+        self.assertEqual(len(rows), 7)
+        legacy = next(row for row in rows if row['id'] == str(self.legacy.id))
+        self.assertEqual((legacy['status'], legacy['html'], legacy['json']), (documents_audit.NEEDS_MIGRATION, 'True', 'False'))
+
+        output = StringIO()
+        call_command('list_html_documents', '--check-s3', stdout=output)
+        self.assertIn(f'Legacy Offer (ID: {self.legacy.id})', output.getvalue())
+
+
+class LexicalTest(TestCase):
+    def convert(self, html):
+        return lexical.html_to_lexical(html)['root']['children']
+
+    def test_editor_html(self):
+        blocks = self.convert(
+            '<h1 class="h1" dir="ltr" style="text-align: center;"><span style="white-space: pre-wrap;">Offer</span></h1>'
+            '<p class="p" dir="ltr"><span style="white-space: pre-wrap;">On </span>'
+            '<b><strong class="textBold" style="white-space: pre-wrap;">[Date]</strong></b>'
+            '<span style="white-space: pre-wrap;">, see </span><a href="https://example.com"><span>terms</span></a></p>'
+        )
+
+        self.assertEqual((blocks[0]['type'], blocks[0]['tag'], blocks[0]['format']), ('heading', 'h1', 'center'))
+        paragraph = blocks[1]
+        self.assertEqual(paragraph['type'], 'paragraph')
+        self.assertEqual([(node.get('text'), node['format']) for node in paragraph['children'][:3]], [('On ', 0), ('[Date]', lexical.IS_BOLD), (', see ', 0)])
+        link = paragraph['children'][3]
+        self.assertEqual((link['type'], link['url'], link['children'][0]['text']), ('link', 'https://example.com', 'terms'))
+
+    def test_nested_lists(self):
+        blocks = self.convert('<ol><li>Offer</li><li><ol><li>Price</li></ol></li><li>Closing<br>Date</li></ol>')
+
+        items = blocks[0]['children']
+        self.assertEqual(blocks[0]['listType'], 'number')
+        self.assertEqual([item['value'] for item in items], [1, 2, 2])
+        nested = items[1]['children'][0]
+        self.assertEqual((nested['type'], nested['children'][0]['indent'], nested['children'][0]['children'][0]['text']), ('list', 1, 'Price'))
+        self.assertEqual([node['type'] for node in items[2]['children']], ['text', 'linebreak', 'text'])
+
+    def test_plain_html(self):
+        blocks = self.convert('<html><head><title>x</title></head><body>Loose <em>text</em><div><p>  A   paragraph </p></div></body></html>')
+
+        self.assertEqual([block['type'] for block in blocks], ['paragraph', 'paragraph'])
+        self.assertEqual([(node['text'], node['format']) for node in blocks[0]['children']], [('Loose ', 0), ('text', lexical.IS_ITALIC)])
+        self.assertEqual(blocks[1]['children'][0]['text'], 'A paragraph')
+        self.assertEqual(self.convert(''), [lexical.create_paragraph([])])
+
+
+class HtmlMigrationTest(TestCase):
+    def setUp(self):
+        self.legacy = Document.objects.create(title='Legacy Offer')
+        self.broken = Document.objects.create(title='Broken Offer')
+        self.migrated = Document.objects.create(title='Offer')
+        self.html = {
+            self.legacy.get_file_path(Document.HTML): '<p>Legacy <b>offer</b></p>',
+            self.broken.get_file_path(Document.HTML): None, # deleted since the listing
+        }
+        keys = list(self.html) + [self.migrated.get_file_path(Document.JSON)]
+        objects = [{'Key': key, 'Size': 10, 'ETag': '"etag"', 'LastModified': timezone.now()} for key in keys]
+
+        audit_patcher = patch('documents.audit.aws_manager')
+        audit_aws_manager = audit_patcher.start()
+        def paginate(Bucket, Prefix='', Delimiter=None):
+            if Delimiter: # all keys are in a "directory"
+                return [{'CommonPrefixes': [{'Prefix': prefix} for prefix in {obj['Key'].split(Delimiter)[0] + Delimiter for obj in objects}]}]
+            return [{'Contents': [obj for obj in objects if obj['Key'].startswith(Prefix)]}]
+        audit_aws_manager.s3_client.get_paginator.return_value.paginate.side_effect = paginate
+        self.addCleanup(audit_patcher.stop)
+
+        aws_manager_patcher = patch('documents.migration.aws_manager')
+        self.aws_manager = aws_manager_patcher.start()
+        self.aws_manager.download_object.side_effect = lambda bucket, file_path: self.html[file_path]
+        self.aws_manager.upload_object.return_value = {'ETag': '"json-etag"'}
+        self.addCleanup(aws_manager_patcher.stop)
+
+    def test_migrate(self):
+        documents = migration.find_documents()
+        self.assertEqual({document.id for document in documents}, {str(self.legacy.id), str(self.broken.id)})
+
+        metrics = migration.Migration(threads=2, processes=0).run(documents, batch_size=1)
+
+        self.assertEqual(metrics.results, {migration.MIGRATED: 1, migration.FAILED: 1})
+        self.assertEqual(self.aws_manager.upload_object.call_count, 1)
+        upload = self.aws_manager.upload_object.call_args.kwargs
+        self.assertEqual(upload['file_path'], self.legacy.get_file_path(Document.JSON))
+        self.assertTrue(upload['only_if_missing'])
+        data = json.loads(upload['body'])
+        self.assertEqual([node['text'] for node in data['root']['children'][0]['children']], ['Legacy ', 'offer'])
+
+        blob = DocumentBlob.objects.get(document=self.legacy, content_type=Document.JSON)
+        self.assertEqual((blob.etag, blob.size), ('json-etag', len(upload['body'])))
+        self.assertGreater(metrics.bytes_read, 0)
+
+    def test_skips_documents_saved_in_the_meantime(self):
+        self.aws_manager.upload_object.side_effect = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        documents = [document for document in migration.find_documents() if document.id == str(self.legacy.id)]
+
+        metrics = migration.Migration(processes=0).run(documents)
+
+        self.assertEqual(metrics.results, {migration.SKIPPED: 1})
+        self.assertFalse(DocumentBlob.objects.filter(document=self.legacy).exists())
+
+    @patch('documents.migration.CONVERSION_TIMEOUT', 0.1)
+    def test_recycles_pool_after_timeout(self):
+        self.html[self.legacy.get_file_path(Document.HTML)] = '<p>hang</p>'
+        self.html[self.broken.get_file_path(Document.HTML)] = '<p>Counter</p>'
+        # the hanging document first, so the other one is still pending in the pool when it times out
+        documents = sorted(migration.find_documents(), key=lambda document: document.id != str(self.legacy.id))
+        released = threading.Event()
+        self.addCleanup(released.set)
+        html_to_json = lexical.html_to_json
+        def convert(html):
+            if 'hang' in html:
+                released.wait()
+            return html_to_json(html)
+
+        results = []
+        run = migration.Migration(processes=0)
+        with patch('documents.lexical.html_to_json', side_effect=convert), patch.object(run, 'get_pool', wraps=run.get_pool) as get_pool:
+            run.run(documents, batch_size=2, on_batch=results.extend)
+
+        self.assertEqual(get_pool.call_count, 2)
+        statuses = {result.id: (result.status, result.error) for result in results}
+        self.assertEqual(statuses[str(self.legacy.id)], (migration.FAILED, 'Conversion timed out after 0.1 s'))
+        self.assertEqual(statuses[str(self.broken.id)], (migration.MIGRATED, ''))
+
+    def test_command_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = f'{directory}/migration.jsonl'
+
+            output = StringIO()
+            call_command('migrate_html_documents', '--dry-run', '--processes', '0', '--checkpoint', checkpoint, stdout=output)
+            self.assertIn('1 converted, 1 failed. This was a dry run', output.getvalue())
+            self.aws_manager.upload_object.assert_not_called()
+
+            call_command('migrate_html_documents', '--processes', '0', '--checkpoint', checkpoint, stdout=StringIO())
+            self.assertEqual(migration.read_checkpoint(checkpoint), {str(self.legacy.id): migration.MIGRATED, str(self.broken.id): migration.FAILED})
+
+            # the failed document is skipped unless retried
+            self.aws_manager.download_object.reset_mock()
+            output = StringIO()
+            call_command('migrate_html_documents', '--processes', '0', '--checkpoint', checkpoint, stdout=output)
+            self.assertIn('Nothing to migrate', output.getvalue())
+            self.aws_manager.download_object.assert_not_called()
+
+            call_command('migrate_html_documents', '--processes', '0', '--checkpoint', checkpoint, '--retry-failed', stdout=StringIO())
+            self.aws_manager.download_object.assert_called_once()
+
+
+class YjsCompactionTest(TestCase):
+    def setUp(self):
+        # as created by y-postgresql, the table does not exist in the test database
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                CREATE TABLE "{yjs.YJS_WRITINGS_TABLE}" (
+                    id SERIAL PRIMARY KEY,
+                    docname TEXT NOT NULL,
+                    value BYTEA NOT NULL,
+                    version TEXT NOT NULL CHECK (version IN ('v1', 'v1_sv'))
+                )
+            ''')
+
+        self.docname = str(uuid.uuid4())
+        self.doc = pycrdt.Doc()
+        self.text = self.doc.get('root', type=pycrdt.Text)
+        self.doc.observe(lambda event: self.store_update(event.update))
+        for word in ['Purchase ', 'agreement ', 'for ', '123 Main St']:
+            self.text += word
+
+    def store_update(self, update: bytes, version: str = yjs.UPDATE):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO "{yjs.YJS_WRITINGS_TABLE}" (docname, value, version) VALUES (%s, %s, %s)',
+                [self.docname, update, version]
+            )
+
+    def get_rows(self) -> list[tuple[int, bytes, str]]:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id, value, version FROM "{yjs.YJS_WRITINGS_TABLE}" WHERE docname = %s ORDER BY id', [self.docname])
+            return [(id, bytes(value), version) for id, value, version in cursor.fetchall()]
+
+    def load(self) -> str:
+        doc = pycrdt.Doc()
+        for _, value, version in self.get_rows():
+            if version == yjs.UPDATE:
+                doc.apply_update(value)
+        return str(doc.get('root', type=pycrdt.Text))
+
+    def test_compact_document(self):
+        self.store_update(yjs.encode_state_vector(b'\x00', 1), version=yjs.STATE_VECTOR)
+
+        result = yjs.compact_document(self.docname)
+
+        self.assertEqual(result.updates, 4)
+        rows = self.get_rows()
+        self.assertEqual([version for _, _, version in rows], [yjs.STATE_VECTOR, yjs.UPDATE])
+        self.assertEqual(self.load(), 'Purchase agreement for 123 Main St')
+        # the state vector covers the snapshot
+        state_vector, clock = yjs.decode_state_vector(rows[0][1])
+        self.assertEqual(clock, rows[1][0])
+        self.assertEqual(state_vector, self.doc.get_state())
+        self.assertIsNone(yjs.compact_document(self.docname))
+
+    def test_merges_updates_stored_while_compacting(self):
+        merge_updates = yjs.merge_updates
+
+        def merge_while_editing(*updates):
+            if len(updates) == 4:
+                self.text += ', Springfield' # stored by the server during the merge
+            return merge_updates(*updates)
+
+        with patch('documents.yjs.merge_updates', side_effect=merge_while_editing):
+            result = yjs.compact_document(self.docname)
+
+        self.assertEqual(result.updates, 5)
+        self.assertEqual(len(self.get_rows()), 2)
+        self.assertEqual(self.load(), 'Purchase agreement for 123 Main St, Springfield')
+
+    def test_skips_document_flushed_while_compacting(self):
+        merge_updates = yjs.merge_updates
+
+        def merge_while_flushing(*updates):
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM "{yjs.YJS_WRITINGS_TABLE}" WHERE id = %s', [self.get_rows()[0][0]])
+            return merge_updates(*updates)
+
+        with patch('documents.yjs.merge_updates', side_effect=merge_while_flushing):
+            self.assertIsNone(yjs.compact_document(self.docname))
+        self.assertEqual(len(self.get_rows()), 3)
+
+    def test_command(self):
+        output = StringIO()
+        call_command('compact_yjs_updates', '--dry-run', '--min-updates', '3', stdout=output)
+        self.assertIn(f'{self.docname}: 4 updates', output.getvalue())
+        self.assertEqual(len(self.get_rows()), 4)
+
+        output = StringIO()
+        call_command('compact_yjs_updates', '--min-updates', '3', stdout=output)
+        self.assertIn('yjs-writings: 4 rows of 1 documents', output.getvalue())
+        self.assertIn('yjs-writings after: 2 rows of 1 documents', output.getvalue())
+        self.assertIn('open time of 1 documents after', output.getvalue())
+        self.assertIn('Compacted 4 updates of 1 documents (0 skipped, 0 failed), 2 rows removed', output.getvalue())
+        self.assertEqual(self.load(), 'Purchase agreement for 123 Main St')
+
+
+class FakeRedis:
+    """The subset of the Redis client used to share the Adobe token, with expiries in whole seconds."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value, expires_at = self.values.get(key, (None, 0))
+        return value if expires_at > time.time() else None
+
+    def ttl(self, key):
+        value, expires_at = self.values.get(key, (None, 0))
+        return int(expires_at - time.time()) if expires_at > time.time() else -2
+
+    def set(self, key, value, ex):
+        self.values[key] = (value, time.time() + ex)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def pipeline(self):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.results = []
+
+            def get(self, key):
+                self.results.append(redis.get(key))
+                return self
+
+            def ttl(self, key):
+                self.results.append(redis.ttl(key))
+                return self
+
+            def execute(self):
+                return self.results
+
+        return Pipeline()
+
+
+class FakeAdobeHandler(BaseHTTPRequestHandler):
+    """Answers like PDF Services: a token, a job id and the statuses queued on the server."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status_code, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(self.path)
+        if self.path == '/token':
+            self.server.tokens_issued += 1
+            self.send(200, {'access_token': f'token-{self.server.tokens_issued}', 'token_type': 'bearer', 'expires_in': 86399})
+        elif self.headers['Authorization'] not in self.server.valid_authorizations():
+            self.send(401, {'error': 'invalid token'})
+        else:
+            self.send(201, {}, headers={'x-request-id': 'job'})
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.headers['Authorization'] not in self.server.valid_authorizations():
+            self.send(401, {'error': 'invalid token'})
+        else:
+            self.send(200, {'status': self.server.statuses.pop(0)})
+
+
+class FakeAdobeServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeAdobeHandler)
+        self.connections = 0
+        self.tokens_issued = 0
+        self.revoked = 0
+        self.requests = []
+        self.statuses = []
+
+    def valid_authorizations(self):
+        return {f'Bearer token-{i}' for i in range(self.revoked + 1, self.tokens_issued + 1)}
+
+
+class AdobePDFClientTest(TestCase):
+    def setUp(self):
+        self.server = FakeAdobeServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.redis = FakeRedis()
+        redis_patcher = patch('documents.api.adobe.redis_manager')
+        redis_patcher.start().r = self.redis
+        self.addCleanup(redis_patcher.stop)
+
+        self.client = self.create_client()
+
+    def create_client(self):
+        client = adobe_api.AdobePDFClient(base_url=f'http://127.0.0.1:{self.server.server_port}', client_id='id', client_secret='secret')
+        self.addCleanup(client.session.close)
+        return client
+
+    def export(self, client):
+        job_id = client.html_to_pdf('https://example.com/offer.html', 'https://example.com/offer.pdf')
+        client.wait_for_job(job_id, timeout=10, interval=0)
+        return job_id
+
+    def test_reuses_token_and_connection(self):
+        self.server.statuses = ['in progress', 'done', 'done']
+
+        self.assertEqual(self.export(self.client), 'job')
+        self.export(self.client)
+
+        # one token for both exports, all over one connection
+        self.assertEqual(self.server.requests.count('/token'), 1)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_shares_token_between_processes(self):
+        self.server.statuses = ['done', 'done']
+        self.export(self.client)
+        self.export(self.create_client())
+
+        self.assertEqual(self.server.tokens_issued, 1)
+        self.assertLess(self.redis.ttl(adobe_api.AdobePDFClient.TOKEN_KEY), 86399 - adobe_api.AdobePDFClient.TOKEN_EXPIRY_MARGIN + 1)
+
+    def test_fetches_new_token_when_rejected(self):
+        self.server.statuses = ['done']
+        self.client.get_access_token()
+        self.server.revoked = 1
+
+        self.export(self.client)
+
+        self.assertEqual(self.server.tokens_issued, 2)
+        self.assertEqual(self.client.token, 'token-2')
+        self.assertEqual(self.redis.get(adobe_api.AdobePDFClient.TOKEN_KEY), 'token-2')
+
+    @patch('documents.api.adobe.time.sleep')
+    def test_waits_with_backoff(self, sleep_mock):
+        self.server.statuses = ['in progress'] * 6 + ['done']
+
+        self.client.wait_for_job('job', timeout=60, interval=0.5, max_interval=4)
+
+        self.assertEqual([call.args[0] for call in sleep_mock.call_args_list], [0.5, 1, 2, 4, 4, 4])
+
+    @patch('documents.api.adobe.time.sleep')
+    def test_failed_job(self, sleep_mock):
+        self.server.statuses = ['in progress', 'failed']
+
+        with self.assertRaisesMessage(adobe_api.AdobeJobFailed, 'Job job failed.'):
+            self.client.wait_for_job('job', timeout=60)
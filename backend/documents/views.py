@@ -1,38 +1,64 @@
 import os
-import time
 import logging
 import jwt
 from datetime import datetime, timedelta
 logger = logging.getLogger('django')
 
 from django.conf import settings
-from django.db.models import Q, Prefetch, Max
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q, Prefetch, Max
 from django.utils import timezone
 from rest_framework import viewsets, status, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.pagination import CursorPagination
 
-from documents.api import adobe as adobe_api
+from documents import exports
 from pairdraft import views_util
 from pairdraft.settings import IS_PRODUCTION
 from pairdraft.email_service import gmail_send_message
 from pairdraft.aws_manager import aws_manager, BUCKETS
 from users.models import UserProfile
 from tokens.models import DocumentToken
-from documents.serializers import DocumentSerializer, CommentSerializer, ThreadSerializer
-from documents.models import Document, Action, Thread, Comment
+from documents.serializers import DocumentSerializer, DocumentSiblingSerializer, CommentSerializer, ThreadSerializer
+from documents.models import Document, DocumentBlob, PdfExport, Action, Chain, Thread, Comment
 from documents.permissions import IsAuthorizedDocument
 
 
+class DocumentHistoryPagination(CursorPagination):
+    """
+    Keyset pagination of the document histories, most recently active first.
+
+    Opt-in, the list is only paginated when page_size is passed.
+    The cursor links keep page_size, so clients only pass it once.
+    """
+    ordering = ('-last_activity_at', '-id') # unique, so chains with the same activity are not skipped or repeated
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
 class DocumentViewSet(viewsets.ModelViewSet):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
     permission_classes = [permissions.IsAuthenticated, IsAuthorizedDocument]
+    pagination_class = DocumentHistoryPagination
     
+    def get_actions(self):
+        """Returns the actions the user has access to, with their users."""
+        actions = Action.objects.select_related('from_user', 'to_user')
+        if views_util.is_superuser(self.request.user):
+            return actions
+        return actions.filter(Q(from_user__user=self.request.user) | Q(to_user__user=self.request.user))
+
     def get_queryset(self):
         """Filters documents to those the user has access to."""
         if views_util.is_superuser(self.request.user):
-            return Document.objects.prefetch_related('actions').all()
+            return Document.objects \
+                .select_related('property') \
+                .prefetch_related(Prefetch('actions', queryset=self.get_actions())) \
+                .all()
 
         # filter actions to only those involving the user
         user_actions = Action.objects.filter(Q(from_user__user=self.request.user) | Q(to_user__user=self.request.user))
@@ -40,7 +66,8 @@ class DocumentViewSet(viewsets.ModelViewSet):
         # filter to documents with those actions
         return Document.objects \
             .annotate(latest_action_timestamp=Max('actions__timestamp')) \
-            .prefetch_related(Prefetch('actions', queryset=user_actions)) \
+            .select_related('property') \
+            .prefetch_related(Prefetch('actions', queryset=self.get_actions())) \
             .filter(actions__in=user_actions) \
             .distinct() \
             .order_by('-latest_action_timestamp')
@@ -52,6 +79,18 @@ class DocumentViewSet(viewsets.ModelViewSet):
             queryset=queryset,
             user_profile=request.user.user_profile
         )
+        return self.serialize_history(request, history)
+
+    @staticmethod
+    def serialize_history(request, history: dict, summary: bool = False) -> dict:
+        """Serializes a history, without the history array in summary mode."""
+        if summary:
+            return {
+                'document': DocumentSerializer(history['documents'][0], context={'request': request}).data,
+                'available_actions': history['available_actions'],
+                'recipient_name': history['recipient_name']
+            }
+
         serialized_documents = DocumentSerializer(history['documents'], context={'request': request}, many=True).data
         return {
             'document': serialized_documents[0],
@@ -75,6 +114,12 @@ class DocumentViewSet(viewsets.ModelViewSet):
 
         A history is a group of documents which all
         share the same root document.
+
+        Query params:
+            page_size: paginate the histories with a cursor (see DocumentHistoryPagination)
+            cursor: the cursor of the next or previous page
+            summary: 'true' to leave out the history array,
+                which is loaded with the history action when a chain is expanded
     
         Returns:
             {
@@ -83,35 +128,37 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 history: []     # all documents in the history back to the root document
             }
         """
-        # TODO: make a Chain model so querying will be easier?
-        #   can pass info through nested serializers instead of having a 'root'
-        queryset = self.get_queryset() # TODO: might need to change to this: queryset = self.filter_queryset(self.get_queryset())
-        
-        histories = []
-        
-        # get the root document ids to group the documents together
-        root_ids = list(queryset.values_list('root', flat=True))
-        seen = set()
-        for root_id in root_ids:
-            if root_id in seen:
-                continue
-
-            history = self.get_history(
-                request=request,
-                queryset=queryset,
-                root_id=root_id
-            )
-            histories.append(history)
-
-            seen.add(root_id)
-            
-        # sort by the most recent action
-        histories.sort(key=lambda x: x['document']['actions'][0]['timestamp'], reverse=True)
-
+        user_profile = request.user.user_profile
+        summary = request.query_params.get('summary') in ('true', '1')
+
+        # the user's negotiations, most recently active first
+        chains = Chain.objects \
+            .select_related('latest_action') \
+            .prefetch_related('participants') \
+            .filter(last_activity_at__isnull=False) \
+            .order_by('-last_activity_at', '-id')
+        if not views_util.is_superuser(request.user):
+            chains = chains.filter(participants=user_profile)
+
+        page = self.paginate_queryset(chains)
+        if page is not None:
+            chains = page
+
+        documents = Document.objects \
+            .select_related('property') \
+            .prefetch_related(Prefetch('actions', queryset=self.get_actions()))
+
+        histories = [
+            self.serialize_history(request, history, summary=summary)
+            for history in Chain.get_histories(chains, documents, user_profile=user_profile)
+        ]
+
+        if page is not None:
+            return self.get_paginated_response(histories)
         return Response(histories, status=status.HTTP_200_OK)
     
     @staticmethod
-    def _get_presigned_url(document: Document, content_type, client_method_name='get_object') -> str | None:
+    def _get_presigned_url(document: Document, content_type, client_method_name='get_object', verify=True) -> str | None:
         method_parameters = {
             'Bucket': BUCKETS.PAIRDRAFT_DOCUMENTS.value,
             'Key': document.get_file_path(content_type)
@@ -126,67 +173,87 @@ class DocumentViewSet(viewsets.ModelViewSet):
             if content_type == Document.PDF:
                 method_parameters['ResponseContentDisposition'] = f'attachment; filename="{document.title}.pdf"'
 
-        return aws_manager.generate_presigned_url(client_method_name=client_method_name, method_parameters=method_parameters)
+        return aws_manager.generate_presigned_url(client_method_name=client_method_name, method_parameters=method_parameters, verify=verify)
+
+    @staticmethod
+    def _get_content_types(document: Document) -> set[str]:
+        """
+        Returns the stored formats of the document from DocumentBlob.
+        Documents without any row yet, i.e. not backfilled, fall back to the (cached)
+        S3 head of the JSON and then the HTML, and the format found is recorded.
+        """
+        content_types = {blob.content_type for blob in document.blobs.all()}
+        if content_types:
+            return content_types
+
+        for content_type in (Document.JSON, Document.HTML):
+            metadata = aws_manager.get_object_metadata(
+                bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+                file_path=document.get_file_path(content_type)
+            )
+            if metadata is not None:
+                DocumentBlob.record_metadata(document, content_type, metadata)
+                return {content_type}
+        return content_types
 
     @staticmethod
     def format_document(request, document: Document, client_method_name='get_object'):
         """
         Serializes the document, 
         generates a presigned url according to the client method,
-        and appends the available actions for the user.
+        and appends the available actions for the user
+        and the other documents of its history.
+
+        The stored formats are read from DocumentBlob, so the url
+        is signed without any request to S3, unless the document
+        has no DocumentBlob rows yet.
         """
         serializer = DocumentSerializer(document, context={'request': request})
         data = dict(serializer.data)
         
-        # Check if JSON exists, if not provide HTML URL
-        json_path = document.get_file_path(Document.JSON)
-        json_exists = aws_manager.object_exists(
-            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-            file_path=json_path
-        )
-        
-        if json_exists:
+        # provide the JSON url if it exists, otherwise the HTML url
+        content_types = DocumentViewSet._get_content_types(document)
+        if Document.JSON in content_types:
             data['presigned_url'] = DocumentViewSet._get_presigned_url(
                 document=document,
                 content_type=Document.JSON,
-                client_method_name=client_method_name
+                client_method_name=client_method_name,
+                verify=False
             )
             data['content_type'] = Document.JSON
-        else:
-            # Check if HTML exists
-            html_path = document.get_file_path(Document.HTML)
-            html_exists = aws_manager.object_exists(
-                bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
-                file_path=html_path
+        elif Document.HTML in content_types:
+            data['presigned_url'] = DocumentViewSet._get_presigned_url(
+                document=document,
+                content_type=Document.HTML,
+                client_method_name=client_method_name,
+                verify=False
             )
-            
-            if html_exists:
-                data['presigned_url'] = DocumentViewSet._get_presigned_url(
-                    document=document,
-                    content_type=Document.HTML,
-                    client_method_name=client_method_name
-                )
-                data['content_type'] = Document.HTML
-                data['needs_migration'] = True
-            else:
-                data['presigned_url'] = None
-                data['content_type'] = None
+            data['content_type'] = Document.HTML
+            data['needs_migration'] = True
+        else:
+            data['presigned_url'] = None
+            data['content_type'] = None
         
         data['available_actions'] = document.get_available_actions(request.user.user_profile)
 
-        editable = False
-        latest_action = document.actions.first()
-        if latest_action \
-            and latest_action.from_user == request.user.user_profile \
-            and latest_action.type in set([Action.CREATE, Action.COUNTER, Action.REVIEW]):
-            editable = True
-        data['editable'] = editable
+        data['editable'] = document.is_editable_by(request.user.user_profile)
 
-        # TODO: really only need to store the ids
+        # the documents of the history, most recently active first
         # TODO: filter documents to those the user has access to
-        documents = Document.objects.filter(root_id=str(document.root.id)).all() # TODO: not guaranteed to be in the correct order
-        serialized_documents = DocumentSerializer(documents, context={'request': request}, many=True).data
-        data['documents'] = serialized_documents
+        documents = Document.objects \
+            .filter(root_id=document.root_id) \
+            .annotate(latest_action_timestamp=Max('actions__timestamp')) \
+            .order_by(F('latest_action_timestamp').desc(nulls_last=True))
+
+        # compact unless the full documents are requested with ?expand=history
+        if request.query_params.get('expand') == 'history':
+            documents = documents \
+                .select_related('property') \
+                .prefetch_related(Prefetch('actions', queryset=Action.objects.select_related('from_user', 'to_user')))
+            data['documents'] = DocumentSerializer(documents, context={'request': request}, many=True).data
+        else:
+            documents = documents.prefetch_related('actions')
+            data['documents'] = DocumentSiblingSerializer(documents, many=True).data
 
         return data
 
@@ -226,6 +293,42 @@ class DocumentViewSet(viewsets.ModelViewSet):
     #         status=status.HTTP_200_OK
     #     )
 
+    @action(detail=True, methods=['post'])
+    def upload_url(self, request, pk=None):
+        """Returns a presigned url to upload the document content."""
+        content_type = request.data.get('content_type')
+        if content_type not in (Document.JSON, Document.HTML):
+            return Response("Invalid content type.", status=status.HTTP_400_BAD_REQUEST)
+
+        presigned_url = DocumentViewSet._get_presigned_url(
+            document=self.get_object(),
+            content_type=content_type,
+            client_method_name='put_object',
+            verify=False
+        )
+        if not presigned_url:
+            return Response("Presigned url not generated.", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(presigned_url, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def uploaded(self, request, pk=None):
+        """Records the content the client uploaded with the presigned url from upload_url."""
+        document = self.get_object()
+        content_type = request.data.get('content_type')
+        if content_type not in (Document.JSON, Document.HTML):
+            return Response("Invalid content type.", status=status.HTTP_400_BAD_REQUEST)
+
+        metadata = aws_manager.get_object_metadata(
+            bucket=BUCKETS.PAIRDRAFT_DOCUMENTS.value,
+            file_path=document.get_file_path(content_type),
+            cached=False
+        )
+        if not metadata:
+            return Response("The content was not uploaded.", status=status.HTTP_400_BAD_REQUEST)
+
+        DocumentBlob.record_metadata(document=document, content_type=content_type, metadata=metadata)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
     @action(detail=True, methods=['get'], url_path='ws-token')
     def ws_token(self, request, pk=None):
         document = self.get_object()
@@ -241,29 +344,59 @@ class DocumentViewSet(viewsets.ModelViewSet):
     # DOWNLOADS ==================================================================
     @action(detail=True, methods=['get'])
     def download_url(self, request, pk=None):
-        """Returns a presigned url to download the document."""
+        """
+        Returns a presigned url to download the document as a PDF if its current
+        content was exported before.  Otherwise queues an export and returns
+        its id with 202, the result is sent on ws/exports/<id>/ and returned by
+        the export action.
+        """
         document = self.get_object()
 
-        get_html_doc_presigned_url = DocumentViewSet._get_presigned_url(document=document, content_type=Document.HTML, client_method_name='get_object')
-        put_pdf_doc_presigned_url = DocumentViewSet._get_presigned_url(document=document, content_type=Document.PDF, client_method_name='put_object')
-        get_pdf_doc_presigned_url = DocumentViewSet._get_presigned_url(document=document, content_type=Document.PDF, client_method_name='get_object')
-        
-        if not get_html_doc_presigned_url or not put_pdf_doc_presigned_url:
-            return Response("Presigned urls not generated.", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
-        job_id = adobe_api.html_to_pdf(get_html_doc_presigned_url, put_pdf_doc_presigned_url)
-        if not job_id:
-            return Response("Job not created.", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        export = exports.request_export(document=document, user_profile=request.user.user_profile)
+        if not export:
+            return Response("The document has no content to export.", status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            exports.serialize_export(export, document),
+            status=status.HTTP_200_OK if export.status == PdfExport.DONE else status.HTTP_202_ACCEPTED
+        )
+
+    @action(detail=True, methods=['get'])
+    def download_urls(self, request, pk=None):
+        """
+        Exports every document in the negotiation of the document as one batch, like download_url.
+        Returns the exports keyed by document id, with 202 until all of them are done.
+        """
+        document = self.get_object()
 
-        # poll for the job status
-        attempts = 0
-        job_status = None
-        while job_status != 'done' and attempts < 10:
-            attempts += 1
-            job_status = adobe_api.get_job_status(job_id)
-            time.sleep(1)
+        chain_exports = exports.request_chain_exports(document=document, user_profile=request.user.user_profile)
+        data = {
+            str(chain_document.id): exports.serialize_export(export, chain_document)
+            for chain_document, export in chain_exports
+        }
+        return Response(
+            data,
+            status=status.HTTP_200_OK if all(export.status == PdfExport.DONE for _, export in chain_exports) else status.HTTP_202_ACCEPTED
+        )
+
+    @action(detail=True, methods=['get'], url_path=r'exports/(?P<export_id>[^/.]+)')
+    def export(self, request, pk=None, export_id=None):
+        """
+        Returns the status of a PDF export of the document and the url to download it once it is done.
+        The export may be one of another document with the same content, which download_url reused.
+        """
+        document = self.get_object()
+
+        try:
+            export = PdfExport.objects \
+                .filter(Q(document=document) | Q(content_hash__in=document.blobs.values('etag')), id=export_id) \
+                .first()
+        except ValidationError:
+            export = None
+        if not export:
+            return Response("Export not found.", status=status.HTTP_404_NOT_FOUND)
 
-        return Response({'url': get_pdf_doc_presigned_url}, status=status.HTTP_200_OK)
+        return Response(exports.serialize_export(export, document), status=status.HTTP_200_OK)
 
 
     # COMMENTS ===================================================================
@@ -336,8 +469,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Submits an offer."""        
         document = self.get_object()
 
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.SUBMIT not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.SUBMIT):
             return Response(f'You cannot {Action.SUBMIT} the offer.', status=status.HTTP_401_UNAUTHORIZED)
         
         base_url = os.environ.get('FRONTEND_URL', 'http://localhost:3000') if IS_PRODUCTION else 'http://localhost:3000'
@@ -458,8 +590,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Accepts an offer."""
         document = self.get_object()
 
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.ACCEPT not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.ACCEPT):
             return Response("You cannot accept the offer.", status=status.HTTP_400_BAD_REQUEST)
 
         # TODO: fill out
@@ -481,8 +612,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Declines an offer."""
         document = self.get_object()
 
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.DECLINE not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.DECLINE):
             return Response("You cannot decline the offer.", status=status.HTTP_400_BAD_REQUEST)
         
         Action.objects.create(
@@ -500,17 +630,17 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Counters an offer."""    
         document = self.get_object()
 
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.COUNTER not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.COUNTER):
             return Response("You cannot counter the offer.", status=status.HTTP_400_BAD_REQUEST)
 
-        counter_document = document.create_copy()
-        
-        Action.objects.create(
-            type=Action.COUNTER, 
-            from_user=request.user.user_profile, 
-            document=counter_document
-        )
+        # the content is copied once the counter and its action are committed
+        with transaction.atomic():
+            counter_document = document.create_copy()
+            Action.objects.create(
+                type=Action.COUNTER, 
+                from_user=request.user.user_profile, 
+                document=counter_document
+            )
         
         logger.info(f"Counter for document {document.id} created by {request.user}")
         return Response({'id': counter_document.id}, status=status.HTTP_200_OK)
@@ -522,8 +652,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Requests a review."""
         document = self.get_object()
         
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.REQUEST_REVIEW not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.REQUEST_REVIEW):
             return Response("You cannot request a review.", status=status.HTTP_400_BAD_REQUEST)
 
         reviewer = UserProfile.objects.filter(is_attorney=True).first()
@@ -546,17 +675,16 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """Creates a review."""
         document = self.get_object()
         
-        available_actions = document.get_available_actions(user_profile=request.user.user_profile)
-        if Action.REVIEW not in available_actions:
+        if not document.can_perform(request.user.user_profile, Action.REVIEW):
             return Response("You cannot create a review.", status=status.HTTP_400_BAD_REQUEST)
         
-        review_document = document.create_copy()
- 
-        Action.objects.create(
-            type=Action.REVIEW, 
-            from_user=request.user.user_profile,
-            document=review_document
-        )
+        with transaction.atomic():
+            review_document = document.create_copy()
+            Action.objects.create(
+                type=Action.REVIEW, 
+                from_user=request.user.user_profile,
+                document=review_document
+            )
 
         logger.info(f"Review for document {document.id} created by {request.user}")
         return Response(status=status.HTTP_200_OK)
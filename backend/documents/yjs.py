@@ -0,0 +1,233 @@
+"""
+Helpers for the "yjs-writings" table.
+
+The table is created and written by the y-websocket server (y-postgresql),
+which stores the Yjs updates for each document under docname = document id:
+a row (version v1) per update, and a row (version v1_sv) with the state
+vector of the document and the id of the last update it includes.
+
+The server stores every update and replays all of them when a document is
+opened, so compact_document merges the updates of a document into a single
+snapshot update and writes its state vector, see compact_yjs_updates.
+"""
+
+import time
+from dataclasses import dataclass
+import logging
+logger = logging.getLogger('django')
+
+from django.db import connection, transaction, DatabaseError
+from pycrdt import Doc, get_state, merge_updates
+
+
+YJS_WRITINGS_TABLE = 'yjs-writings'
+
+# versions of the rows, as written by y-postgresql
+UPDATE = 'v1'
+STATE_VECTOR = 'v1_sv'
+
+
+def get_latest_update_id(document_id) -> int | None:
+    """
+    Returns the id of the most recent Yjs row for a document.
+
+    A new row is written whenever the document is edited or its
+    updates are compacted, so a different id means the content may have changed.
+    """
+    try:
+        # savepoint so a missing table does not break an outer transaction
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT MAX(id) FROM \"{YJS_WRITINGS_TABLE}\" WHERE docname = %s",
+                    [str(document_id)]
+                )
+                row = cursor.fetchone()
+    except DatabaseError as e:
+        logger.warning(f"Could not read {YJS_WRITINGS_TABLE} for document {document_id}: {e}")
+        return None
+    return row[0] if row else None
+
+
+def delete_updates(document_id) -> int:
+    """Deletes the Yjs rows of a document and returns how many were deleted."""
+    try:
+        # savepoint so a missing table does not break the deleting transaction
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM \"{YJS_WRITINGS_TABLE}\" WHERE docname = %s",
+                    [str(document_id)]
+                )
+                return cursor.rowcount
+    except DatabaseError as e:
+        logger.warning(f"Could not delete from {YJS_WRITINGS_TABLE} for document {document_id}: {e}")
+        return 0
+
+
+@dataclass
+class TableStats:
+    rows: int
+    documents: int
+    bytes: int # of the updates' values
+    table_size: int # on disk, including indexes and free space until the table is vacuumed
+
+
+@dataclass
+class CompactionResult:
+    docname: str
+    updates: int # merged into the snapshot
+    bytes_before: int
+    bytes_after: int
+    clock: int # id of the snapshot
+
+
+def write_var_uint(value: int) -> bytes:
+    """Encodes an unsigned integer as lib0 does, 7 bits per byte with the highest bit set on all but the last."""
+    data = bytearray()
+    while value > 0x7f:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def read_var_uint(data: bytes, position: int = 0) -> tuple[int, int]:
+    """Returns the lib0 encoded unsigned integer at the position and the position after it."""
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def encode_state_vector(state_vector: bytes, clock: int) -> bytes:
+    """Encodes the value of a v1_sv row as y-postgresql does: the clock and the state vector as a lib0 Uint8Array."""
+    return write_var_uint(clock) + write_var_uint(len(state_vector)) + state_vector
+
+
+def decode_state_vector(value: bytes) -> tuple[bytes, int]:
+    """Returns the state vector and clock of a v1_sv row."""
+    clock, position = read_var_uint(value)
+    length, position = read_var_uint(value, position)
+    return bytes(value[position:position + length]), clock
+
+
+def get_table_stats() -> TableStats:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT COUNT(*), COUNT(DISTINCT docname), COALESCE(SUM(octet_length(value)), 0), pg_total_relation_size(%s::regclass) FROM \"{YJS_WRITINGS_TABLE}\"",
+            [f'"{YJS_WRITINGS_TABLE}"']
+        )
+        rows, documents, size, table_size = cursor.fetchone()
+    return TableStats(rows=rows, documents=documents, bytes=size, table_size=table_size)
+
+
+def get_documents_to_compact(min_updates: int, docnames: list[str] | None = None, limit: int | None = None) -> list[tuple[str, int]]:
+    """Returns the documents with at least min_updates update rows and their number of rows, most rows first."""
+    query = f"SELECT docname, COUNT(*) FROM \"{YJS_WRITINGS_TABLE}\" WHERE version = %s"
+    params = [UPDATE]
+    if docnames is not None:
+        query += " AND docname = ANY(%s)"
+        params.append([str(docname) for docname in docnames])
+    query += " GROUP BY docname HAVING COUNT(*) >= %s ORDER BY COUNT(*) DESC, docname"
+    params.append(max(min_updates, 2))
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+
+def get_updates(cursor, docname: str, after: int = 0) -> list[tuple[int, bytes]]:
+    cursor.execute(
+        f"SELECT id, value FROM \"{YJS_WRITINGS_TABLE}\" WHERE docname = %s AND version = %s AND id > %s ORDER BY id",
+        [docname, UPDATE, after]
+    )
+    return [(id, bytes(value)) for id, value in cursor.fetchall()]
+
+
+def measure_open(docname: str) -> float:
+    """Returns the seconds it takes to load a document as the y-websocket server does, reading and applying all its updates."""
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        updates = get_updates(cursor, docname)
+    doc = Doc()
+    for _, update in updates:
+        doc.apply_update(update)
+    return time.perf_counter() - start
+
+
+def compact_document(docname: str, lock_timeout: int = 2000) -> CompactionResult | None:
+    """
+    Replaces the update rows of a document with a single snapshot update and writes its state vector.
+    Returns None if there was nothing to compact or the rows changed while they were merged.
+
+    The updates are read and merged without locks.  The rows are then
+    replaced in a short transaction holding a lock that waits for the
+    inserts in progress and blocks new ones (lock_timeout milliseconds at
+    most), so updates stored in the meantime are merged too and none is lost.
+    Clients opening the document see either all old rows or the snapshot.
+    """
+    with connection.cursor() as cursor:
+        updates = get_updates(cursor, docname)
+    if len(updates) < 2:
+        return None
+    snapshot = merge_updates(*[update for _, update in updates])
+    last_id = updates[-1][0]
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL lock_timeout = {int(lock_timeout)}")
+            # conflicts with inserts and deletes, and itself, but not with reads
+            cursor.execute(f"LOCK TABLE \"{YJS_WRITINGS_TABLE}\" IN SHARE ROW EXCLUSIVE MODE")
+
+            cursor.execute(
+                f"SELECT id FROM \"{YJS_WRITINGS_TABLE}\" WHERE docname = %s AND version = %s AND id <= %s ORDER BY id",
+                [docname, UPDATE, last_id]
+            )
+            ids = [id for id, _ in updates]
+            if [id for id, in cursor.fetchall()] != ids:
+                # i.e. the server flushed the document itself
+                logger.info(f"Updates of Yjs document {docname} changed while compacting, skipped")
+                return None
+
+            newer = get_updates(cursor, docname, after=last_id)
+            if newer:
+                snapshot = merge_updates(snapshot, *[update for _, update in newer])
+                ids += [id for id, _ in newer]
+
+            cursor.execute(
+                f"INSERT INTO \"{YJS_WRITINGS_TABLE}\" (docname, value, version) VALUES (%s, %s, %s) RETURNING id",
+                [docname, snapshot, UPDATE]
+            )
+            clock = cursor.fetchone()[0]
+            cursor.execute(
+                f"DELETE FROM \"{YJS_WRITINGS_TABLE}\" WHERE docname = %s AND version = %s AND id = ANY(%s)",
+                [docname, UPDATE, ids]
+            )
+
+            # the state vector is valid as long as the snapshot is the last update
+            state_vector = encode_state_vector(get_state(snapshot), clock)
+            cursor.execute(
+                f"UPDATE \"{YJS_WRITINGS_TABLE}\" SET value = %s WHERE docname = %s AND version = %s",
+                [state_vector, docname, STATE_VECTOR]
+            )
+            if not cursor.rowcount:
+                cursor.execute(
+                    f"INSERT INTO \"{YJS_WRITINGS_TABLE}\" (docname, value, version) VALUES (%s, %s, %s)",
+                    [docname, state_vector, STATE_VECTOR]
+                )
+
+    return CompactionResult(
+        docname=docname,
+        updates=len(ids),
+        bytes_before=sum(len(update) for _, update in updates + newer),
+        bytes_after=len(snapshot),
+        clock=clock
+    )
@@ -0,0 +1,36 @@
+"""
+Django management command to save the direct messages queued by inbox.write_behind.
+
+Each web process drains the queue on its own while messages are being sent,
+this command saves whatever is left, i.e. before a deploy or after an outage.
+"""
+
+from django.core.management.base import BaseCommand
+
+from inbox.write_behind import flush_messages
+import logging
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Save the direct messages queued in the Redis stream'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Messages saved per query (default: INBOX_WRITE_BEHIND_BATCH)',
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            saved = flush_messages(options['batch_size'])
+            if not saved:
+                break
+            total += saved
+
+        logger.info(f"Saved {total} queued inbox messages")
+        self.stdout.write(self.style.SUCCESS(f'Saved {total} queued messages'))
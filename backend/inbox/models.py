@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from django.utils import timezone
     
 
 class Message(models.Model):
@@ -7,5 +8,5 @@ class Message(models.Model):
     sender = models.ForeignKey('users.UserProfile', on_delete=models.SET_NULL, null=True, blank=True, related_name='sent_messages')
     recipient = models.ForeignKey('users.UserProfile', on_delete=models.SET_NULL, null=True, blank=True, related_name='received_messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now) # set when the message is sent, it may be saved later (see inbox.write_behind)
     read = models.BooleanField(default=False)
@@ -1,5 +1,16 @@
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIRequestFactory
 from users import util as users_util
+from inbox import write_behind
 from inbox.models import Message
 from inbox.views import MessageViewSet
 
@@ -23,3 +34,93 @@ class RecipientsLatestMessageTest(APITestCase):
         response = self.view.recipients_latest_message(request)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), 1)
+
+
+class FakeStreamRedis:
+    def __init__(self):
+        self.streams = {}
+        self.next_id = 0
+
+    @property
+    def entries(self):
+        return self.streams.get(write_behind.STREAM_KEY, [])
+
+    def xadd(self, key, fields):
+        entry_id = f'{self.next_id}-0'
+        self.next_id += 1
+        self.streams.setdefault(key, []).append((entry_id, dict(fields)))
+        return entry_id
+
+    def xrange(self, key, count=None):
+        return self.streams.get(key, [])[:count]
+
+    def xdel(self, key, *entry_ids):
+        self.streams[key] = [entry for entry in self.streams.get(key, []) if entry[0] not in entry_ids]
+
+
+@patch('inbox.write_behind.redis_manager')
+class WriteBehindTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _, cls.buyer_user_profile = users_util.create_user('buyer@pairdraft.com')
+        _, cls.seller_user_profile = users_util.create_user('seller@pairdraft.com')
+
+    def queue_messages(self, count):
+        sent_at = timezone.now() - timedelta(minutes=1)
+        messages = [
+            Message(sender=self.buyer_user_profile, recipient=self.seller_user_profile, content=f'Hello {i}', timestamp=sent_at)
+            for i in range(count)
+        ]
+        for message in messages:
+            write_behind.append_message(message)
+        return messages
+
+    def test_flush_saves_queued_messages_in_one_query(self, redis_manager_mock):
+        redis_manager_mock.r = FakeStreamRedis()
+        messages = self.queue_messages(3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(write_behind.flush_messages(), 3)
+
+        # one insert, the savepoint around it is the transaction outside of tests
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['SAVEPOINT', 'INSERT', 'RELEASE'])
+
+        saved = Message.objects.get(id=messages[0].id)
+        self.assertEqual(saved.content, 'Hello 0')
+        self.assertEqual(saved.sender, self.buyer_user_profile)
+        self.assertEqual(saved.timestamp, messages[0].timestamp) # keeps the time it was sent
+        self.assertEqual(redis_manager_mock.r.entries, [])
+        self.assertEqual(write_behind.flush_messages(), 0)
+
+    def test_flush_is_idempotent(self, redis_manager_mock):
+        redis_manager_mock.r = FakeStreamRedis()
+        messages = self.queue_messages(1)
+        write_behind.flush_messages()
+        write_behind.append_message(messages[0]) # i.e. drained twice by two processes
+
+        self.assertEqual(write_behind.flush_messages(), 1)
+        self.assertEqual(Message.objects.filter(id=messages[0].id).count(), 1)
+
+    def test_flush_moves_messages_that_cannot_be_saved_to_dead_letters(self, redis_manager_mock):
+        redis_manager_mock.r = FakeStreamRedis()
+        messages = self.queue_messages(3)
+        redis_manager_mock.r.entries[1][1]['recipient_id'] = str(uuid.uuid4()) # i.e. the user was deleted
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE') # as when the insert commits
+
+        self.assertEqual(write_behind.flush_messages(), 3)
+
+        self.assertEqual(set(Message.objects.values_list('id', flat=True)), {messages[0].id, messages[2].id})
+        self.assertEqual(redis_manager_mock.r.entries, [])
+        dead_letters = redis_manager_mock.r.xrange(write_behind.DEAD_LETTER_KEY)
+        self.assertEqual([fields['id'] for _, fields in dead_letters], [str(messages[1].id)])
+        self.assertIn('error', dead_letters[0][1])
+
+    def test_flush_command_drains_stream_in_batches(self, redis_manager_mock):
+        redis_manager_mock.r = FakeStreamRedis()
+        self.queue_messages(5)
+
+        call_command('flush_inbox_messages', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(redis_manager_mock.r.entries, [])
@@ -0,0 +1,131 @@
+"""
+Write-behind persistence for direct messages.
+
+When INBOX_WRITE_BEHIND is enabled, ChatConsumer fans a message out to the
+chat group before it is saved and appends it to a Redis stream.  A writer
+task in the same process drains the stream and inserts the messages in
+batches, so delivery does not wait on the database.
+
+Entries are only removed from the stream after they were inserted and
+inserts ignore existing ids, so a message is saved at least once even if
+several processes drain the stream at the same time.  If a batch cannot be
+inserted, i.e. the thread or user of a message was deleted, its messages are
+inserted one by one and those that still fail are moved to the
+DEAD_LETTER_KEY stream, so one bad message does not hold up the others.
+"""
+
+import asyncio
+import logging
+logger = logging.getLogger('django')
+from datetime import datetime
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from channels.db import database_sync_to_async
+
+from pairdraft.redis_manager import redis_manager
+from inbox.models import Message
+
+
+STREAM_KEY = 'inbox_messages'
+DEAD_LETTER_KEY = 'inbox_messages_dead' # entries that could not be saved, with the error
+MAX_FAILURES = 5 # consecutive failed flushes before the writer stops
+
+
+def append_message(message: Message):
+    """Appends a message that has not been saved yet to the stream."""
+    redis_manager.r.xadd(STREAM_KEY, {
+        'id': str(message.id),
+        'sender_id': str(message.sender_id) if message.sender_id else '',
+        'recipient_id': str(message.recipient_id) if message.recipient_id else '',
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat()
+    })
+
+
+def flush_messages(count: Optional[int] = None) -> int:
+    """Inserts the oldest messages of the stream with one query and returns how many were saved."""
+    count = count or settings.INBOX_WRITE_BEHIND_BATCH
+    entries = redis_manager.r.xrange(STREAM_KEY, count=count)
+    if not entries:
+        return 0
+
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create([to_message(fields) for _, fields in entries], ignore_conflicts=True)
+    except (IntegrityError, DataError, ValueError, KeyError) as e:
+        # a message of the batch cannot be saved, the others are saved without it
+        logger.warning(f"Could not save {len(entries)} inbox messages in one batch, saving them one by one: {e}")
+        for entry_id, fields in entries:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([to_message(fields)], ignore_conflicts=True)
+            except (IntegrityError, DataError, ValueError, KeyError) as e:
+                logger.error(f"Could not save inbox message {fields.get('id')}, moved to {DEAD_LETTER_KEY}: {e}")
+                redis_manager.r.xadd(DEAD_LETTER_KEY, {**fields, 'error': str(e)})
+
+    redis_manager.r.xdel(STREAM_KEY, *[entry_id for entry_id, _ in entries])
+    return len(entries)
+
+
+def to_message(fields: dict) -> Message:
+    return Message(
+        id=fields['id'],
+        sender_id=fields['sender_id'] or None,
+        recipient_id=fields['recipient_id'] or None,
+        content=fields['content'],
+        timestamp=datetime.fromisoformat(fields['timestamp'])
+    )
+
+
+class InboxWriter:
+    """
+    Drains the stream in the background of the current process.
+
+    The task is started when a message is enqueued
+    and stops once the stream is empty.
+    """
+    _task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def start(cls):
+        if cls._task is None or cls._task.done():
+            cls._task = asyncio.get_running_loop().create_task(cls.run())
+
+    @classmethod
+    async def run(cls):
+        failures = 0
+        while True:
+            await asyncio.sleep(settings.INBOX_WRITE_BEHIND_INTERVAL * 2 ** failures)
+            try:
+                saved = await database_sync_to_async(flush_messages)()
+                failures = 0
+            except Exception as e:
+                # i.e. the database is unavailable, the messages stay in the stream
+                failures += 1
+                logger.error(f"Could not save inbox messages ({failures} attempts): {e}")
+                if failures >= MAX_FAILURES:
+                    # the next message or the flush_inbox_messages command starts over
+                    cls._task = None
+                    return
+                continue
+            if not saved:
+                cls._task = None
+                return
+
+
+async def enqueue_message(message: Message):
+    """
+    Queues a message that was already sent to the chat group for saving.
+    Falls back to saving it directly if Redis is unavailable.
+    """
+    try:
+        await sync_to_async(append_message, thread_sensitive=False)(message)
+    except Exception as e:
+        logger.error(f"Could not queue inbox message {message.id}, saving it directly: {e}")
+        await database_sync_to_async(message.save)()
+        return
+
+    InboxWriter.start()
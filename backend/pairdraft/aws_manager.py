@@ -1,12 +1,16 @@
 # AWS Manager singleton
 
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import logging
 logger = logging.getLogger('django')
 
 import boto3
 from botocore.exceptions import ClientError
+from django.conf import settings
 
 
 class BUCKETS(str, Enum):
@@ -14,6 +18,52 @@ class BUCKETS(str, Enum):
     PAIRDRAFT_DOCUMENTS = 'pairdraft-documents'
     
 
+MISSING = object() # cache miss, as opposed to a cached None
+
+
+class ExpiringCache:
+    """
+    A per-process cache whose entries expire at a given time.
+    The oldest entries are evicted once it holds S3_CACHE_MAX_ENTRIES.
+    Used from request threads and the copy_objects threads, so access is locked.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, now: float, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if now >= expires_at:
+                self.entries.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value, expires_at: float):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires_at)
+            # iterating the dict while another thread inserts would raise
+            while len(self.entries) > settings.S3_CACHE_MAX_ENTRIES:
+                self.entries.pop(next(iter(self.entries)), None)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+def get_reuse_until(signed_at: float, expiration: int, fraction: float) -> float:
+    """
+    Returns until when a presigned url is handed out again.
+    A reused url is valid for at least (1 - fraction) * expiration seconds.
+    """
+    return signed_at + expiration * fraction
+
+
 class AWSManager(object):
     def __init__(self):        
         self.s3_client = boto3.client(
@@ -23,66 +73,76 @@ class AWSManager(object):
             aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
         )
 
+        # presigned urls by (method, http method, expiration, parameters)
+        self.presigned_urls = ExpiringCache()
+        # head_object responses (None if the object does not exist) by (bucket, key)
+        self.object_metadata = ExpiringCache()
+        # threads of copy_objects, the client's pool keeps 10 connections
+        self.copy_executor = ThreadPoolExecutor(max_workers=settings.S3_COPY_MAX_WORKERS, thread_name_prefix='s3-copy')
+
     def generate_presigned_url(self, client_method_name, method_parameters,
-                               expiration=3600, http_method=None) -> str | None:
+                               expiration=3600, http_method=None, verify=True) -> str | None:
         """
         Checks if the key exists before generating a presigned URL.
 
+        Signing is local, urls are reused until S3_PRESIGNED_URL_REUSE_FRACTION
+        of their lifetime has passed and whether a key exists is cached
+        for S3_OBJECT_EXISTS_CACHE_TTL seconds.
+
         Parameters:
         client_method_name (string): Name of the S3.Client method, e.g., 'put_object' for uploading or 'get_object' for downloading.
         method_parameters: Dictionary of parameters to send to the method.
         expiration: Time in seconds for the presigned URL to remain valid.
         http_method: HTTP method to use (GET, etc.).
+        verify: Whether to check that the key exists. Signing without the check makes no request to S3.
         
         Returns:
         str, None: Presigned URL as string. If key doesn't exist or there's an error, returns None.
         """
-        try:
-            # first verify the key exists
-            self.s3_client.head_object(
-                Bucket=method_parameters.get('Bucket'),
-                Key=method_parameters.get('Key')
-            )
-            
-            # if key exists, proceed to generate presigned URL
-            try:
-                response = self.s3_client.generate_presigned_url(
-                    ClientMethod=client_method_name,
-                    Params=method_parameters,
-                    ExpiresIn=expiration,
-                    HttpMethod=http_method
-                )
-            except ClientError as e:
-                logger.error(e)
+        if verify and not self.object_exists(
+            bucket=method_parameters.get('Bucket'),
+            file_path=method_parameters.get('Key')
+        ):
+            # the key does not exist, only a new key can be uploaded
+            if client_method_name != 'put_object':
                 return None
 
-            return response
+        if client_method_name == 'put_object':
+            # the object is about to change
+            self.object_metadata.pop((method_parameters.get('Bucket'), method_parameters.get('Key')))
+
+        key = (client_method_name, http_method, expiration, tuple(sorted(method_parameters.items())))
+        now = time.time()
+        presigned_url = self.presigned_urls.get(key, now)
+        if presigned_url:
+            return presigned_url
 
+        try:
+            presigned_url = self.s3_client.generate_presigned_url(
+                ClientMethod=client_method_name,
+                Params=method_parameters,
+                ExpiresIn=expiration,
+                HttpMethod=http_method
+            )
         except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                # the key does not exist
-                if client_method_name == 'get_object':
-                    return None
-                
-                # generate a presigned URL for a new key
-                elif client_method_name == 'put_object':
-                    return self.s3_client.generate_presigned_url(
-                        ClientMethod=client_method_name,
-                        Params=method_parameters,
-                        ExpiresIn=expiration,
-                        HttpMethod=http_method
-                    )
-            else:
-                # some other error occurred
-                raise e
+            logger.error(e)
+            return None
+
+        reuse_until = get_reuse_until(now, expiration, settings.S3_PRESIGNED_URL_REUSE_FRACTION)
+        self.presigned_urls.set(key, presigned_url, expires_at=reuse_until)
+        return presigned_url
     
     def get_object(self, bucket, file_path):
         return self.s3_client.get_object(Bucket=bucket, Key=file_path)
     
-    def upload_object(self, bucket, file_path, body='', content_type='text/html'):
-        self.s3_client.put_object(Bucket=bucket, Key=file_path, Body=body, ContentType=content_type)
+    def upload_object(self, bucket, file_path, body='', content_type='text/html', only_if_missing=False):
+        """Uploads an object, with only_if_missing the upload fails with PreconditionFailed if the key exists."""
+        self.object_metadata.pop((bucket, file_path))
+        conditions = {'IfNoneMatch': '*'} if only_if_missing else {}
+        return self.s3_client.put_object(Bucket=bucket, Key=file_path, Body=body, ContentType=content_type, **conditions)
     
     def delete_object(self, bucket, key):
+        self.object_metadata.pop((bucket, key))
         try:
             response = self.s3_client.delete_object(Bucket=bucket, Key=key)
         except ClientError as e:
@@ -90,46 +150,91 @@ class AWSManager(object):
             return None
         return response
     
-    def copy_object(self, source_bucket, source_file_path, destination_bucket, destination_file_path):
+    def delete_objects(self, bucket, keys) -> dict:
+        """
+        Deletes up to 1000 keys with one request.
+        Returns the error message of each key that could not be deleted, raises if the request failed.
+        """
+        for key in keys:
+            self.object_metadata.pop((bucket, key))
+        response = self.s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in keys],
+                'Quiet': True # only errors are returned
+            }
+        )
+        return {error['Key']: error.get('Message') or error.get('Code', '') for error in response.get('Errors', [])}
+    
+    def copy_object(self, source_bucket, source_file_path, destination_bucket, destination_file_path, if_match=None):
+        """
+        Copies an object within S3 without checking for the source first.
+        With if_match the source is only copied if it still has that etag.
+        Returns None if the source does not exist, has another etag or the copy failed.
+        """
+        self.object_metadata.pop((destination_bucket, destination_file_path))
+        conditions = {'CopySourceIfMatch': f'"{if_match.strip(chr(34))}"'} if if_match else {}
         try:
-            # first verify the key exists
-            self.s3_client.head_object(Bucket=source_bucket, Key=source_file_path)
-            
-            # if key exists, proceed to copy the object
-            try:
-                response = self.s3_client.copy_object(
-                    CopySource={
-                        'Bucket': source_bucket,
-                        'Key': source_file_path
-                    },
-                    Bucket=destination_bucket,
-                    Key=destination_file_path
-                )
-            except ClientError as e:
+            response = self.s3_client.copy_object(
+                CopySource={
+                    'Bucket': source_bucket,
+                    'Key': source_file_path
+                },
+                Bucket=destination_bucket,
+                Key=destination_file_path,
+                **conditions
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404', 'PreconditionFailed', '412'):
                 logger.error(e)
-                return None
+            # otherwise the source key does not exist or was changed
+            return None
 
-            return response
+        return response
 
-        except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                # the source key does not exist
+    def copy_objects(self, copies):
+        """
+        Copies (source bucket, source file path, destination bucket, destination file path) tuples
+        concurrently on at most S3_COPY_MAX_WORKERS threads shared by the process.
+        Returns the response of each copy in order, None for those that failed.
+        """
+        def copy(arguments):
+            try:
+                return self.copy_object(*arguments)
+            except Exception as e:
+                logger.error(f"Failed to copy {arguments[1]} to {arguments[3]}: {e}")
                 return None
-            else:
-                # some other error occurred
-                raise e
+
+        if len(copies) <= 1:
+            return [copy(arguments) for arguments in copies]
+        return list(self.copy_executor.map(copy, copies))
     
     def object_exists(self, bucket, file_path):
         """Check if an object exists in S3"""
+        return self.get_object_metadata(bucket=bucket, file_path=file_path) is not None
+
+    def get_object_metadata(self, bucket, file_path, cached=True) -> dict | None:
+        """
+        Returns the head_object response of an object, or None if it does not exist.
+        Reuses responses from the last S3_OBJECT_EXISTS_CACHE_TTL seconds unless cached is False.
+        """
+        now = time.time()
+        if cached:
+            metadata = self.object_metadata.get((bucket, file_path), now, default=MISSING)
+            if metadata is not MISSING:
+                return metadata
+
         try:
-            self.s3_client.head_object(Bucket=bucket, Key=file_path)
-            return True
+            metadata = self.s3_client.head_object(Bucket=bucket, Key=file_path)
         except ClientError as e:
             if e.response['Error']['Code'] == "404":
-                return False
+                metadata = None
             else:
                 # some other error occurred
                 raise e
+
+        self.object_metadata.set((bucket, file_path), metadata, expires_at=now + settings.S3_OBJECT_EXISTS_CACHE_TTL)
+        return metadata
     
     def download_object(self, bucket, file_path):
         """Download an object from S3 and return its content as a string"""
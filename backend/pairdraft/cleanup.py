@@ -0,0 +1,119 @@
+"""
+Out of band deletion of the S3 objects of deleted documents and properties.
+
+Delete signals call delete_objects_on_commit, which queues the keys as
+OrphanedObject rows in the deleting transaction, so a rolled back delete
+keeps its objects, the keys of a committed delete survive a restart and
+requests never wait on S3.  Once the transaction commits an ObjectCleaner
+thread in the same process waits S3_CLEANUP_DELAY seconds, so the keys of a
+cascading delete are collected, then drains the queued rows with one
+delete_objects request per bucket and 1000 keys.  Queued rows left behind by
+a stopped process are drained by the next cleaner of any process.
+
+Failed batches are retried, keys that still could not be deleted stay
+recorded as orphans and are deleted by the reconcile_orphaned_objects command.
+"""
+
+import threading
+import time
+from collections import defaultdict
+import logging
+logger = logging.getLogger('django')
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from documents.models import OrphanedObject
+from pairdraft.aws_manager import aws_manager
+
+
+MAX_KEYS_PER_REQUEST = 1000 # limit of delete_objects
+MAX_KEYS_PER_DRAIN = 10 * MAX_KEYS_PER_REQUEST # queued keys read at once
+
+
+def delete_objects_on_commit(bucket: str, keys: list[str]):
+    """Queues the keys in the current transaction, they are deleted once it commits."""
+    keys = [key for key in keys if key]
+    if keys:
+        OrphanedObject.queue(bucket, keys)
+        transaction.on_commit(ObjectCleaner.start)
+
+
+def delete_objects(bucket: str, keys: list[str]) -> dict:
+    """
+    Deletes the keys in batches, retrying the keys of a batch that failed
+    S3_CLEANUP_RETRIES times.  Removes the rows of the deleted keys, records
+    the keys that could not be deleted as orphans and returns their errors.
+    """
+    failed = {}
+    for start in range(0, len(keys), MAX_KEYS_PER_REQUEST):
+        batch = keys[start:start + MAX_KEYS_PER_REQUEST]
+        pending = batch
+        for attempt in range(settings.S3_CLEANUP_RETRIES + 1):
+            if attempt:
+                time.sleep(settings.S3_CLEANUP_RETRY_INTERVAL * 2 ** (attempt - 1))
+            try:
+                errors = aws_manager.delete_objects(bucket=bucket, keys=pending)
+            except Exception as e:
+                errors = {key: str(e) for key in pending}
+            if not errors:
+                break
+            pending = list(errors)
+        OrphanedObject.objects.filter(bucket=bucket, key__in=[key for key in batch if key not in errors]).delete()
+        failed.update(errors)
+
+    if failed:
+        logger.error(f"Could not delete {len(failed)} objects in {bucket}, recorded as orphans")
+        OrphanedObject.record(bucket=bucket, errors=failed)
+    return failed
+
+
+class ObjectCleaner:
+    """
+    Drains the queued keys in a background thread of the current process.
+    The thread stops once no keys are queued.
+    """
+    _thread: threading.Thread | None = None
+    _requested = False # keys were queued since the last drain started
+    _lock = threading.Lock()
+
+    @classmethod
+    def start(cls):
+        with cls._lock:
+            cls._requested = True
+            if cls._thread is None:
+                cls._thread = threading.Thread(target=cls.run, name='s3-cleanup', daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def drain(cls) -> int:
+        """Deletes up to MAX_KEYS_PER_DRAIN queued keys and returns their number."""
+        queued = OrphanedObject.objects.filter(attempts=0).order_by('created').values_list('bucket', 'key')[:MAX_KEYS_PER_DRAIN]
+        keys_by_bucket = defaultdict(list)
+        for bucket, key in queued:
+            keys_by_bucket[bucket].append(key)
+
+        for bucket, keys in keys_by_bucket.items():
+            failed = delete_objects(bucket, keys)
+            logger.info(f"Deleted {len(keys) - len(failed)} objects in {bucket}")
+        return sum(len(keys) for keys in keys_by_bucket.values())
+
+    @classmethod
+    def run(cls):
+        try:
+            while True:
+                time.sleep(settings.S3_CLEANUP_DELAY)
+                with cls._lock:
+                    cls._requested = False
+                try:
+                    if cls.drain():
+                        continue
+                except Exception as e:
+                    # the keys stay queued for the next cleaner or reconcile_orphaned_objects
+                    logger.error(f"Could not clean up queued objects: {e}")
+                with cls._lock:
+                    if not cls._requested:
+                        cls._thread = None
+                        return
+        finally:
+            connection.close()
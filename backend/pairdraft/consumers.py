@@ -1,19 +1,26 @@
 import json
-from collections import deque
+import time
 from typing import Dict, Optional, Any
-from asgiref.sync import async_to_sync
 import logging
 logger = logging.getLogger('django')
 
+from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels_redis.core import RedisChannelLayer
-from openai import OpenAI
-
-from agent.models import AgentMessage
+from openai import AsyncOpenAI
+
+from agent import prompt as agent_prompt
+from agent import history
+from agent import limiter
+from agent.stream_parser import AgentStreamParser
+from agent.stream_batcher import StreamBatcher
+from agent.document_text import get_document_text
 from users.models import UserProfile
 from inbox.models import Message
+from inbox import write_behind
 from inbox.serializers import MessageSerializer
 from tokens.models import SocketToken
 
@@ -21,20 +28,22 @@ from tokens.models import SocketToken
 def get_users_from_chat_name(chat_name: str, user: User) -> Optional[Dict[str, Any]]:
     """Get the sender and recipient user profiles from the chat name."""
     first, second = chat_name.split('_')
-    first_user_profile = UserProfile.objects.filter(id=first).first()
-    second_user_profile = UserProfile.objects.filter(id=second).first()
+    user_profiles = {
+        str(user_profile.id): user_profile
+        for user_profile in UserProfile.objects.select_related('user').filter(id__in=[first, second])
+    }
+    first_user_profile = user_profiles.get(first)
+    second_user_profile = user_profiles.get(second)
     
     if not first_user_profile or not second_user_profile:
         return None
     
-    if first_user_profile.user != user and second_user_profile.user != user:
-        return None
-    elif first_user_profile.user == user:
+    if first_user_profile.user_id == user.id:
         return {
             'sender': first_user_profile,
             'recipient': second_user_profile,
         }
-    elif second_user_profile.user == user:
+    elif second_user_profile.user_id == user.id:
         return {
             'sender': second_user_profile,
             'recipient': first_user_profile,
@@ -42,23 +51,44 @@ def get_users_from_chat_name(chat_name: str, user: User) -> Optional[Dict[str, A
     return None
 
 
-class ChatConsumer(WebsocketConsumer):
+@database_sync_to_async
+def create_message(sender: UserProfile, recipient: UserProfile, content: str) -> Dict[str, Any]:
+    """Creates a direct message and returns its serialized data."""
+    message = Message.objects.create(
+        sender=sender,
+        recipient=recipient,
+        content=content
+    )
+
+    return MessageSerializer(message).data
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Handles both the agent chat and direct messages.
+
+    The consumer is fully async so that a long agent stream only awaits
+    network I/O and never holds the thread that sync consumers share.
+    """
     channel_layer: RedisChannelLayer # add type hint to avoid errors in IDE
     
-    def connect(self):
-        self.accept()
+    async def connect(self):
+        await self.accept()
         self.user = self.scope["user"]
+        self.user_profile = None # agent chat, resolved on the first message
+        self.users_data = None # direct messages, resolved when the user is authenticated
         
         chat_name = self.scope['url_route']['kwargs']['chat_name']
         if chat_name == 'agent':
-            self.llm = OpenAI()
+            self.llm = AsyncOpenAI()
+            self.document = None # resolved on the first message and reused for the connection
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         chat_name = self.scope['url_route']['kwargs']['chat_name']
         if chat_name != 'agent': # means the chat should be in a group if it's not the agent
-            async_to_sync(self.channel_layer.group_discard)(chat_name, self.channel_name)
+            await self.channel_layer.group_discard(chat_name, self.channel_name)
 
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         data = json.loads(text_data)
         chat_name = self.scope['url_route']['kwargs']['chat_name']
 
@@ -68,278 +98,163 @@ class ChatConsumer(WebsocketConsumer):
             thread_id = data.get('thread_id')
             conversation_history = data.get('conversation_history', [])
             document_text = data.get('document_text', '')
+            document_version = data.get('document_version') # Yjs state vector of the client's document
             active_mark_ids = data.get('active_mark_ids', '')
 
             # Get user profile
-            user_profile = UserProfile.objects.filter(user=self.user).first()
+            user_profile = await self.get_user_profile()
             if not user_profile:
-                self.send(text_data=json.dumps({"error": "User profile not found"}))
+                await self.send(text_data=json.dumps({"error": "User profile not found"}))
                 return
+
+            # Flatten the document or load it from the server-side cache
+            # when the client only sent the document version
+            if user_message and document_id and (document_text or document_version):
+                document_text = await database_sync_to_async(get_document_text)(
+                    document_id=document_id,
+                    version=document_version,
+                    editor_state=document_text
+                )
+                if document_text is None:
+                    # ask the client to resend the message with the full document
+                    await self.send(text_data=json.dumps({
+                        "document_text_required": True,
+                        "document_id": document_id,
+                        "thread_id": thread_id
+                    }))
+                    return
             
-            # Save user message to database
-            if user_message and document_id:
-                try:
-                    from documents.models import Document
-                    document = Document.objects.get(id=document_id)
-                    AgentMessage.objects.create(
-                        user_profile=user_profile,
-                        document=document,
-                        role='user',
-                        content=user_message
-                    )
-                except Document.DoesNotExist:
-                    logger.error(f"Document {document_id} not found")
-            
-            # # Load conversation history from database
-            # conversation_history = []
-            # if document_id:
-            #     try:
-            #         from documents.models import Document
-            #         document = Document.objects.get(id=document_id)
-            #         messages = AgentMessage.objects.filter(
-            #             user_profile=user_profile,
-            #             document=document
-            #         ).order_by('timestamp')
-                    
-            #         for msg in messages:
-            #             conversation_history.append({
-            #                 "role": "assistant" if msg.role == 'agent' else "user",
-            #                 "content": msg.content
-            #             })
-            #     except Document.DoesNotExist:
-            #         logger.error(f"Document {document_id} not found")
+            document = await self.get_document(document_id) if document_id else None
 
             # Do not send message to LLM for connection request where just document_id is passed
             if not user_message:
                 return
 
-            # # Add current user message to conversation history
-            if user_message:
+            # Reject over-quota requests before calling the model
+            usage = await database_sync_to_async(limiter.get_current_usage)(user_profile.id)
+            if usage and not usage.can_use:
+                await self.send(text_data=json.dumps({
+                    "error": "You have used all of your AI credits for this billing period.",
+                    "thread_id": thread_id
+                }))
+                return
+
+            summary = None
+            if document and not thread_id:
+                # Load the messages that are not summarized yet and the summary of older messages from the database,
+                # the current message is saved together with the reply
+                summary, conversation_history = await database_sync_to_async(history.load_history)(
+                    user_profile_id=user_profile.id,
+                    document_id=document.id
+                )
                 conversation_history.append({
                     "role": "user",
                     "content": user_message
                 })
-
-            conversation_history = [{
-                'role': 'assistant' if message.get('authorDetails', {}).get('full_name') == 'ai' else 'user',
-                'content': message.get('content', '')
-            } for message in conversation_history]
-
-            # It is very important to not give legal advice and if the user asks for it, you should say something like:
-            # I am not a lawyer and cannot give legal advice.
-
-            # If the user asks a question about a certain topic, you can direct them to reach out to a specialist.  For example, if they ask about the tax implications of a certain action, you can say:
-            # I am not a tax specialist and cannot give tax advice.  You should reach out to a tax specialist for more information.
-
-            # Here is another example of a disclaimer you can use to respond to a finance question:
-            # This is not professional financial advice. Consulting a financial advisor about your particular circumstances is best.
-
-            # If you do answer a question, you should try to share the source of your information.
-            instructions = f"""
-            You are helping multiple parties negotiate an agreement.                    
-
-            You will be given a full document {'and a list of active mark ids to know which text is relevant.' if active_mark_ids else ''}
-
-            If you propose changes to the document (a change is defined as a deletion AND an addition), indicate the changes at the end of your response with '[[CHANGES]]: {{changes_json_array}} where changes_json_array is a JSON array with the following example format (don't include whitespace or new lines):
-
-            [
-                {{
-                    "type": "deletion",
-                    "start_key": "45",
-                    "start_offset": 0,
-                    "end_key": "45",
-                    "end_offset": 8, // i.e. length of text in node to erase the whole node
-                }},
-                {{
-                    "type": "addition",
-                    "key": "45",
-                    "offset": 0,
-                    "text": "abc"
-                }},
-            ]
-
-            type: str (ONLY EITHER 'addition' OR 'deletion' are valid values)
-            offset: int
-            key, start_key, end_key: str
-
-            If you are adding new text and the user did not designate a location, use your discretion to find the best location.
-
-            If you propose changes, also include a justification section after your message with '[[JUSTIFICATION]]: <text>' where <text> is a brief message written in the user's voice, as if the user themselves is explaining the rationale behind the proposed change to the other parties on the document. It should read naturally as something the user would share with collaborators to justify the edit (this will be shown to all users in a comment thread).
-
-            Response order when proposing changes:
-            1. Your main message to the user
-            2. [[JUSTIFICATION]]: <plain text explanation>
-            3. [[CHANGES]]: <json array>
-            """
-
-            # Respond in two parts:
-            # 1. A message to the user with `[[MESSAGE_END]]` at the end.
-            # 2. Document content (formatted in standard Markdown) with `[[FINAL_END]]` at the end.
-
-            # Prepare messages for OpenAI API
-            messages = [{"role": "system", "content": instructions}]
-
-            if document_text:
-                messages.append({
-                    'role': 'user',
-                    'content': f'FULL DOCUMENT (for reference only):\n\"\"\"\n{document_text}\n\"\"\"'
-                })
-            if active_mark_ids:
-                messages.append({
-                    'role': 'user',
-                    'content': f'ACTIVE MARK IDS:\n\"\"\"\n{active_mark_ids}\n\"\"\"'
+            else:
+                # comment threads send their own conversation
+                conversation_history.append({
+                    "role": "user",
+                    "content": user_message
                 })
-
-            messages.extend(conversation_history)
-            
-            stream = self.llm.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages,
-                stream=data.get('stream', True)
+                conversation_history = history.window([{
+                    'role': 'assistant' if message.get('authorDetails', {}).get('full_name') == 'ai' else 'user',
+                    'content': message.get('content', '')
+                } for message in conversation_history])
+
+            messages = agent_prompt.build_messages(
+                conversation_history=conversation_history,
+                document_text=document_text,
+                active_mark_ids=active_mark_ids,
+                summary=summary
             )
 
-        # TODO: store message in db and append to history
-
-        #             self.ws_consumer.send(text_data=json.dumps({
-        #     "content": {
-        #         "id": str(self.user_step.id),
-        #         "content": content,
-        #         "type": type,
-        #         "field_type": self.document_step.field_type, # for fields like "number", "text", "select", "multi-checkbox"
-        #         "choices": self.document_step.choices, # for dropdowns (select and multi-checkbox)
-        #         "indent": self.document_step.indent if self.document_step.indent else 0,
-        #     }
-        # }))
-
-            # if not data.get('stream', True):
-            # handle AI for comment
-            # message, changes = stream.choices[0].message.content.split('[[CHANGES]]:')
-
-            # self.send(
-            #     text_data=json.dumps({
-            #         "message": message,
-            #         "sender": "PAIRDRAFT",
-            #         "streaming": True,
-            #         "comment": True,
-            #         "changes": changes,
-            #         "thread_id": thread_id
-            #     }))
-                # return
-            justification_delimiter = '[[JUSTIFICATION]]:'
-            changes_delimiter = '[[CHANGES]]:'
-            # Use the longer delimiter to determine safe streaming window
-            max_delimiter_len = max(len(justification_delimiter), len(changes_delimiter))
-            buffer = ""
-            justification_buffer = ""
-            changes_buffer = ""
-            # Parsing state: 'message' -> 'justification' -> 'changes'
-            parse_state = 'message'
-
-            for chunk in stream:
-                text = chunk.choices[0].delta.content
-                if text is None:
-                    continue
-
-                buffer += text
-
-                if parse_state == 'message':
-                    if justification_delimiter in buffer:
-                        parse_state = 'justification'
-                        pre, post = buffer.split(justification_delimiter, 1)
-                        self.send(text_data=json.dumps({
-                            "message": pre,
-                            "sender": "PAIRDRAFT",
-                            "streaming": True,
-                            "thread_id": thread_id
-                        }))
-                        buffer = post
-                    elif changes_delimiter in buffer:
-                        # No justification section — jump straight to changes
-                        parse_state = 'changes'
-                        pre, post = buffer.split(changes_delimiter, 1)
-                        self.send(text_data=json.dumps({
-                            "message": pre,
+            # Wait for a free agent slot, sending the queue position while waiting
+            async def send_queue_position(position):
+                await self.send(text_data=json.dumps({"queued": True, "position": position, "thread_id": thread_id}))
+
+            try:
+                async with limiter.AgentSlot(user_profile.id, document_id, on_queued=send_queue_position):
+                    streaming = data.get('stream', True)
+                    request_options = {}
+                    if streaming:
+                        request_options['stream_options'] = {'include_usage': True}
+                    prompt_cache_key = agent_prompt.get_prompt_cache_key(document_id)
+                    if prompt_cache_key:
+                        request_options['extra_body'] = {'prompt_cache_key': prompt_cache_key}
+
+                    started_at = time.monotonic()
+                    stream = await self.llm.chat.completions.create(
+                        model=agent_prompt.MODEL,
+                        messages=messages,
+                        stream=streaming,
+                        **request_options
+                    )
+
+                    parser = AgentStreamParser()
+                    batcher = StreamBatcher(
+                        send=lambda frame: self.send(text_data=frame),
+                        envelope={
                             "sender": "PAIRDRAFT",
                             "streaming": True,
                             "thread_id": thread_id
-                        }))
-                        buffer = ""
-                        changes_buffer += post
-                    else:
-                        # Safe to stream, hold back enough chars to catch a split delimiter
-                        safe = buffer[:-max_delimiter_len]
-                        if safe:
-                            self.send(text_data=json.dumps({
-                                "message": safe,
-                                "sender": "PAIRDRAFT",
-                                "streaming": True,
-                                "thread_id": thread_id
-                            }))
-                            buffer = buffer[len(safe):]
-
-                elif parse_state == 'justification':
-                    if changes_delimiter in buffer:
-                        parse_state = 'changes'
-                        pre, post = buffer.split(changes_delimiter, 1)
-                        justification_buffer += pre
-                        buffer = ""
-                        changes_buffer += post
-                    else:
-                        # Hold back to avoid splitting the changes delimiter
-                        safe = buffer[:-max_delimiter_len]
-                        if safe:
-                            justification_buffer += safe
-                            buffer = buffer[len(safe):]
-
-                else:
-                    # parse_state == 'changes' — accumulate silently
-                    changes_buffer += text
-                    buffer = ""
-
-            # Flush any remaining buffer content based on final state
-            if parse_state == 'message' and buffer:
-                self.send(text_data=json.dumps({
-                    "message": buffer,
-                    "sender": "PAIRDRAFT",
-                    "streaming": True,
-                    "thread_id": thread_id
-                }))
-            elif parse_state == 'justification' and buffer:
-                justification_buffer += buffer
-
-            # Signal end of stream and send captured changes and justification
-            self.send(text_data=json.dumps({
-                "message": "",
-                "sender": "PAIRDRAFT",
-                "streaming": False,
-                "changes": changes_buffer.strip(),
-                "justification": justification_buffer.strip(),
-                "thread_id": thread_id
-            }))
-
-            # self.send(text_data=json.dumps({"message": "", "sender": "PAIRDRAFT", "streaming": False}))
-            # Save agent's response to database
-            if buffer and document_id:
-                try:
-                    from documents.models import Document
-                    document = Document.objects.get(id=document_id)
-                    AgentMessage.objects.create(
-                        user_profile=user_profile,
-                        document=document,
-                        role='agent',
-                        content=buffer,
-                        metadata={
-                            'model': 'gpt-5-mini',
-                            'has_document_content': bool(document)
                         }
                     )
-                except Document.DoesNotExist:
-                    logger.error(f"Document {document_id} not found")
-            
-            # if certain types of data are returned (other than messages that should be streamed),
-            # then we can send them back to the frontend here
-            # if response.get('data'):
-            #     self.send(text_data=json.dumps(response['data']))
+
+                    first_token_at = None
+                    try:
+                        async for text in self.iter_completion_text(stream):
+                            if first_token_at is None:
+                                first_token_at = time.monotonic()
+                            for event, value in parser.feed(text):
+                                if event == AgentStreamParser.MESSAGE:
+                                    await batcher.add(value)
+
+                        for event, value in parser.close():
+                            if event == AgentStreamParser.MESSAGE:
+                                await batcher.add(value)
+                    finally:
+                        # also stops the flush timer if the stream failed
+                        await batcher.close()
+                    finished_at = time.monotonic()
+
+                    # Signal end of stream and send captured changes and justification
+                    await self.send(text_data=json.dumps({
+                        "message": "",
+                        "sender": "PAIRDRAFT",
+                        "streaming": False,
+                        "changes": parser.changes_text,
+                        "justification": parser.justification,
+                        "thread_id": thread_id
+                    }))
+            except limiter.AgentLimitExceeded as e:
+                await self.send(text_data=json.dumps({"error": str(e), "thread_id": thread_id}))
+                return
+
+            # Save both turns to the database
+            if document:
+                await database_sync_to_async(history.save_turn)(
+                    user_profile=user_profile,
+                    document=document,
+                    user_message=user_message,
+                    agent_message=parser.message,
+                    metadata={
+                        'model': agent_prompt.MODEL,
+                        'has_document_content': bool(document_text),
+                        'justification': parser.justification,
+                        'changes': parser.changes,
+                        'usage': agent_prompt.get_usage_metadata(self.completion_usage),
+                        'latency': {
+                            'first_token_ms': round((first_token_at - started_at) * 1000) if first_token_at else None,
+                            'total_ms': round((finished_at - started_at) * 1000)
+                        },
+                        'frame_count': batcher.frame_count
+                    }
+                )
+
+                # Fold messages that fell out of the history window into the summary
+                # in the background, so it delays neither the response nor the next message
+                history.schedule_summary_update(self.llm, user_profile.id, document.id)
 
         else:
             # direct messages via 'groups'
@@ -347,59 +262,126 @@ class ChatConsumer(WebsocketConsumer):
             # authenticate user after connection is established
             if (data.get('token') is not None):
                 token = data.get('token')
-                self.authenticate_user_with_token(token, chat_name)
+                await self.authenticate_user_with_token(token, chat_name)
                 return
             
             if not self.user:
                 logger.error("User not authenticated.")
-                self.close()
+                await self.close()
                 return
 
-            users_data = get_users_from_chat_name(chat_name, self.user)
+            users_data = await self.get_users_data(chat_name)
             if not users_data:
                 logger.error(f"User {self.user} does not have access to chat {chat_name}.  Send a message with session id first.")
-                self.close()
+                await self.close()
                 return
             
-            message = Message.objects.create(
-                sender=users_data['sender'],
-                recipient=users_data['recipient'],
-                content=data['content']
-            )
-            message.save()
-            
-            serializer = MessageSerializer(message)
+            if settings.INBOX_WRITE_BEHIND:
+                # send the message before it is saved, it is queued and saved in batches
+                message = Message(
+                    sender=users_data['sender'],
+                    recipient=users_data['recipient'],
+                    content=data['content']
+                )
+                message_data = MessageSerializer(message).data
+            else:
+                message_data = await create_message(
+                    sender=users_data['sender'],
+                    recipient=users_data['recipient'],
+                    content=data['content']
+                )
             
-            async_to_sync(self.channel_layer.group_send)(
+            await self.channel_layer.group_send(
                 chat_name,
                 {
                     "type": "chat.message",
-                    "text": json.dumps(serializer.data),
+                    "text": json.dumps(message_data),
                 },
             )
 
-    def chat_message(self, event):
+            if settings.INBOX_WRITE_BEHIND:
+                await write_behind.enqueue_message(message)
+
+    async def get_user_profile(self) -> Optional[UserProfile]:
+        """Returns the profile of the connected user, only querying it once per connection."""
+        if not self.user_profile and self.user and self.user.is_authenticated:
+            self.user_profile = await UserProfile.objects.select_related('user').filter(user=self.user).afirst()
+        return self.user_profile
+
+    async def get_users_data(self, chat_name: str) -> Optional[Dict[str, Any]]:
+        """Returns the sender and recipient profiles of a direct message chat, only querying them once per connection."""
+        if not self.users_data:
+            self.users_data = await database_sync_to_async(get_users_from_chat_name)(chat_name, self.user)
+        return self.users_data
+
+    async def get_document(self, document_id):
+        """Returns the document of the agent chat, only querying it when the document changes."""
+        from documents.models import Document
+
+        if self.document and str(self.document.id) == str(document_id):
+            return self.document
+
+        try:
+            self.document = await Document.objects.aget(id=document_id)
+        except Document.DoesNotExist:
+            logger.error(f"Document {document_id} not found")
+            self.document = None
+        return self.document
+
+    async def chat_message(self, event):
         """Used to handle chat.message events from the group."""
-        self.send(text_data=event["text"])
+        await self.send(text_data=event["text"])
+
+    async def iter_completion_text(self, completion):
+        """
+        Yields the text of an OpenAI chat completion.
+
+        Streamed completions yield each delta as it arrives,
+        non-streamed completions yield the whole message once.
+        The token usage is stored on self.completion_usage.
+        """
+        self.completion_usage = None
+
+        if not hasattr(completion, '__aiter__'):
+            self.completion_usage = getattr(completion, 'usage', None)
+            text = completion.choices[0].message.content
+            if text:
+                yield text
+            return
+
+        async for chunk in completion:
+            # with include_usage, the last chunk only carries the usage
+            if getattr(chunk, 'usage', None):
+                self.completion_usage = chunk.usage
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text is None:
+                continue
+            yield text
         
-    def authenticate_user_with_token(self, token: str, chat_name: str):
-        socket_token = SocketToken.objects.filter(token=token, date_expires__gt=timezone.now()).first()
+    async def authenticate_user_with_token(self, token: str, chat_name: str):
+        socket_token = await SocketToken.objects \
+            .select_related('user_profile__user') \
+            .filter(token=token, date_expires__gt=timezone.now()) \
+            .afirst()
         
         if not socket_token:
             logger.error(f"Socket token {token} not found.")
-            self.close()
+            await self.close()
             return
         
         # assign the user to the consumer
         self.user = socket_token.user_profile.user
         
         # delete token after user is authenticated
-        socket_token.delete()
+        await socket_token.adelete()
         
-        users_data = get_users_from_chat_name(chat_name, self.user)
+        self.users_data = None
+        users_data = await self.get_users_data(chat_name)
         if not users_data:
             logger.error(f"User {self.user} does not have access to chat {chat_name}")
-            self.close()
+            await self.close()
             return
 
-        async_to_sync(self.channel_layer.group_add)(chat_name, self.channel_name)
+        await self.channel_layer.group_add(chat_name, self.channel_name)
@@ -1,7 +1,9 @@
 from django.urls import re_path
 
 from . import consumers
+from documents import consumers as documents_consumers
 
 websocket_urlpatterns = [
     re_path(r"ws/chat/(?P<chat_name>[\w.-]+)/$", consumers.ChatConsumer.as_asgi()),
+    re_path(r"ws/exports/(?P<export_id>[\w-]+)/$", documents_consumers.ExportConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -189,6 +189,49 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Agent
+# How streamed agent tokens are coalesced into websocket frames: 'time', 'size' or 'sentence'
+AGENT_STREAM_FLUSH_POLICY = os.environ.get('AGENT_STREAM_FLUSH_POLICY', 'time')
+AGENT_STREAM_FLUSH_INTERVAL = 0.03 # seconds pending text waits before it is sent ('time' policy)
+AGENT_STREAM_FLUSH_MAX_CHARS = 200 # pending characters that always trigger a frame (all policies)
+AGENT_HISTORY_MESSAGES = 12 # most recent messages sent to the agent verbatim
+AGENT_SUMMARY_BATCH_MESSAGES = 8 # older messages that accumulate before they are folded into the summary
+AGENT_MAX_REQUESTS = int(os.environ.get('AGENT_MAX_REQUESTS', 50)) # concurrent model calls across all processes
+AGENT_MAX_REQUESTS_PER_USER = 2
+AGENT_MAX_REQUESTS_PER_DOCUMENT = 3
+AGENT_QUEUE_TIMEOUT = 60 # seconds a request waits for a slot before it is rejected
+AGENT_QUEUE_POLL_INTERVAL = 0.5 # seconds between attempts to get a slot
+
+# S3
+S3_PRESIGNED_URL_REUSE_FRACTION = 0.5 # share of a presigned url's lifetime it is handed out again for
+S3_OBJECT_EXISTS_CACHE_TTL = 10 # seconds the result of checking whether an object exists is reused
+S3_CACHE_MAX_ENTRIES = 10000 # per cache and process
+S3_COPY_MAX_WORKERS = 8 # threads per process copying objects concurrently
+S3_CLEANUP_DELAY = 1 # seconds deleted objects are collected before they are deleted in batches
+S3_CLEANUP_RETRIES = 3 # retries of a failed batch before its keys are recorded as orphans
+S3_CLEANUP_RETRY_INTERVAL = 1 # seconds before the first retry, doubled after each retry
+
+# PDF exports
+# Run exports in a background thread of the web process, disable when the run_pdf_exports command runs them
+PDF_EXPORT_IN_PROCESS = os.environ.get('PDF_EXPORT_IN_PROCESS', 'true') == 'true'
+PDF_EXPORT_TIMEOUT = 60 # seconds an export waits for its PDF
+PDF_EXPORT_POLL_INTERVAL = 0.5 # seconds before the first check of the job status, doubled after each check
+# local renders the lexical JSON in a process pool, adobe converts the HTML with Adobe PDF Services.
+# adobe until the download button saves the JSON before exporting, it only uploads the editor's HTML
+PDF_EXPORT_ENGINE = os.environ.get('PDF_EXPORT_ENGINE', 'adobe')
+PDF_EXPORT_PROCESSES = int(os.environ.get('PDF_EXPORT_PROCESSES', 2)) # 0 renders in the worker thread
+PDF_EXPORT_BATCH_SIZE = 8 # exports claimed and generated together
+
+# Yjs
+YJS_COMPACTION_MIN_UPDATES = 50 # update rows a document needs before compact_yjs_updates merges them
+YJS_COMPACTION_INTERVAL = 3600 # seconds between runs of compact_yjs_updates --periodic
+
+# Inbox
+# Send direct messages before they are saved and save them in batches from a Redis stream
+INBOX_WRITE_BEHIND = os.environ.get('INBOX_WRITE_BEHIND', 'false') == 'true'
+INBOX_WRITE_BEHIND_INTERVAL = 0.5 # seconds between batches
+INBOX_WRITE_BEHIND_BATCH = 500 # messages saved per query
+
 if IS_PRODUCTION:
     CSRF_TRUSTED_ORIGINS = [
         'https://reachagreements.com',
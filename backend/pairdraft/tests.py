@@ -1,7 +1,39 @@
+import asyncio
+import json
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
 from botocore.exceptions import ClientError
-from pairdraft.aws_manager import AWSManager
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+
+from datetime import timedelta
+
+from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+
+from users import util as users_util
+from agent.models import AgentMessage
+from billing.models import Usage
+from inbox.models import Message
+from inbox.tests import FakeStreamRedis
+from tokens.models import SocketToken
+from documents.models import Document
+from pairdraft.aws_manager import AWSManager, get_reuse_until
+from pairdraft import consumers
+from pairdraft.routing import websocket_urlpatterns
+
+
+def create_completion_stream(*texts, usage=None):
+    """Returns an async iterator that mimics a streamed OpenAI chat completion."""
+    async def stream():
+        for text in texts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+        if usage:
+            yield SimpleNamespace(choices=[], usage=usage)
+    return stream()
 
 
 class TestAWSManager(unittest.TestCase):
@@ -50,6 +82,24 @@ class TestAWSManager(unittest.TestCase):
         mock_s3_client.head_object.assert_called_once_with(Bucket='my-bucket', Key='non-existent-key')
         self.assertIsNone(result)
 
+    @patch('boto3.client')
+    def test_generate_presigned_url_without_verify(self, mock_boto_client):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        
+        mock_s3_client.generate_presigned_url.return_value = 'https://example.com/presigned_url'
+        
+        aws_manager = AWSManager()
+        method_params = {'Bucket': 'my-bucket', 'Key': 'my-key'}
+        
+        # Act
+        result = aws_manager.generate_presigned_url('get_object', method_params, verify=False)
+        
+        # Assert
+        mock_s3_client.head_object.assert_not_called()
+        self.assertEqual(result, 'https://example.com/presigned_url')
+
     @patch('boto3.client')
     def test_generate_presigned_url_put_object_key_not_found(self, mock_boto_client):
         """Ensure we create a presigned URL for a PUT request if the key does not exist."""
@@ -129,7 +179,6 @@ class TestAWSManager(unittest.TestCase):
         mock_s3_client = MagicMock()
         mock_boto_client.return_value = mock_s3_client
         
-        mock_s3_client.head_object.return_value = {}
         mock_s3_client.copy_object.return_value = {'CopyObjectResult': 'success'}
         
         aws_manager = AWSManager()
@@ -143,7 +192,7 @@ class TestAWSManager(unittest.TestCase):
         )
 
         # Assert
-        mock_s3_client.head_object.assert_called_once_with(Bucket='source-bucket', Key='source-file-path')
+        mock_s3_client.head_object.assert_not_called()
         mock_s3_client.copy_object.assert_called_once_with(
             CopySource={
                 'Bucket': 'source-bucket',
@@ -160,8 +209,8 @@ class TestAWSManager(unittest.TestCase):
         mock_s3_client = MagicMock()
         mock_boto_client.return_value = mock_s3_client
         
-        error_response = {'Error': {'Code': '404'}}
-        mock_s3_client.head_object.side_effect = ClientError(error_response, 'head_object')
+        error_response = {'Error': {'Code': 'NoSuchKey'}}
+        mock_s3_client.copy_object.side_effect = ClientError(error_response, 'copy_object')
         
         aws_manager = AWSManager()
         
@@ -174,5 +223,357 @@ class TestAWSManager(unittest.TestCase):
         )
         
         # Assert
-        mock_s3_client.head_object.assert_called_once_with(Bucket='source-bucket', Key='non-existent-source-file-path')
+        mock_s3_client.head_object.assert_not_called()
         self.assertIsNone(result)
+
+    @patch('boto3.client')
+    def test_copy_objects_concurrently(self, mock_boto_client):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+
+        # each copy waits until all three run at the same time
+        barrier = threading.Barrier(3, timeout=5)
+        def copy_object(CopySource, Bucket, Key):
+            barrier.wait()
+            if Key == 'missing-copy':
+                raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'copy_object')
+            return {'CopyObjectResult': {'ETag': Key}}
+        mock_s3_client.copy_object.side_effect = copy_object
+
+        aws_manager = AWSManager()
+
+        # Act
+        result = aws_manager.copy_objects([
+            ('bucket', 'json', 'bucket', 'json-copy'),
+            ('bucket', 'missing', 'bucket', 'missing-copy'),
+            ('bucket', 'html', 'bucket', 'html-copy'),
+        ])
+
+        # Assert
+        self.assertEqual(result, [{'CopyObjectResult': {'ETag': 'json-copy'}}, None, {'CopyObjectResult': {'ETag': 'html-copy'}}])
+
+
+    # Test the delete_objects method
+    @patch('boto3.client')
+    def test_delete_objects_returns_errors(self, mock_boto_client):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        mock_s3_client.delete_objects.return_value = {
+            'Errors': [{'Key': 'b', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+        }
+
+        aws_manager = AWSManager()
+
+        # Act
+        result = aws_manager.delete_objects('my-bucket', ['a', 'b'])
+
+        # Assert
+        mock_s3_client.delete_objects.assert_called_once_with(
+            Bucket='my-bucket',
+            Delete={'Objects': [{'Key': 'a'}, {'Key': 'b'}], 'Quiet': True}
+        )
+        self.assertEqual(result, {'b': 'Access Denied'})
+
+    # Test the presigned url and existence caches
+    def test_get_reuse_until(self):
+        self.assertEqual(get_reuse_until(signed_at=1000, expiration=3600, fraction=0.5), 2800)
+        self.assertEqual(get_reuse_until(signed_at=1000, expiration=3600, fraction=0), 1000)
+
+    @patch('pairdraft.aws_manager.time.time')
+    @patch('boto3.client')
+    @override_settings(S3_PRESIGNED_URL_REUSE_FRACTION=0.5)
+    def test_generate_presigned_url_reuses_url(self, mock_boto_client, mock_time):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        mock_s3_client.generate_presigned_url.side_effect = ['https://example.com/1', 'https://example.com/2']
+        
+        aws_manager = AWSManager()
+        method_params = {'Bucket': 'my-bucket', 'Key': 'my-key'}
+        
+        # Act & Assert
+        mock_time.return_value = 1000
+        self.assertEqual(aws_manager.generate_presigned_url('get_object', method_params, verify=False), 'https://example.com/1')
+
+        # reused until half of the hour has passed
+        mock_time.return_value = 2799
+        self.assertEqual(aws_manager.generate_presigned_url('get_object', dict(method_params), verify=False), 'https://example.com/1')
+
+        mock_time.return_value = 2800
+        self.assertEqual(aws_manager.generate_presigned_url('get_object', method_params, verify=False), 'https://example.com/2')
+        self.assertEqual(mock_s3_client.generate_presigned_url.call_count, 2)
+
+    @patch('boto3.client')
+    def test_generate_presigned_url_by_parameters(self, mock_boto_client):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        mock_s3_client.generate_presigned_url.side_effect = lambda **kwargs: str(kwargs)
+        
+        aws_manager = AWSManager()
+        method_params = {'Bucket': 'my-bucket', 'Key': 'my-key'}
+        
+        # Act
+        get_url = aws_manager.generate_presigned_url('get_object', method_params, verify=False)
+        put_url = aws_manager.generate_presigned_url('put_object', method_params, verify=False)
+        pdf_url = aws_manager.generate_presigned_url('get_object', {**method_params, 'ResponseContentType': 'application/pdf'}, verify=False)
+        
+        # Assert
+        self.assertEqual(len({get_url, put_url, pdf_url}), 3)
+
+    @patch('pairdraft.aws_manager.time.time')
+    @patch('boto3.client')
+    @override_settings(S3_OBJECT_EXISTS_CACHE_TTL=10)
+    def test_object_exists_is_cached(self, mock_boto_client, mock_time):
+        # Arrange
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        mock_s3_client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'head_object')
+        
+        aws_manager = AWSManager()
+        
+        # Act & Assert
+        mock_time.return_value = 1000
+        self.assertFalse(aws_manager.object_exists('my-bucket', 'my-key'))
+
+        mock_s3_client.head_object.side_effect = None
+        mock_s3_client.head_object.return_value = {'ContentLength': 1}
+        mock_time.return_value = 1009
+        self.assertFalse(aws_manager.object_exists('my-bucket', 'my-key'))
+        self.assertEqual(mock_s3_client.head_object.call_count, 1)
+
+        mock_time.return_value = 1010
+        self.assertTrue(aws_manager.object_exists('my-bucket', 'my-key'))
+        self.assertEqual(mock_s3_client.head_object.call_count, 2)
+
+        # writes invalidate the cache
+        aws_manager.delete_object('my-bucket', 'my-key')
+        mock_s3_client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'head_object')
+        self.assertFalse(aws_manager.object_exists('my-bucket', 'my-key'))
+
+
+class ChatConsumerAgentTest(TransactionTestCase):
+    def setUp(self):
+        self.user, self.user_profile = users_util.create_user('buyer@pairdraft.com')
+        self.document = Document.objects.create(title='Offer')
+
+        # admit every request
+        limiter_redis_patcher = patch('agent.limiter.redis_manager')
+        self.limiter_redis = limiter_redis_patcher.start().r
+        self.limiter_redis.eval.return_value = -1
+        self.addCleanup(limiter_redis_patcher.stop)
+
+    async def connect(self, llm):
+        with patch('pairdraft.consumers.AsyncOpenAI', return_value=llm):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/agent/')
+            communicator.scope['user'] = self.user
+            connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_until_finished(self, communicator):
+        frames = []
+        while True:
+            frame = json.loads(await communicator.receive_from())
+            frames.append(frame)
+            if not frame.get('streaming') and not frame.get('queued'):
+                return frames
+
+    async def test_streams_message_and_captures_changes(self):
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=create_completion_stream(
+            'Here is my ', 'suggestion.', '[[JUSTIFICATION]]: Clearer ', 'wording.', '[[CHANGES]]: []'
+        ))
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({
+            'message': 'Can you help?',
+            'document_id': str(self.document.id)
+        }))
+        frames = await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        message = ''.join(frame['message'] for frame in frames)
+        self.assertEqual(message, 'Here is my suggestion.')
+        self.assertEqual(frames[-1]['justification'], 'Clearer wording.')
+        self.assertEqual(frames[-1]['changes'], '[]')
+        self.assertTrue(await AgentMessage.objects.filter(role=AgentMessage.USER, content='Can you help?').aexists())
+
+    async def test_handles_non_streamed_completion(self):
+        completion = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='Done.'))])
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=completion)
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({
+            'message': 'Summarize',
+            'document_id': str(self.document.id),
+            'stream': False
+        }))
+        frames = await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual(''.join(frame['message'] for frame in frames), 'Done.')
+
+    async def test_records_token_usage(self):
+        usage = SimpleNamespace(
+            prompt_tokens=1200,
+            completion_tokens=40,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=1024)
+        )
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=create_completion_stream('All good.', usage=usage))
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({
+            'message': 'Anything to change?',
+            'document_id': str(self.document.id)
+        }))
+        await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        _, kwargs = llm.chat.completions.create.call_args
+        self.assertEqual(kwargs['stream_options'], {'include_usage': True})
+
+        agent_message = await AgentMessage.objects.filter(role=AgentMessage.AGENT).afirst()
+        self.assertEqual(agent_message.content, 'All good.')
+        self.assertEqual(
+            agent_message.metadata['usage'],
+            {'prompt_tokens': 1200, 'cached_tokens': 1024, 'completion_tokens': 40}
+        )
+
+    async def test_loads_conversation_history_from_database(self):
+        await AgentMessage.objects.acreate(user_profile=self.user_profile, document=self.document, role=AgentMessage.USER, content='Earlier question')
+        await AgentMessage.objects.acreate(user_profile=self.user_profile, document=self.document, role=AgentMessage.AGENT, content='Earlier answer')
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=create_completion_stream('Sure.'))
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({
+            'message': 'Follow up',
+            'document_id': str(self.document.id),
+            'conversation_history': [{'content': 'ignored', 'authorDetails': {}}]
+        }))
+        await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        _, kwargs = llm.chat.completions.create.call_args_list[0]
+        self.assertEqual(kwargs['messages'][1:], [
+            {'role': 'user', 'content': 'Earlier question'},
+            {'role': 'assistant', 'content': 'Earlier answer'},
+            {'role': 'user', 'content': 'Follow up'}
+        ])
+
+    async def test_saves_both_turns_and_resolves_document_once(self):
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(side_effect=[
+            create_completion_stream('First ', 'reply.', '[[JUSTIFICATION]]: Fair.', '[[CHANGES]]: []'),
+            create_completion_stream('Second reply.')
+        ])
+        communicator = await self.connect(llm)
+
+        with patch.object(Document.objects, 'aget', wraps=Document.objects.aget) as aget:
+            for message in ['One', 'Two']:
+                await communicator.send_to(text_data=json.dumps({
+                    'message': message,
+                    'document_id': str(self.document.id)
+                }))
+                await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual(aget.call_count, 1)
+        messages = [message async for message in AgentMessage.objects.order_by('timestamp')]
+        self.assertEqual(
+            [(message.role, message.content) for message in messages],
+            [('user', 'One'), ('agent', 'First reply.'), ('user', 'Two'), ('agent', 'Second reply.')]
+        )
+        self.assertEqual(messages[1].metadata['justification'], 'Fair.')
+        self.assertEqual(messages[1].metadata['changes'], [])
+
+    async def test_rejects_requests_over_quota(self):
+        now = timezone.now()
+        await Usage.objects.acreate(
+            user_profile=self.user_profile,
+            period_start=now - timedelta(days=1),
+            period_end=now + timedelta(days=29),
+            used=20,
+            allowed=20
+        )
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock()
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({'message': 'Hi', 'document_id': str(self.document.id)}))
+        response = json.loads(await communicator.receive_from())
+        await communicator.disconnect()
+
+        self.assertIn('credits', response['error'])
+        llm.chat.completions.create.assert_not_called()
+
+    @override_settings(AGENT_QUEUE_POLL_INTERVAL=0)
+    async def test_sends_queue_position_while_waiting(self):
+        self.limiter_redis.eval.side_effect = [-2, 1, 1, 0, -1]
+        llm = MagicMock()
+        llm.chat.completions.create = AsyncMock(return_value=create_completion_stream('Your turn.'))
+        communicator = await self.connect(llm)
+
+        await communicator.send_to(text_data=json.dumps({'message': 'Hi', 'document_id': str(self.document.id)}))
+        frames = await self.receive_until_finished(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual([frame['position'] for frame in frames if frame.get('queued')], [None, 2, 1])
+        self.assertEqual(''.join(frame['message'] for frame in frames if not frame.get('queued')), 'Your turn.')
+
+
+class ChatConsumerDirectMessageTest(TransactionTestCase):
+    def setUp(self):
+        _, self.sender = users_util.create_user('buyer@pairdraft.com')
+        _, self.recipient = users_util.create_user('seller@pairdraft.com')
+        self.token = SocketToken.objects.create(user_profile=self.sender)
+        self.chat_name = f'{self.sender.id}_{self.recipient.id}'
+
+    async def test_resolves_profiles_once_per_connection(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat_name}/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        with patch('pairdraft.consumers.get_users_from_chat_name', wraps=consumers.get_users_from_chat_name) as get_users:
+            await communicator.send_to(text_data=json.dumps({'token': self.token.token}))
+            for content in ['Hi', 'Are you there?']:
+                await communicator.send_to(text_data=json.dumps({'content': content}))
+                message = json.loads(await communicator.receive_from())
+                self.assertEqual(message['content'], content)
+                self.assertEqual(message['sender']['id'], str(self.sender.id))
+        await communicator.disconnect()
+
+        self.assertEqual(get_users.call_count, 1)
+        self.assertEqual(await Message.objects.filter(sender=self.sender, recipient=self.recipient).acount(), 2)
+
+    @override_settings(INBOX_WRITE_BEHIND=True, INBOX_WRITE_BEHIND_INTERVAL=0.01)
+    async def test_write_behind_sends_before_saving(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat_name}/')
+        communicator.scope['user'] = AnonymousUser()
+        await communicator.connect()
+
+        with patch('inbox.write_behind.redis_manager') as redis_manager_mock:
+            redis_manager_mock.r = FakeStreamRedis()
+            await communicator.send_to(text_data=json.dumps({'token': self.token.token}))
+            await communicator.send_to(text_data=json.dumps({'content': 'Hi'}))
+            message = json.loads(await communicator.receive_from())
+
+            self.assertFalse(await Message.objects.filter(id=message['id']).aexists())
+            self.assertEqual(len(redis_manager_mock.r.entries), 1)
+
+            await asyncio.sleep(0.1) # the writer drains the stream
+            self.assertTrue(await Message.objects.filter(id=message['id'], content='Hi').aexists())
+            self.assertEqual(redis_manager_mock.r.entries, [])
+        await communicator.disconnect()
+
+    def test_get_users_from_chat_name(self):
+        with self.assertNumQueries(1):
+            users_data = consumers.get_users_from_chat_name(self.chat_name, self.recipient.user)
+
+        self.assertEqual(users_data, {'sender': self.recipient, 'recipient': self.sender})
@@ -87,7 +87,7 @@ class Command(BaseCommand):
         action.save()
 
         # create review document
-        review_document = document.create_copy(content_type=Document.JSON)
+        review_document = document.create_copy()
         action = Action.objects.create(
             type=Action.REVIEW, 
             from_user=reviewer,
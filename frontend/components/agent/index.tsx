@@ -2,6 +2,8 @@
 
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { useLexicalComposerContext } from '@lexical/react/LexicalComposerContext';
+import { useCollaborationContext } from '@lexical/react/LexicalCollaborationContext';
+import * as Y from 'yjs';
 import {
   $getRoot,
   $createTextNode,
@@ -77,10 +79,24 @@ interface AgentMessage {
 
 const font = Lexend({ weight: '400', subsets: ['latin'] });
 
+/**
+ * Returns the Yjs state vector of the document as base64.
+ * The server caches the document text under this version
+ * so the full document only has to be uploaded when it changes.
+ */
+function getDocumentVersion(yDoc: Y.Doc | undefined): string | null {
+  if (!yDoc) return null;
+  const stateVector = Y.encodeStateVector(yDoc);
+  let binary = '';
+  stateVector.forEach(byte => { binary += String.fromCharCode(byte); });
+  return btoa(binary);
+}
+
 export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<any> }) {
   const { editor } = useGlobal();
   const { doc, hasSignedTerms } = useDocument();
   const { agentSocket, setAgentSocket } = useWebSockets();
+  const { yjsDocMap } = useCollaborationContext();
 
   const [open, setOpen] = useState(true);
   const [input, setInput] = useState("");
@@ -90,11 +106,16 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
   const [messages, setMessages] = useState<IMessage[]>([]);
   const messagesRef = useRef(messages);
   const [streamingMessage, setStreamingMessage] = useState<string>("");
+  const [queuePosition, setQueuePosition] = useState<number | null | undefined>(undefined); // null while waiting on the user's other requests
   const streamingMessageRef = useRef(streamingMessage);
   const messagesEndRef = React.createRef() as React.RefObject<HTMLDivElement | null>;
 
   const webSocketRef = useRef<WebSocket | null>(null); // used for cleanup
 
+  const editorRef = useRef(editor);
+  const pendingRequestRef = useRef<Record<string, any> | null>(null); // last request, resent if the server needs the document
+  const lastSentVersionRef = useRef<string | null>(null); // document version the server last received the document for
+
   const scrollToBottom = useCallback(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth', block: 'end' })
   }, [messagesEndRef]);
@@ -109,6 +130,10 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
     streamingMessageRef.current = streamingMessage;
   }, [streamingMessage]);
 
+  useEffect(() => {
+    editorRef.current = editor;
+  }, [editor]);
+
   // Load message history when document changes
   useEffect(() => {
     if (!doc) return;
@@ -151,7 +176,23 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
       let buffer = '';
       webSocket.onmessage = (event: MessageEvent) => {
         const data = JSON.parse(event.data);
-        if (data.streaming) {
+        if (data.document_text_required) {
+          // the server's cached copy of the document is stale, resend with the full document
+          if (pendingRequestRef.current && editorRef.current) {
+            lastSentVersionRef.current = pendingRequestRef.current.document_version;
+            webSocket.send(JSON.stringify({
+              ...pendingRequestRef.current,
+              'document_text': JSON.stringify(editorRef.current.getEditorState()),
+            }));
+            pendingRequestRef.current = null;
+          }
+        } else if (data.queued) {
+          setQueuePosition(data.position);
+        } else if (data.error) {
+          setQueuePosition(undefined);
+          setMessages(msgs => [...msgs, { content: data.error, type: 'ai', timestamp: new Date().toISOString() }]);
+        } else if (data.streaming) {
+          setQueuePosition(undefined);
           onStreamingMessage(data);
         } else if (data.message === "") {
           onStreamingFinished(data.changes, data.justification);
@@ -202,13 +243,24 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
     // and clear streaming message for a new response
     setMessages(messages => [...messages, { content: input, type: 'human', timestamp: new Date().toISOString() }]);
 
-    const documentJson = JSON.stringify(editor.getEditorState());
-
-    agentSocket.send(JSON.stringify({
+    const documentVersion = getDocumentVersion(yjsDocMap.get(doc.id));
+    const request: Record<string, any> = {
       'message': input,
       'document_id': doc.id,
-      'document_text': documentJson,
-    }));
+      'document_version': documentVersion,
+    };
+    pendingRequestRef.current = request;
+
+    // only upload the document if the server has not seen this version yet
+    if (!documentVersion || documentVersion !== lastSentVersionRef.current) {
+      lastSentVersionRef.current = documentVersion;
+      agentSocket.send(JSON.stringify({
+        ...request,
+        'document_text': JSON.stringify(editor.getEditorState()),
+      }));
+    } else {
+      agentSocket.send(JSON.stringify(request));
+    }
 
     setInput("");
   }
@@ -307,6 +359,7 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
   };
 
   const onStreamingFinished = (changes?: string, justification?: string) => {
+    setQueuePosition(undefined);
     const content = streamingMessageRef.current;
     streamingMessageRef.current = ""; // prevent double-fire from producing duplicate
     if (!content) return;
@@ -440,6 +493,13 @@ export function Agent({ addThreadRef }: { addThreadRef: React.MutableRefObject<a
             )}
           </div>
         ))}
+        { queuePosition !== undefined && streamingMessage === "" && (
+          <Message
+            content={queuePosition ? `Waiting for the agent (#${queuePosition} in line)...` : 'Waiting for your other request to finish...'}
+            type='ai'
+            key={'queued'}
+          />
+        )}
         { streamingMessage !== "" && <Message content={streamingMessage} type='ai' key={'streaming'} /> }
         <div ref={messagesEndRef} />
       </div>
@@ -116,8 +116,8 @@ export function DocumentProvider({ children }: { children: React.ReactNode }) {
     try {
       // get the presigned url
       const { data, status } = await makeRequest({
-        url: `${BACKEND_URL}/documents/${doc.id}/`,
-        method: 'PUT',
+        url: `${BACKEND_URL}/documents/${doc.id}/upload_url/`,
+        method: 'POST',
         body: {
           content_type: type
         },
@@ -145,6 +145,15 @@ export function DocumentProvider({ children }: { children: React.ReactNode }) {
         if (!s3Response.ok) {
           throw new Error(`Failed to upload to S3: ${s3Response.status}`);
         }
+
+        // record the uploaded format so the document is served without checking S3
+        await makeRequest({
+          url: `${BACKEND_URL}/documents/${doc.id}/uploaded/`,
+          method: 'POST',
+          body: {
+            content_type: type
+          }
+        });
         
         return { data: null, status: s3Response.status };
       } else {
@@ -16,7 +16,7 @@ import {
 import { type VariantProps } from 'class-variance-authority';
 import { toast } from 'sonner';
 
-import { BACKEND_URL } from 'lib/constants';
+import { BACKEND_URL, WEBSOCKET_URL } from 'lib/constants';
 import { makeRequest, STATUS } from 'lib/utils/request';
 import { useDialog } from 'context/dialog';
 import { buttonVariants } from 'components/ui/button';
@@ -46,6 +46,13 @@ interface DocumentsContext {
   setVersions: any;
 }
 
+type PDFExport = {
+  id: string;
+  status: 'pending' | 'running' | 'done' | 'failed';
+  url: string | null;
+  error: string | null;
+};
+
 const DocumentsContext = React.createContext<DocumentsContext | undefined>(undefined);
 
 export function DocumentsProvider({ children }: { children: React.ReactNode }) {
@@ -241,6 +248,7 @@ export function DocumentsProvider({ children }: { children: React.ReactNode }) {
 
   /**
    * Retrieves a presigned URL for downloading a document as a PDF.
+   * If the document's content has not been exported yet, waits for the export to finish.
    *
    * @param {string} id - The ID of the document.
    * @returns {Promise<string | null>} A promise that resolves to a string representing the presigned URL for downloading the document.
@@ -254,12 +262,38 @@ export function DocumentsProvider({ children }: { children: React.ReactNode }) {
     });
 
     if (status === STATUS.HTTP_200_OK && typeof data === 'object') {
-      const presignedURL = (data as { url: string }).url;
+      const presignedURL = (data as PDFExport).url;
       return presignedURL;
     };
+    if (status === STATUS.HTTP_202_ACCEPTED && typeof data === 'object') {
+      return waitForPDFExport((data as PDFExport).id);
+    }
     return null;
   }
 
+  /**
+   * Waits for a PDF export to finish on its websocket.
+   *
+   * @param {string} exportId - The ID of the export.
+   * @returns {Promise<string | null>} A promise that resolves to the presigned URL of the PDF, or null if the export failed.
+   */
+  function waitForPDFExport(exportId: string): Promise<string | null> {
+    return new Promise((resolve) => {
+      const webSocket = new WebSocket(`${WEBSOCKET_URL}/ws/exports/${exportId}/`);
+      const timeoutId = window.setTimeout(() => webSocket.close(), 120000);
+
+      webSocket.onmessage = (event) => {
+        const data = JSON.parse(event.data) as PDFExport;
+        window.clearTimeout(timeoutId);
+        resolve(data.status === 'done' ? data.url : null);
+      };
+      webSocket.onclose = () => {
+        window.clearTimeout(timeoutId);
+        resolve(null); // no-op if the export already finished
+      };
+    });
+  }
+
   /**
    * Opens a dialog asking the user to confirm an action before doing so.
    * 